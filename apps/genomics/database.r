@@ -28,7 +28,7 @@ tissue <- tbl(db, "tissue")
 cell_type <- tbl(db, "cell_type") %>%
   inner_join(tissue, by = "tissue_id")
 sample <- tbl(db, "sample") %>%
-  inner_join(patient, by = "patient_id")
+  inner_join(patient, by = "patient_key")
 
 # Entity ID lists (for UI dropdown)
 genes <- gene %>%
@@ -63,48 +63,59 @@ data_tbls <- list(
 
 ################
 # Derived tables
+# (joined to patients and samples on their integer keys; the barcodes come
+# from the patient and sample tables)
 
 patient_immune_subtype <- data_tbls$patient_text_value %>%
   filter(data_type == "Immune Subtype") %>%
-  inner_join(patient, by = "patient_id") %>%
+  select(-patient_id) %>%
+  inner_join(patient, by = "patient_key") %>%
   select(cohort_id, patient_id, immune_subtype = value)
 
 patient_immune_composition <- data_tbls$patient_value %>%
   filter(unit == "fraction") %>%
-  inner_join(patient, by = "patient_id") %>%
+  select(-patient_id) %>%
+  inner_join(patient, by = "patient_key") %>%
   select(cohort_id, patient_id, component = data_type, fraction = value)
 
 patient_signature_score <- data_tbls$patient_value %>%
   filter(unit == "signature score") %>%
-  inner_join(patient, by = "patient_id") %>%
+  select(-patient_id) %>%
+  inner_join(patient, by = "patient_key") %>%
   select(cohort_id, patient_id, signature = data_type, signature_score = value)
 
 patient_clinical_text <- data_tbls$patient_text_value %>%
   filter(unit == "clinical") %>%
-  inner_join(patient, by = "patient_id")
+  select(-patient_id) %>%
+  inner_join(patient, by = "patient_key")
 
 patient_clinical_value <- data_tbls$patient_value %>%
   filter(unit == "clinical") %>%
-  inner_join(patient, by = "patient_id")
+  select(-patient_id) %>%
+  inner_join(patient, by = "patient_key")
 
 sample_expression <- data_tbls$sample_gene_value %>%
   filter(data_type == "expression") %>%
+  select(-sample_id) %>%
   inner_join(gene, by = "gene_id") %>%
-  inner_join(sample, by = "sample_id")
+  inner_join(sample, by = c("sample_key", "cohort_id"))
 
 sample_copy_number <- data_tbls$sample_gene_value %>%
   filter(data_type == "copy number") %>%
+  select(-sample_id) %>%
   inner_join(gene, by = "gene_id") %>%
-  inner_join(sample, by = "sample_id")
+  inner_join(sample, by = c("sample_key", "cohort_id"))
 
 sample_mutation <- data_tbls$sample_gene_text_value %>%
   filter(unit == "mutation") %>%
+  select(-sample_id) %>%
   inner_join(gene, by = "gene_id") %>%
-  inner_join(sample, by = "sample_id")
+  inner_join(sample, by = "sample_key")
 
 sample_isoform <- data_tbls$sample_isoform_value %>%
+  select(-sample_id) %>%
   inner_join(isoform, by = "isoform_id") %>%
-  inner_join(sample, by = "sample_id")
+  inner_join(sample, by = "sample_key")
 
 tissue_expression <- data_tbls$tissue_gene_value %>%
   filter(data_type == "expression") %>%
@@ -0,0 +1,119 @@
+"""Partition sample_gene_value by data_type and cohort
+
+Revision ID: 2b7c5e1d9a3f
+Revises: f78df4a87305
+Create Date: 2026-10-18 09:12:31.482113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b7c5e1d9a3f'
+down_revision = 'f78df4a87305'
+branch_labels = None
+depends_on = None
+
+# Data types with their own cohort-partitioned table, by partition suffix
+DATA_TYPES = {
+    'expression': 'expression',
+    'copy number': 'copy_number',
+}
+
+
+def check_cohorts():
+    """Values must have a cohort, through their sample's patient, to move
+
+    cohort_id is part of the new primary key. Rather than drop rows of
+    samples without a patient, or fail on the first patient without a
+    cohort, count both and stop before changing anything.
+    """
+    no_patient, no_cohort = op.get_bind().execute('''
+        SELECT COUNT(*) FILTER (WHERE p.patient_id IS NULL),
+               COUNT(*) FILTER (WHERE p.patient_id IS NOT NULL
+                                AND p.cohort_id IS NULL)
+        FROM sample_gene_value o
+        INNER JOIN sample s ON s.sample_id = o.sample_id
+        LEFT JOIN patient p ON p.patient_id = s.patient_id
+    ''').fetchone()
+    if no_patient or no_cohort:
+        raise RuntimeError(
+            f'sample_gene_value has {no_patient} rows of samples without a '
+            f'patient and {no_cohort} rows of patients without a cohort. '
+            'Set their patient and cohort, or delete those rows, before '
+            'upgrading.')
+
+
+def upgrade():
+    check_cohorts()
+    op.rename_table('sample_gene_value', 'sample_gene_value_old')
+    op.execute('ALTER INDEX sample_gene_value_pkey '
+               'RENAME TO sample_gene_value_old_pkey')
+
+    op.create_table(
+        'sample_gene_value',
+        sa.Column('sample_id', sa.String, sa.ForeignKey('sample.sample_id'),
+                  primary_key=True),
+        sa.Column('gene_id', sa.Integer, sa.ForeignKey('gene.gene_id'),
+                  primary_key=True),
+        sa.Column('data_type', sa.String, primary_key=True),
+        sa.Column('cohort_id', sa.String, sa.ForeignKey('cohort.cohort_id'),
+                  primary_key=True),
+        sa.Column('unit', sa.String),
+        sa.Column('value', sa.Numeric, nullable=False),
+        postgresql_partition_by='LIST (data_type)')
+
+    cohorts = [row[0] for row in
+               op.get_bind().execute('SELECT cohort_id FROM cohort')]
+    for data_type, suffix in DATA_TYPES.items():
+        op.execute(f'''
+            CREATE TABLE sample_gene_value_{suffix}
+            PARTITION OF sample_gene_value
+            FOR VALUES IN ('{data_type}')
+            PARTITION BY LIST (cohort_id)
+        ''')
+        for cohort in cohorts:
+            op.execute(f'''
+                CREATE TABLE sample_gene_value_{suffix}_{cohort.lower()}
+                PARTITION OF sample_gene_value_{suffix}
+                FOR VALUES IN ('{cohort}')
+            ''')
+    op.execute('''
+        CREATE TABLE sample_gene_value_other
+        PARTITION OF sample_gene_value DEFAULT
+    ''')
+
+    op.execute('''
+        INSERT INTO sample_gene_value
+        (sample_id, gene_id, data_type, cohort_id, unit, value)
+        SELECT o.sample_id, o.gene_id, o.data_type, p.cohort_id,
+               o.unit, o.value
+        FROM sample_gene_value_old o
+        INNER JOIN sample s ON s.sample_id = o.sample_id
+        INNER JOIN patient p ON p.patient_id = s.patient_id
+    ''')
+    op.drop_table('sample_gene_value_old')
+
+
+def downgrade():
+    op.rename_table('sample_gene_value', 'sample_gene_value_partitioned')
+    op.execute('ALTER INDEX sample_gene_value_pkey '
+               'RENAME TO sample_gene_value_partitioned_pkey')
+
+    op.create_table(
+        'sample_gene_value',
+        sa.Column('sample_id', sa.String, sa.ForeignKey('sample.sample_id'),
+                  primary_key=True),
+        sa.Column('gene_id', sa.Integer, sa.ForeignKey('gene.gene_id'),
+                  primary_key=True),
+        sa.Column('data_type', sa.String, primary_key=True),
+        sa.Column('unit', sa.String),
+        sa.Column('value', sa.Numeric, nullable=False))
+    op.execute('''
+        INSERT INTO sample_gene_value
+        (sample_id, gene_id, data_type, unit, value)
+        SELECT sample_id, gene_id, data_type, unit, value
+        FROM sample_gene_value_partitioned
+    ''')
+    op.drop_table('sample_gene_value_partitioned')
@@ -0,0 +1,31 @@
+"""Add load_checkpoint for resuming failed loads chunk by chunk
+
+Revision ID: 4c8e1b3d7f92
+Revises: 9b4d2e6f1a07
+Create Date: 2026-10-19 09:41:17.204385
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c8e1b3d7f92'
+down_revision = '9b4d2e6f1a07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'load_checkpoint',
+        sa.Column('update_id', sa.String, primary_key=True),
+        sa.Column('chunk', sa.Integer, primary_key=True),
+        sa.Column('input_hash', sa.String),
+        sa.Column('n_rows', sa.BigInteger),
+        sa.Column('committed', sa.DateTime(timezone=True),
+                  server_default=sa.func.now()))
+
+
+def downgrade():
+    op.drop_table('load_checkpoint')
@@ -0,0 +1,57 @@
+"""Store EAV values as real or double precision
+
+Revision ID: 5a9e2c7b1d46
+Revises: c41e9b7d2f08
+Create Date: 2026-10-18 19:26:14.550873
+
+"""
+from alembic import op
+
+from ob_genomics.config import cfg
+
+
+# revision identifiers, used by Alembic.
+revision = '5a9e2c7b1d46'
+down_revision = 'c41e9b7d2f08'
+branch_labels = None
+depends_on = None
+
+# Numeric EAV tables and their previous value type
+TABLES = {
+    'patient_value': 'numeric',
+    'sample_gene_value': 'numeric',
+    'sample_isoform_value': 'varchar',
+    'tissue_gene_value': 'numeric',
+    'tissue_isoform_value': 'numeric',
+}
+SQL_TYPES = {
+    'real': 'real',
+    'double': 'double precision',
+}
+# Values of the text sample_isoform_value column that parse as numbers
+NUMBER = r'^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$'
+
+
+def alter_values(types):
+    '''Change value column types, recreating the views that read them'''
+    bind = op.get_bind()
+    views = {name: bind.execute('SELECT pg_get_viewdef(%s)', (name,)).scalar()
+             for name in types}
+    for name in views:
+        op.execute(f'DROP VIEW {name}')
+    for name, sql_type in types.items():
+        op.execute(f'ALTER TABLE {name}_fact ALTER COLUMN value '
+                   f'TYPE {sql_type} USING value::{sql_type}')
+    for name, definition in views.items():
+        op.execute(f'CREATE VIEW {name} AS {definition}')
+
+
+def upgrade():
+    op.execute(f"DELETE FROM sample_isoform_value_fact "
+               f"WHERE value !~ '{NUMBER}'")
+    alter_values({name: SQL_TYPES[cfg['VALUE_PRECISION'][name]]
+                  for name in TABLES})
+
+
+def downgrade():
+    alter_values(TABLES)
@@ -0,0 +1,46 @@
+"""Record the input that loaded each patient value
+
+Revision ID: 6e2a9d4c8b15
+Revises: 4c8e1b3d7f92
+Create Date: 2026-10-20 10:06:52.731948
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2a9d4c8b15'
+down_revision = '4c8e1b3d7f92'
+branch_labels = None
+depends_on = None
+
+TABLES = ['patient_value', 'patient_text_value']
+
+
+def view(name, source=True):
+    source_col = ', t.source_id' if source else ''
+    return f'''
+        CREATE OR REPLACE VIEW {name} AS
+        SELECT patient.patient_id, t.patient_key, d.data_type, u.unit,
+               t.value{source_col}
+        FROM {name}_fact t
+        LEFT JOIN patient ON patient.patient_key = t.patient_key
+        INNER JOIN data_type d ON d.data_type_id = t.data_type_id
+        LEFT JOIN unit u ON u.unit_id = t.unit_id
+    '''
+
+
+def upgrade():
+    # Rows loaded before are left without a source: reloads keep them
+    for name in TABLES:
+        op.add_column(f'{name}_fact', sa.Column(
+            'source_id', sa.String, sa.ForeignKey('source.source_id')))
+        op.execute(view(name))
+
+
+def downgrade():
+    for name in TABLES:
+        op.execute(f'DROP VIEW {name}')
+        op.execute(view(name, source=False))
+        op.drop_column(f'{name}_fact', 'source_id')
@@ -0,0 +1,210 @@
+"""Dictionary-encode data_type and unit in the EAV tables
+
+Revision ID: 8d3f6a0c4e21
+Revises: 2b7c5e1d9a3f
+Create Date: 2026-10-18 14:37:02.915560
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3f6a0c4e21'
+down_revision = '2b7c5e1d9a3f'
+branch_labels = None
+depends_on = None
+
+# Key columns of the EAV tables: (type, foreign key)
+KEYS = {
+    'patient_id': (sa.String, 'patient.patient_id'),
+    'sample_id': (sa.String, 'sample.sample_id'),
+    'gene_id': (sa.Integer, 'gene.gene_id'),
+    'isoform_id': (sa.String, 'isoform.isoform_id'),
+    'source_id': (sa.String, 'source.source_id'),
+    'tissue_id': (sa.String, 'tissue.tissue_id'),
+    'cell_type_id': (sa.String, 'cell_type.cell_type_id'),
+    'cohort_id': (sa.String, 'cohort.cohort_id'),
+}
+# EAV tables: (columns before value, value type)
+TABLES = {
+    'patient_value': (['patient_id', 'data_type', 'unit'], sa.Numeric),
+    'patient_text_value': (['patient_id', 'data_type', 'unit'], sa.String),
+    'sample_gene_value': (
+        ['sample_id', 'gene_id', 'data_type', 'cohort_id', 'unit'],
+        sa.Numeric),
+    'sample_gene_text_value': (
+        ['sample_id', 'gene_id', 'data_type', 'unit'], sa.String),
+    'sample_isoform_value': (['sample_id', 'isoform_id', 'unit'], sa.String),
+    'tissue_gene_value': (
+        ['source_id', 'tissue_id', 'gene_id', 'data_type', 'unit'],
+        sa.Numeric),
+    'tissue_isoform_value': (
+        ['source_id', 'tissue_id', 'isoform_id', 'unit'], sa.Numeric),
+    'cell_type_gene_text_value': (
+        ['source_id', 'cell_type_id', 'gene_id', 'data_type', 'unit'],
+        sa.String),
+}
+# Data types with their own cohort-partitioned table, by partition suffix
+SAMPLE_GENE_DATA_TYPES = {
+    'expression': 'expression',
+    'copy number': 'copy_number',
+}
+
+
+def table_columns(name, encoded):
+    names, value_type = TABLES[name]
+    cols = []
+    for col in names:
+        if col == 'data_type' and encoded:
+            cols.append(sa.Column(
+                'data_type_id', sa.SmallInteger,
+                sa.ForeignKey('data_type.data_type_id'), primary_key=True))
+        elif col == 'data_type':
+            cols.append(sa.Column('data_type', sa.String, primary_key=True))
+        elif col == 'unit' and encoded:
+            cols.append(sa.Column('unit_id', sa.SmallInteger,
+                                  sa.ForeignKey('unit.unit_id')))
+        elif col == 'unit':
+            cols.append(sa.Column('unit', sa.String))
+        else:
+            col_type, fk = KEYS[col]
+            cols.append(sa.Column(col, col_type, sa.ForeignKey(fk),
+                                  primary_key=True))
+    cols.append(sa.Column('value', value_type, nullable=False))
+    return cols
+
+
+def create_table(name, encoded):
+    table = f'{name}_fact' if encoded else name
+    if name != 'sample_gene_value':
+        op.create_table(table, *table_columns(name, encoded))
+        return
+
+    partition_by = 'data_type_id' if encoded else 'data_type'
+    op.create_table(table, *table_columns(name, encoded),
+                    postgresql_partition_by=f'LIST ({partition_by})')
+    bind = op.get_bind()
+    cohorts = [row[0] for row in bind.execute('SELECT cohort_id FROM cohort')]
+    for data_type, suffix in SAMPLE_GENE_DATA_TYPES.items():
+        if encoded:
+            bound = bind.execute(
+                'SELECT data_type_id FROM data_type WHERE data_type = %s',
+                (data_type,)).scalar()
+        else:
+            bound = f"'{data_type}'"
+        op.execute(f'''
+            CREATE TABLE sample_gene_value_{suffix}
+            PARTITION OF {table}
+            FOR VALUES IN ({bound})
+            PARTITION BY LIST (cohort_id)
+        ''')
+        for cohort in cohorts:
+            op.execute(f'''
+                CREATE TABLE sample_gene_value_{suffix}_{cohort.lower()}
+                PARTITION OF sample_gene_value_{suffix}
+                FOR VALUES IN ('{cohort}')
+            ''')
+    op.execute(f'''
+        CREATE TABLE sample_gene_value_other
+        PARTITION OF {table} DEFAULT
+    ''')
+
+
+def rename_partitions(table):
+    '''Move partitions and their indexes out of the way of new ones'''
+    bind = op.get_bind()
+    for relation, kind in [(table, 'TABLE'), (f'{table}_pkey', 'INDEX')]:
+        names = [row[0] for row in bind.execute(f'''
+            SELECT c.relname FROM pg_partition_tree('{relation}') t
+            INNER JOIN pg_class c ON c.oid = t.relid
+            WHERE t.level > 0
+        ''')]
+        for name in names:
+            op.execute(f'ALTER {kind} {name} RENAME TO {name}_old')
+
+
+def copy_rows(name, encoded):
+    '''Copy rows between the text and the encoded version of a table'''
+    names, _ = TABLES[name]
+    source, target = (name, f'{name}_fact') if encoded else (f'{name}_fact',
+                                                              name)
+    cols, exprs = [], []
+    for col in names + ['value']:
+        if col == 'data_type':
+            cols.append('data_type_id' if encoded else 'data_type')
+            exprs.append('d.data_type_id' if encoded else 'd.data_type')
+        elif col == 'unit':
+            cols.append('unit_id' if encoded else 'unit')
+            exprs.append('u.unit_id' if encoded else 'u.unit')
+        else:
+            cols.append(col)
+            exprs.append(f't.{col}')
+    joins = []
+    if 'data_type' in names:
+        joins.append('INNER JOIN data_type d ON ' + (
+            'd.data_type = t.data_type' if encoded
+            else 'd.data_type_id = t.data_type_id'))
+    joins.append('LEFT JOIN unit u ON ' + (
+        'u.unit = t.unit' if encoded else 'u.unit_id = t.unit_id'))
+    op.execute(f'''
+        INSERT INTO {target} ({", ".join(cols)})
+        SELECT {", ".join(exprs)}
+        FROM {source} t {" ".join(joins)}
+    ''')
+
+
+def view_sql(name):
+    names, _ = TABLES[name]
+    cols = [f'{"d" if col == "data_type" else "u" if col == "unit" else "t"}'
+            f'.{col}' for col in names + ['value']]
+    joins = ['LEFT JOIN unit u ON u.unit_id = t.unit_id']
+    if 'data_type' in names:
+        joins.insert(0, 'INNER JOIN data_type d '
+                        'ON d.data_type_id = t.data_type_id')
+    return (f'SELECT {", ".join(cols)} FROM {name}_fact t '
+            + ' '.join(joins))
+
+
+def upgrade():
+    op.create_table(
+        'data_type',
+        sa.Column('data_type_id', sa.SmallInteger, primary_key=True),
+        sa.Column('data_type', sa.String, nullable=False, unique=True))
+    op.create_table(
+        'unit',
+        sa.Column('unit_id', sa.SmallInteger, primary_key=True),
+        sa.Column('unit', sa.String, nullable=False, unique=True))
+
+    for data_type in SAMPLE_GENE_DATA_TYPES:
+        op.execute(f"INSERT INTO data_type (data_type) VALUES ('{data_type}')")
+    for name, (names, _) in TABLES.items():
+        if 'data_type' in names:
+            op.execute(f'''
+                INSERT INTO data_type (data_type)
+                SELECT DISTINCT data_type FROM {name}
+                ON CONFLICT (data_type) DO NOTHING
+            ''')
+        op.execute(f'''
+            INSERT INTO unit (unit)
+            SELECT DISTINCT unit FROM {name} WHERE unit IS NOT NULL
+            ON CONFLICT (unit) DO NOTHING
+        ''')
+
+    rename_partitions('sample_gene_value')
+    for name in TABLES:
+        create_table(name, encoded=True)
+        copy_rows(name, encoded=True)
+        op.drop_table(name)
+        op.execute(f'CREATE VIEW {name} AS {view_sql(name)}')
+
+
+def downgrade():
+    rename_partitions('sample_gene_value_fact')
+    for name in TABLES:
+        op.execute(f'DROP VIEW {name}')
+        create_table(name, encoded=False)
+        copy_rows(name, encoded=False)
+        op.drop_table(f'{name}_fact')
+    op.drop_table('unit')
+    op.drop_table('data_type')
@@ -0,0 +1,40 @@
+"""Add task_metric for build task timings and row counts
+
+Revision ID: 9b4d2e6f1a07
+Revises: e3a1f7c09b52
+Create Date: 2026-10-18 23:10:42.608139
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b4d2e6f1a07'
+down_revision = 'e3a1f7c09b52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'task_metric',
+        sa.Column('metric_id', sa.Integer, primary_key=True),
+        sa.Column('build_id', sa.String, nullable=False, index=True),
+        sa.Column('task_id', sa.String, nullable=False),
+        sa.Column('step', sa.String, nullable=False),
+        sa.Column('status', sa.String),
+        sa.Column('started', sa.DateTime(timezone=True)),
+        sa.Column('wall_seconds', sa.Float),
+        sa.Column('parse_seconds', sa.Float),
+        sa.Column('transform_seconds', sa.Float),
+        sa.Column('copy_seconds', sa.Float),
+        sa.Column('rows_read', sa.BigInteger),
+        sa.Column('rows_written', sa.BigInteger),
+        sa.Column('rows_dropped', sa.BigInteger),
+        sa.Column('bytes_streamed', sa.BigInteger),
+        sa.Column('peak_rss', sa.BigInteger))
+
+
+def downgrade():
+    op.drop_table('task_metric')
@@ -0,0 +1,210 @@
+"""Integer surrogate keys for samples and patients
+
+Revision ID: c41e9b7d2f08
+Revises: 8d3f6a0c4e21
+Create Date: 2026-10-18 17:05:48.203671
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e9b7d2f08'
+down_revision = '8d3f6a0c4e21'
+branch_labels = None
+depends_on = None
+
+# Dimension tables by barcode column, with their surrogate key
+DIMENSIONS = {
+    'patient': ('patient_id', 'patient_key'),
+    'sample': ('sample_id', 'sample_key'),
+}
+# Fact tables keyed by a dimension: (dimension, other columns before value,
+# value type)
+KEYS = {
+    'gene_id': (sa.Integer, 'gene.gene_id'),
+    'isoform_id': (sa.String, 'isoform.isoform_id'),
+    'data_type_id': (sa.SmallInteger, 'data_type.data_type_id'),
+    'cohort_id': (sa.String, 'cohort.cohort_id'),
+}
+TABLES = {
+    'patient_value': ('patient', ['data_type_id'], sa.Numeric),
+    'patient_text_value': ('patient', ['data_type_id'], sa.String),
+    'sample_gene_value': (
+        'sample', ['gene_id', 'data_type_id', 'cohort_id'], sa.Numeric),
+    'sample_gene_text_value': (
+        'sample', ['gene_id', 'data_type_id'], sa.String),
+    'sample_isoform_value': ('sample', ['isoform_id'], sa.String),
+}
+SAMPLE_GENE_DATA_TYPES = {
+    'expression': 'expression',
+    'copy number': 'copy_number',
+}
+
+
+def table_columns(name, keyed):
+    dim, others, value_type = TABLES[name]
+    barcode, key = DIMENSIONS[dim]
+    if keyed:
+        cols = [sa.Column(key, sa.Integer, sa.ForeignKey(f'{dim}.{key}'),
+                          primary_key=True)]
+    else:
+        cols = [sa.Column(barcode, sa.String,
+                          sa.ForeignKey(f'{dim}.{barcode}'),
+                          primary_key=True)]
+    for col in others:
+        col_type, fk = KEYS[col]
+        cols.append(sa.Column(col, col_type, sa.ForeignKey(fk),
+                              primary_key=True))
+    cols.append(sa.Column('unit_id', sa.SmallInteger,
+                          sa.ForeignKey('unit.unit_id')))
+    cols.append(sa.Column('value', value_type, nullable=False))
+    return cols
+
+
+def create_table(name, keyed):
+    table = f'{name}_fact'
+    if name != 'sample_gene_value':
+        op.create_table(table, *table_columns(name, keyed))
+        return
+
+    op.create_table(table, *table_columns(name, keyed),
+                    postgresql_partition_by='LIST (data_type_id)')
+    bind = op.get_bind()
+    cohorts = [row[0] for row in bind.execute('SELECT cohort_id FROM cohort')]
+    for data_type, suffix in SAMPLE_GENE_DATA_TYPES.items():
+        data_type_id = bind.execute(
+            'SELECT data_type_id FROM data_type WHERE data_type = %s',
+            (data_type,)).scalar()
+        op.execute(f'''
+            CREATE TABLE sample_gene_value_{suffix}
+            PARTITION OF {table}
+            FOR VALUES IN ({data_type_id})
+            PARTITION BY LIST (cohort_id)
+        ''')
+        for cohort in cohorts:
+            op.execute(f'''
+                CREATE TABLE sample_gene_value_{suffix}_{cohort.lower()}
+                PARTITION OF sample_gene_value_{suffix}
+                FOR VALUES IN ('{cohort}')
+            ''')
+    op.execute(f'''
+        CREATE TABLE sample_gene_value_other
+        PARTITION OF {table} DEFAULT
+    ''')
+
+
+def rename_table(table):
+    '''Move a table, its partitions and their indexes out of the way'''
+    bind = op.get_bind()
+    for relation, kind in [(table, 'TABLE'), (f'{table}_pkey', 'INDEX')]:
+        names = [row[0] for row in bind.execute(f'''
+            SELECT c.relname FROM pg_partition_tree('{relation}') t
+            INNER JOIN pg_class c ON c.oid = t.relid
+            WHERE t.level > 0
+        ''')]
+        for name in names + [relation]:
+            op.execute(f'ALTER {kind} {name} RENAME TO {name}_old')
+
+
+def drop_dimension_fkeys():
+    '''Drop foreign keys referencing patients or samples'''
+    rows = op.get_bind().execute('''
+        SELECT conrelid::regclass::text, conname FROM pg_constraint
+        WHERE contype = 'f' AND conparentid = 0
+        AND confrelid IN ('patient'::regclass, 'sample'::regclass)
+    ''').fetchall()
+    for table, name in rows:
+        op.execute(f'ALTER TABLE {table} DROP CONSTRAINT {name}')
+
+
+def copy_rows(name, keyed):
+    '''Copy rows from the renamed table, swapping barcodes and keys'''
+    dim, others, _ = TABLES[name]
+    barcode, key = DIMENSIONS[dim]
+    source, target = (barcode, key) if keyed else (key, barcode)
+    cols = others + ['unit_id', 'value']
+    op.execute(f'''
+        INSERT INTO {name}_fact ({target}, {", ".join(cols)})
+        SELECT d.{target}, {", ".join(f"t.{col}" for col in cols)}
+        FROM {name}_fact_old t
+        INNER JOIN {dim} d ON d.{source} = t.{source}
+    ''')
+    op.drop_table(f'{name}_fact_old')
+
+
+def view_sql(name, keyed):
+    dim, others, _ = TABLES[name]
+    barcode, key = DIMENSIONS[dim]
+    cols = [f'{dim}.{barcode}', f't.{key}'] if keyed else [f't.{barcode}']
+    joins = [f'LEFT JOIN {dim} ON {dim}.{key} = t.{key}'] if keyed else []
+    for col in others:
+        if col == 'data_type_id':
+            cols.append('d.data_type')
+            joins.append('INNER JOIN data_type d '
+                         'ON d.data_type_id = t.data_type_id')
+        else:
+            cols.append(f't.{col}')
+    cols += ['u.unit', 't.value']
+    joins.append('LEFT JOIN unit u ON u.unit_id = t.unit_id')
+    return (f'SELECT {", ".join(cols)} FROM {name}_fact t '
+            + ' '.join(joins))
+
+
+def upgrade():
+    for name in TABLES:
+        op.execute(f'DROP VIEW {name}')
+        rename_table(f'{name}_fact')
+    drop_dimension_fkeys()
+
+    for dim, (barcode, key) in DIMENSIONS.items():
+        op.add_column(dim, sa.Column(key, sa.Integer, autoincrement=True))
+        op.execute(f'CREATE SEQUENCE {dim}_{key}_seq OWNED BY {dim}.{key}')
+        op.execute(f"UPDATE {dim} SET {key} = nextval('{dim}_{key}_seq')")
+        op.execute(f'ALTER TABLE {dim} ALTER COLUMN {key} '
+                   f"SET DEFAULT nextval('{dim}_{key}_seq')")
+        op.drop_constraint(f'{dim}_pkey', dim)
+        op.create_primary_key(f'{dim}_pkey', dim, [key])
+        op.create_unique_constraint(f'{dim}_{barcode}_key', dim, [barcode])
+
+    op.add_column('sample', sa.Column('patient_key', sa.Integer))
+    op.execute('''
+        UPDATE sample s SET patient_key = p.patient_key
+        FROM patient p WHERE p.patient_id = s.patient_id
+    ''')
+    op.drop_column('sample', 'patient_id')
+    op.create_foreign_key('sample_patient_key_fkey', 'sample', 'patient',
+                          ['patient_key'], ['patient_key'])
+
+    for name in TABLES:
+        create_table(name, keyed=True)
+        copy_rows(name, keyed=True)
+        op.execute(f'CREATE VIEW {name} AS {view_sql(name, keyed=True)}')
+
+
+def downgrade():
+    for name in TABLES:
+        op.execute(f'DROP VIEW {name}')
+        rename_table(f'{name}_fact')
+    drop_dimension_fkeys()
+
+    op.add_column('sample', sa.Column('patient_id', sa.String))
+    op.execute('''
+        UPDATE sample s SET patient_id = p.patient_id
+        FROM patient p WHERE p.patient_key = s.patient_key
+    ''')
+    op.drop_column('sample', 'patient_key')
+    for dim, (barcode, key) in DIMENSIONS.items():
+        op.drop_constraint(f'{dim}_{barcode}_key', dim)
+        op.drop_constraint(f'{dim}_pkey', dim)
+        op.create_primary_key(f'{dim}_pkey', dim, [barcode])
+    op.create_foreign_key('sample_patient_id_fkey', 'sample', 'patient',
+                          ['patient_id'], ['patient_id'])
+
+    for name in TABLES:
+        create_table(name, keyed=False)
+        copy_rows(name, keyed=False)
+        op.execute(f'CREATE VIEW {name} AS {view_sql(name, keyed=False)}')
+    for dim, (_, key) in DIMENSIONS.items():
+        op.drop_column(dim, key)
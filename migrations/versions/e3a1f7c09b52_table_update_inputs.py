@@ -0,0 +1,34 @@
+"""Record input files and row counts of table updates
+
+Revision ID: e3a1f7c09b52
+Revises: 5a9e2c7b1d46
+Create Date: 2026-10-18 21:48:09.317264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a1f7c09b52'
+down_revision = '5a9e2c7b1d46'
+branch_labels = None
+depends_on = None
+
+COLUMNS = [
+    ('input_path', sa.String),
+    ('input_size', sa.BigInteger),
+    ('input_mtime', sa.DateTime(timezone=True)),
+    ('input_hash', sa.String),
+    ('n_rows', sa.BigInteger),
+]
+
+
+def upgrade():
+    for name, type_ in COLUMNS:
+        op.add_column('table_update', sa.Column(name, type_))
+
+
+def downgrade():
+    for name, _ in reversed(COLUMNS):
+        op.drop_column('table_update', name)
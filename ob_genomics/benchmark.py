@@ -0,0 +1,539 @@
+'''Loader benchmarks on synthetic reference files
+
+generate() writes files shaped like the real reference at a given scale:
+NCBI genes, isoform maps, GDAC RSEM and GISTIC matrices, clinical picked
+files, an MC3 MAF, GTEx GCTs, HPA tables, the immune landscape and TCIA
+tables. run() loads them into a throwaway database created next to the
+configured one, each loader in its own forked process, and reports rows per
+second and peak memory per loader. Results are saved as JSON, and compare()
+lines up two runs.
+
+Nothing is downloaded, but the loaders stream with Postgres COPY, so a
+Postgres server is needed; a local one will do.
+'''
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import json
+import multiprocessing
+import os
+import os.path as op
+import platform
+import shutil
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+from ob_genomics.config import cfg
+from ob_genomics import cache
+from ob_genomics import gtex
+from ob_genomics import hpa
+from ob_genomics import metrics
+from ob_genomics import tcga
+import ob_genomics.database as db
+
+BENCHMARK_DIR = op.join(cfg['SCRATCH'], 'benchmark')
+# Synthetic reference sizes at scale 1; all but the per-unit counts scale
+SIZES = {
+    'genes': 2000,
+    'isoforms_per_gene': 2,
+    'cohorts': 2,
+    'patients_per_cohort': 100,
+    'mutations': 20000,
+    'tissues': 10,
+    'cell_types_per_tissue': 3,
+    'gtex_samples': 200,
+    'tcia_cell_types': 20,
+}
+FIXED = ['isoforms_per_gene', 'cohorts', 'tissues', 'cell_types_per_tissue',
+         'tcia_cell_types']
+VARIANTS = ['Missense_Mutation', 'Silent', 'Nonsense_Mutation',
+            'Frame_Shift_Del', 'Splice_Site', "3'UTR"]
+
+
+def sizes(scale=1.):
+    '''Synthetic reference sizes at scale'''
+    return {name: n if name in FIXED else max(1, int(round(n * scale)))
+            for name, n in SIZES.items()}
+
+
+def _write_gct(fpath, df):
+    with open(fpath, 'w') as f:
+        f.write('#1.2\n')
+        f.write(f'{len(df)}\t{df.shape[1] - 2}\n')
+        df.to_csv(f, sep='\t', index=False, float_format='%.3f')
+
+
+def _write_rsem(fpath, values, labels, barcodes, value_name):
+    '''GDAC RSEM matrix, with its second header line of value names'''
+    with open(fpath, 'w') as f:
+        f.write('\t'.join(['Hybridization REF', *barcodes]) + '\n')
+        f.write('\t'.join(['gene_id', *[value_name] * len(barcodes)]) + '\n')
+        pd.DataFrame(values, index=labels).to_csv(
+            f, sep='\t', header=False, float_format='%.4f')
+
+
+def generate(out_dir, scale=1., seed=0):
+    '''Write a synthetic reference to out_dir, returning paths by input
+
+    TCGA matrices and clinical files are written once per cohort, as
+    {cohort: path} dicts.
+    '''
+    n = sizes(scale)
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+
+    def path(name):
+        paths[name] = op.join(out_dir, name)
+        return paths[name]
+
+    # Genes, a few retired ones, and their isoforms
+    gene_id = np.arange(1, n['genes'] + 1)
+    genes = pd.DataFrame({
+        'GeneID': gene_id,
+        'ensembl_id': [f'ENSG{i:011d}' for i in gene_id],
+        'Symbol': [f'GENE{i}' for i in gene_id],
+    })
+    genes.to_csv(path('genes.hs.csv'), index=False)
+    retired = gene_id[::100]
+    pd.DataFrame({
+        '#tax_id': 9606,
+        'GeneID': retired,
+        'Discontinued_GeneID': retired + n['genes'],
+        'Discontinued_Symbol': [f'OLD{i}' for i in retired],
+        'Discontinue_Date': 20150101,
+    }).to_csv(path('gene_history.hs.tsv'), sep='\t', index=False)
+    isoform_gene = np.repeat(gene_id, n['isoforms_per_gene'])
+    isoforms = [f'uc{i:06d}.1' for i in range(len(isoform_gene))]
+    pd.DataFrame({
+        'mapping': [f'GENE{i}|{i}' for i in isoform_gene],
+        'isoform_id': isoforms,
+    }).to_csv(path('unc_knownToLocus.txt'), sep='\t', index=False,
+              header=False)
+    pd.DataFrame({
+        'isoform_id': [f'ENST{i:011d}.1' for i in range(len(isoform_gene))],
+        'symbol': [f'GENE{i}' for i in isoform_gene],
+    }).to_csv(path('gencode.metadata.HGNC.txt'), sep='\t', index=False,
+              header=False)
+
+    # Tissues and cell types, named as GTEx and HPA name them
+    tissue = pd.DataFrame({
+        'tissue_id': [f'tissue{i}' for i in range(n['tissues'])],
+        'tissue': [f'Tissue {i}' for i in range(n['tissues'])],
+        'subtype': None,
+        'gtex_id': [f'Tissue - Site {i}' for i in range(n['tissues'])],
+        'hpa_id': [f'tissue {i}' for i in range(n['tissues'])],
+    })
+    tissue.to_csv(path('tissue.csv'), index=False)
+    cell_type = pd.DataFrame([
+        {'cell_type_id': f'{t.tissue_id}_cell{j}',
+         'tissue_id': t.tissue_id,
+         'cell_type': f'cell type {j}',
+         'hpa_tissue_id': t.hpa_id}
+        for t in tissue.itertuples() for j in range(n['cell_types_per_tissue'])
+    ])
+    cell_type.to_csv(path('cell_type.csv'), index=False)
+
+    # TCGA cohorts, patients and primary tumor samples
+    cohorts = [f'COHORT{i}' for i in range(n['cohorts'])]
+    pd.DataFrame({'cohort_id': cohorts,
+                  'cohort_name': [f'Cohort {i}' for i in range(len(cohorts))]
+                  }).to_csv(path('cohort.csv'), index=False)
+    patient = pd.DataFrame([
+        {'patient_id': f'TCGA-{c:02d}-{p:04d}', 'cohort_id': cohort}
+        for c, cohort in enumerate(cohorts)
+        for p in range(n['patients_per_cohort'])
+    ])
+    patient.to_csv(path('patient.csv'), index=False)
+    sample = patient.assign(sample_id=patient['patient_id'] + '-01',
+                            sample_code='01',
+                            sample_type='Primary Solid Tumor')
+    sample[['sample_id', 'patient_id', 'sample_code', 'sample_type']].to_csv(
+        path('sample.csv'), index=False)
+    barcodes = sample['sample_id'] + 'A-11R-A000-07'
+
+    for name in ['expression', 'copy number', 'isoforms', 'clinical']:
+        paths[name] = {}
+    for cohort in cohorts:
+        in_cohort = (sample['cohort_id'] == cohort).to_numpy()
+        cohort_barcodes = list(barcodes[in_cohort])
+        n_samples = len(cohort_barcodes)
+
+        fpath = op.join(out_dir, f'{cohort}.rnaseqv2.genes.txt')
+        _write_rsem(fpath,
+                    rng.lognormal(5, 2, (len(gene_id), n_samples)),
+                    [f'GENE{i}|{i}' for i in gene_id], cohort_barcodes,
+                    'normalized_count')
+        paths['expression'][cohort] = fpath
+
+        fpath = op.join(out_dir, f'{cohort}.rnaseqv2.isoforms.txt')
+        _write_rsem(fpath,
+                    rng.lognormal(3, 2, (len(isoforms), n_samples)),
+                    isoforms, cohort_barcodes, 'normalized_count')
+        paths['isoforms'][cohort] = fpath
+
+        fpath = op.join(out_dir, f'{cohort}.all_data_by_genes.txt')
+        gistic = pd.DataFrame(rng.normal(0, .5, (len(gene_id), n_samples)),
+                              columns=cohort_barcodes)
+        gistic.insert(0, 'Gene Symbol', genes['Symbol'])
+        gistic.insert(1, 'Locus ID', gene_id)
+        gistic.insert(2, 'Cytoband', '1p36.33')
+        gistic.to_csv(fpath, sep='\t', index=False, float_format='%.3f')
+        paths['copy number'][cohort] = fpath
+
+        # Picked clinical files have patients, lowercase, as columns
+        patients = patient.loc[in_cohort, 'patient_id'].str.lower()
+        clinical = pd.DataFrame({
+            'years_to_birth': rng.integers(20, 90, n_samples),
+            'vital_status': rng.integers(0, 2, n_samples),
+            'days_to_death': np.where(rng.random(n_samples) < .5, np.nan,
+                                      rng.integers(1, 5000, n_samples)),
+            'gender': rng.choice(['male', 'female'], n_samples),
+            'pathologic_stage': rng.choice(['stage i', 'stage ii',
+                                            'stage iii'], n_samples),
+        }, index=patients.to_numpy())
+        clinical.insert(0, 'Composite Element REF', 'value')
+        fpath = op.join(out_dir, f'{cohort}.clin.merged.picked.txt')
+        clinical.T.rename_axis('Hybridization REF').to_csv(
+            fpath, sep='\t', float_format='%.0f')
+        paths['clinical'][cohort] = fpath
+
+    # MC3 mutations, with the columns read_maf uses among others
+    pick = rng.integers(0, len(gene_id), n['mutations'])
+    pd.DataFrame({
+        'Hugo_Symbol': genes['Symbol'].to_numpy()[pick],
+        'Chromosome': rng.integers(1, 23, n['mutations']),
+        'Start_Position': rng.integers(1, 2**28, n['mutations']),
+        'Variant_Classification': rng.choice(VARIANTS, n['mutations']),
+        'Variant_Type': rng.choice(['SNP', 'DEL', 'INS'], n['mutations']),
+        'Tumor_Sample_Barcode': rng.choice(barcodes, n['mutations']),
+        'HGVSp_Short': [f'p.A{i}T' for i in rng.integers(1, 1000,
+                                                          n['mutations'])],
+        'Gene': genes['ensembl_id'].to_numpy()[pick],
+    }).to_csv(path('mc3.maf'), sep='\t', index=False)
+
+    # Immune landscape, with the duplicated column names of the original
+    n_patients = len(patient)
+    immune = pd.DataFrame({
+        'TCGA Participant Barcode': patient['patient_id'],
+        'TCGA Study': patient['cohort_id'],
+    })
+    for data_type, unit in tcga.IMMUNE_LANDSCAPE_UNITS.items():
+        if unit == 'subtype':
+            immune[data_type] = rng.choice(['C1', 'C2', 'C3'], n_patients)
+        else:
+            immune[data_type] = rng.random(n_patients).round(4)
+    immune = immune.rename(columns={
+        'Eosinophils score': 'Eosinophils.0',
+        'Neutrophils score': 'Neutrophils.0',
+        'Eosinophils': 'Eosinophils.1',
+        'Neutrophils': 'Neutrophils.1'})
+    immune.to_csv(path('immune_landscape.csv'), index=False)
+
+    # TCIA clinical data and cell type enrichment, each patient and cell
+    # type either enriched or depleted
+    pd.DataFrame({
+        'barcode': patient['patient_id'],
+        'datasource': 'TCGA',
+        'disease': patient['cohort_id'],
+        'clinical_data_age': rng.integers(20, 90, n_patients),
+        'clinical_data_gender': rng.choice(['male', 'female'], n_patients),
+        'clinical_data_vital_status': rng.choice(['alive', 'dead'],
+                                                 n_patients),
+    }).to_csv(path('patientsAll.tsv'), sep='\t', index=False)
+    pathways = pd.DataFrame({
+        'patients': np.repeat(patient['patient_id'], n['tcia_cell_types']),
+        'disease': np.repeat(patient['cohort_id'], n['tcia_cell_types']),
+        'cellType': np.tile([f'Cell type {i}'
+                             for i in range(n['tcia_cell_types'])],
+                            n_patients),
+        'qvalue': rng.random(n_patients * n['tcia_cell_types']) / 10,
+        'NES > 0': rng.normal(0, 1, n_patients * n['tcia_cell_types']),
+    })
+    enriched = rng.random(len(pathways)) < .5
+    (pathways[enriched]
+     .rename(columns={'qvalue': 'qValue < 1%Enriched'})
+     .to_csv(path('pathways_enrichment.tsv'), sep='\t', index=False))
+    (pathways[~enriched]
+     .rename(columns={'qvalue': 'qValue < 1%Depleted'})
+     .to_csv(path('pathways_depletion.tsv'), sep='\t', index=False))
+
+    # GTEx samples, gene and transcript TPM, and median gene TPM
+    gtex_samples = [f'GTEX-{i:05d}-0001-SM-0000'
+                    for i in range(n['gtex_samples'])]
+    pd.DataFrame({
+        'SAMPID': gtex_samples,
+        'SMTS': 'Tissue',
+        'SMTSD': rng.choice(tissue['gtex_id'], len(gtex_samples)),
+    }).to_csv(path('gtex_sample_attributes.txt'), sep='\t', index=False)
+    versioned = genes['ensembl_id'] + '.1'
+    tpm = pd.DataFrame(rng.lognormal(1, 2, (len(gene_id), len(gtex_samples))),
+                       columns=gtex_samples)
+    tpm.insert(0, 'Name', versioned)
+    tpm.insert(1, 'Description', genes['Symbol'])
+    _write_gct(path('gtex_gene_tpm.gct'), tpm)
+    median = pd.DataFrame(rng.lognormal(1, 2, (len(gene_id), len(tissue))),
+                          columns=tissue['gtex_id'])
+    median.insert(0, 'gene_id', versioned)
+    median.insert(1, 'Description', genes['Symbol'])
+    _write_gct(path('gtex_gene_median_tpm.gct'), median)
+    transcripts = pd.DataFrame(
+        rng.lognormal(1, 2, (len(isoforms), len(gtex_samples))),
+        columns=gtex_samples)
+    transcripts.insert(0, 'transcript_id', isoforms)
+    transcripts.insert(1, 'gene_id', versioned.to_numpy().repeat(
+        n['isoforms_per_gene']))
+    transcripts.to_csv(path('gtex_transcript_tpm.txt'), sep='\t',
+                       index=False, float_format='%.3f')
+    paths['gtex_median_isoform'] = op.join(out_dir,
+                                           'gtex_median_isoform.csv')
+
+    # HPA protein levels by cell type and RNA by tissue
+    protein = cell_type.merge(genes, how='cross')
+    pd.DataFrame({
+        'Gene': protein['ensembl_id'],
+        'Gene name': protein['Symbol'],
+        'Tissue': protein['hpa_tissue_id'],
+        'Cell type': protein['cell_type'],
+        'Level': rng.choice(['High', 'Medium', 'Low', 'Not detected'],
+                            len(protein)),
+        'Reliability': rng.choice(['Approved', 'Supported', 'Uncertain'],
+                                  len(protein)),
+    }).to_csv(path('normal_tissue.tsv'), sep='\t', index=False)
+    rna = tissue.merge(genes, how='cross')
+    pd.DataFrame({
+        'Gene': rna['ensembl_id'],
+        'Gene name': rna['Symbol'],
+        'Sample': rna['hpa_id'],
+        'Value': rng.lognormal(1, 2, len(rna)).round(1),
+        'Unit': 'TPM',
+    }).to_csv(path('rna_tissue.tsv'), sep='\t', index=False)
+    return paths
+
+
+def loaders(paths):
+    '''Loader calls on a synthetic reference, in load order
+
+    Dimension loaders come first: later loaders resolve against them.
+    '''
+    isoform_dir = op.join(op.dirname(paths['genes.hs.csv']),
+                          'isoforms.parquet')
+    return {
+        'database.load_genes': lambda: db.load_genes(
+            paths['genes.hs.csv'], paths['gene_history.hs.tsv']),
+        'database.load_isoforms': lambda: db.load_isoforms(
+            paths['unc_knownToLocus.txt'], paths['gencode.metadata.HGNC.txt']),
+        'database.load_tissues': lambda: db.load_tissues(paths['tissue.csv']),
+        'database.load_cell_types': lambda: db.load_cell_types(
+            paths['cell_type.csv']),
+        'tcga.load_tcga_sample_meta': lambda: tcga.load_tcga_sample_meta(
+            paths['cohort.csv'], paths['patient.csv'], paths['sample.csv']),
+        'tcga.load_tcga_profile expression': lambda: sum(
+            tcga.load_tcga_profile('expression', fpath, cohort, env='test')
+            for cohort, fpath in paths['expression'].items()),
+        'tcga.load_tcga_profile copy number': lambda: sum(
+            tcga.load_tcga_profile('copy number', fpath, cohort, env='test')
+            for cohort, fpath in paths['copy number'].items()),
+        'tcga.parse_tcga_isoform_cohorts': lambda: sum(
+            tcga.parse_tcga_isoform_cohorts(
+                paths['isoforms'], isoform_dir, workers=2).values()),
+        'tcga.load_tcga_isoforms': lambda: sum(
+            tcga.load_tcga_isoforms(cohort, isoform_dir, env='test')
+            for cohort in paths['isoforms']),
+        'tcga.load_tcga_clinical': lambda: sum(
+            tcga.load_tcga_clinical(fpath)
+            for fpath in paths['clinical'].values()),
+        'tcga.load_tcga_mutation': lambda: tcga.load_tcga_mutation(
+            paths['mc3.maf']),
+        'tcga.load_immune_landscape': lambda: tcga.load_immune_landscape(
+            paths['immune_landscape.csv']),
+        'tcga.load_tcia_patient': lambda: tcga.load_tcia_patient(
+            paths['patientsAll.tsv']),
+        'tcga.load_tcia_pathways': lambda: tcga.load_tcia_pathways(
+            paths['pathways_enrichment.tsv'], paths['pathways_depletion.tsv']),
+        'gtex.load_gtex_median_tpm': lambda: gtex.load_gtex_median_tpm(
+            paths['gtex_gene_median_tpm.gct'], env='test'),
+        'gtex.summarize_gtex_isoform': lambda: gtex.summarize_gtex_isoform(
+            paths['gtex_transcript_tpm.txt'],
+            paths['gtex_sample_attributes.txt'],
+            paths['gtex_median_isoform']),
+        'gtex.load_gtex_isoform': lambda: gtex.load_gtex_isoform(
+            paths['gtex_median_isoform']),
+        'gtex.build_gtex_tpm_store': lambda: gtex.build_gtex_tpm_store(
+            paths['gtex_gene_tpm.gct'], paths['gtex_sample_attributes.txt'],
+            op.join(op.dirname(paths['genes.hs.csv']), 'gtex_tpm_store')),
+        'hpa.load_hpa_protein': lambda: hpa.load_hpa_protein(
+            paths['normal_tissue.tsv'], env='test',
+            cell_type_fpath=paths['cell_type.csv']),
+        'hpa.load_hpa_expression': lambda: hpa.load_hpa_expression(
+            paths['rna_tissue.tsv'], env='test',
+            tissue_fpath=paths['tissue.csv']),
+    }
+
+
+@contextmanager
+def throwaway_database(uri=cfg['DATABASE_URI']):
+    '''URL of a new, empty database on the server of uri, dropped on exit'''
+    url = make_url(uri)
+    name = f'ob_genomics_benchmark_{uuid.uuid4().hex[:8]}'
+    admin = create_engine(url.set(database='postgres'),
+                          isolation_level='AUTOCOMMIT')
+    admin.execute(f'CREATE DATABASE {name}')
+    try:
+        yield url.set(database=name)
+    finally:
+        db.engine.dispose()
+        admin.execute(f'DROP DATABASE IF EXISTS {name}')
+        admin.dispose()
+
+
+def _measure(name, load, conn):
+    '''Run one loader in this (forked) process and send back its metrics'''
+    try:
+        metrics.start_task(name)
+        load()
+        conn.send(metrics.finish_task())
+    except Exception as e:
+        metrics.finish_task('failed')
+        conn.send({'error': f'{type(e).__name__}: {e}'})
+    finally:
+        conn.close()
+
+
+def measure(name, load):
+    '''Metrics of a loader run in a forked process of its own
+
+    Forking gives each loader a fresh peak RSS and resolver cache, so
+    loaders are measured alone and cold, as build tasks with --workers run.
+    '''
+    ctx = multiprocessing.get_context('fork')
+    recv, send = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_measure, args=(name, load, send))
+    process.start()
+    send.close()
+    try:
+        row = recv.recv()
+    except EOFError:
+        row = {'error': f'Loader process exited with {process.exitcode}'}
+    process.join()
+    return row
+
+
+def _result(name, row):
+    if 'error' in row:
+        return {'loader': name, **row}
+    # Loaders that only write files are rated on the rows they read
+    rows = row['rows_written'] or row['rows_read']
+    return {
+        'loader': name,
+        'rows': rows,
+        'seconds': round(row['wall_seconds'], 3),
+        'rows_per_sec': round(rows / row['wall_seconds'], 1),
+        'peak_rss_mb': round(row['peak_rss'] / 2**20, 1),
+        **{f'{phase}_seconds': round(row[f'{phase}_seconds'], 3)
+           for phase in ['parse', 'transform', 'copy']},
+        **{name: row[name] for name in metrics.COUNTERS},
+    }
+
+
+def run(scale=1., database_uri=cfg['DATABASE_URI'], work_dir=None,
+        seed=0):
+    '''Benchmark every loader on a synthetic reference at scale
+
+    Inputs are written to work_dir, or a temporary folder removed
+    afterwards, and parsed without the SCRATCH cache. Returns the results,
+    as saved by save().
+    '''
+    temporary = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='benchmark-',
+                                            dir=cfg['SCRATCH'])
+    cache_dir = cache.CACHE_DIR
+    started = datetime.now(timezone.utc)
+    try:
+        start = time.perf_counter()
+        paths = generate(op.join(work_dir, 'reference'), scale, seed)
+        print(f'Generated synthetic reference in '
+              f'{time.perf_counter() - start:.1f}s')
+        cache.CACHE_DIR = op.join(work_dir, 'cache')
+
+        with throwaway_database(database_uri) as url:
+            db.use_database(url, paths['gene_history.hs.tsv'])
+            db.create()
+            server = db.engine.execute('SHOW server_version').scalar()
+            results = []
+            for name, load in loaders(paths).items():
+                result = _result(name, measure(name, load))
+                print(_format(result))
+                results.append(result)
+    finally:
+        cache.CACHE_DIR = cache_dir
+        db.use_database(cfg['DATABASE_URI'])
+        if temporary:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'started': started.isoformat(),
+        'scale': scale,
+        'sizes': sizes(scale),
+        'seed': seed,
+        'environment': {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'postgres': server,
+            'cpus': os.cpu_count(),
+            'copy_workers': db.COPY_WORKERS,
+        },
+        'loaders': results,
+    }
+
+
+def _format(result):
+    if 'error' in result:
+        return f'{result["loader"]:40s} failed: {result["error"]}'
+    return (f'{result["loader"]:40s} {result["rows"]:>10,d} rows '
+            f'{result["seconds"]:8.2f}s {result["rows_per_sec"]:>12,.0f} '
+            f'rows/s {result["peak_rss_mb"]:8.1f} MiB')
+
+
+def save(results, fpath=None):
+    '''Write results as JSON, by default to BENCHMARK_DIR by start time'''
+    if fpath is None:
+        stamp = datetime.fromisoformat(results['started'])
+        fpath = op.join(BENCHMARK_DIR,
+                        f'benchmark-{stamp:%Y%m%d-%H%M%S}.json')
+    os.makedirs(op.dirname(op.abspath(fpath)), exist_ok=True)
+    with open(fpath, 'w') as f:
+        json.dump(results, f, indent=2)
+    return fpath
+
+
+def load(fpath):
+    with open(fpath) as f:
+        return json.load(f)
+
+
+def compare(baseline, current):
+    '''Rows per second and peak memory of two runs, by loader
+
+    Ratios are current over baseline: a speedup above 1 is faster, a
+    memory ratio above 1 uses more memory. Runs at different scales are
+    compared as they are.
+    '''
+    def table(results):
+        return (pd.DataFrame([r for r in results['loaders']
+                              if 'error' not in r])
+                .set_index('loader')[['rows_per_sec', 'peak_rss_mb']])
+
+    baseline, current = table(baseline), table(current)
+    df = baseline.join(current, how='outer', lsuffix='_baseline',
+                       rsuffix='_current')
+    df = df.reindex(current.index.union(baseline.index, sort=False))
+    df['speedup'] = df['rows_per_sec_current'] / df['rows_per_sec_baseline']
+    df['memory_ratio'] = df['peak_rss_mb_current'] / df['peak_rss_mb_baseline']
+    return df
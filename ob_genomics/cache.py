@@ -0,0 +1,229 @@
+'''Parsed reference files, cached as Parquet in SCRATCH
+
+cache.read_csv parses a file once with pd.read_csv and keeps the typed
+result. Later reads of the same content with the same arguments load the
+Parquet copy instead, whether the file is local or on S3. Files on S3
+are parsed from their local copy (see fetch).
+'''
+from collections import defaultdict
+from datetime import datetime, timezone
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import shutil
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ob_genomics.config import cfg
+from ob_genomics import fetch
+from ob_genomics import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = op.join(cfg['SCRATCH'], 'cache')
+CACHE_SIZE_GB = cfg['CACHE_SIZE_GB']
+# Bump when the way results are parsed or stored changes
+PARSER_VERSION = 1
+
+
+def _hash_file(fpath):
+    digest = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def content_hash(fpath):
+    '''Hash of a file's content: the ETag on S3, else SHA-256
+
+    Local hashes are remembered by path, size and modification time, so
+    unchanged files are only read once.
+    '''
+    if fpath.startswith('s3://'):
+        return fetch.head(fpath)['ETag'].strip('"')
+
+    stat = os.stat(fpath)
+    stamp = [op.abspath(fpath), stat.st_size, stat.st_mtime_ns]
+    name = hashlib.sha1(stamp[0].encode()).hexdigest()
+    memo = op.join(CACHE_DIR, 'hashes', f'{name}.json')
+    if op.exists(memo):
+        with open(memo) as f:
+            saved = json.load(f)
+        if saved['stamp'] == stamp:
+            return saved['hash']
+
+    digest = _hash_file(fpath)
+    os.makedirs(op.dirname(memo), exist_ok=True)
+    tmp = f'{memo}.{uuid.uuid4().hex}'
+    with open(tmp, 'w') as f:
+        json.dump({'stamp': stamp, 'hash': digest}, f)
+    os.replace(tmp, memo)
+    return digest
+
+
+def file_info(fpath):
+    '''Size, modification time (UTC datetime) and content hash of a file'''
+    if fpath.startswith('s3://'):
+        head = fetch.head(fpath)
+        return (head['ContentLength'], head['LastModified'],
+                head['ETag'].strip('"'))
+    stat = os.stat(fpath)
+    mtime = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+    return stat.st_size, mtime, content_hash(fpath)
+
+
+def _describe(value):
+    '''JSON-able form of a read_csv argument, stable across runs'''
+    if isinstance(value, defaultdict):
+        return {'default': _describe(value.default_factory()),
+                **{str(k): _describe(v) for k, v in value.items()}}
+    if isinstance(value, dict):
+        return {str(k): _describe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_describe(v) for v in value]
+    if isinstance(value, type):
+        return value.__name__
+    return value if isinstance(value, (str, int, float, bool)) or \
+        value is None else str(value)
+
+
+def cache_key(fpath, kwargs):
+    key = json.dumps({
+        'content': content_hash(fpath),
+        'parser': PARSER_VERSION,
+        'pandas': pd.__version__,
+        'kwargs': _describe(kwargs),
+    }, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _entries():
+    '''Cache entries (Parquet files or chunk folders) with size and mtime'''
+    if not op.isdir(CACHE_DIR):
+        return []
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = op.join(CACHE_DIR, name)
+        if name == 'hashes' or '.tmp' in name:
+            continue
+        if op.isdir(path):
+            size = sum(op.getsize(op.join(path, part))
+                       for part in os.listdir(path))
+        else:
+            size = op.getsize(path)
+        entries.append((op.getmtime(path), size, path))
+    return entries
+
+
+def evict(size_gb=CACHE_SIZE_GB):
+    '''Remove least recently used entries until the cache fits in size_gb'''
+    entries = sorted(_entries())
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= size_gb * 2**30:
+            break
+        if op.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        total -= size
+
+
+def _write(df, path):
+    pq.write_table(pa.Table.from_pandas(df), path)
+
+
+def _read_chunks(path):
+    parts = sorted(os.listdir(path), key=lambda name: int(name.split('.')[0]))
+    for part in parts:
+        yield pd.read_parquet(op.join(path, part))
+
+
+def _parse_chunks(fpath, path, kwargs):
+    '''Yield chunks from read_csv, saving each as one part of an entry'''
+    tmp = f'{path}.tmp{uuid.uuid4().hex}'
+    os.makedirs(tmp)
+    caching, complete = True, False
+    try:
+        chunks = pd.read_csv(fetch.local_path(fpath), **kwargs)
+        for i, chunk in enumerate(chunks):
+            if caching:
+                try:
+                    _write(chunk, op.join(tmp, f'{i}.parquet'))
+                except (pa.ArrowException, ValueError) as e:
+                    logger.info(f'Not caching {fpath}: {e}')
+                    caching = False
+            yield chunk
+        complete = caching
+    finally:
+        if complete:
+            os.replace(tmp, path)
+            evict()
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _counted(chunks):
+    '''Chunks timed as parsing and counted as rows read, for metrics'''
+    chunks = iter(chunks)
+    while True:
+        with metrics.phase('parse'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        metrics.count(rows_read=len(chunk))
+        yield chunk
+
+
+def read_csv(fpath, **kwargs):
+    '''pd.read_csv, served from the Parquet cache when possible
+
+    Results are keyed by the file's content hash, PARSER_VERSION, the
+    pandas version and the arguments. With chunksize, chunks are cached
+    as they are read and served in the same sizes. File-like inputs and
+    nrows reads are passed straight to pandas.
+    '''
+    if kwargs.get('chunksize'):
+        with metrics.phase('parse'):
+            chunks = _read_csv(fpath, **kwargs)
+        return _counted(chunks)
+
+    with metrics.phase('parse'):
+        df = _read_csv(fpath, **kwargs)
+    metrics.count(rows_read=len(df))
+    return df
+
+
+def _read_csv(fpath, **kwargs):
+    if not isinstance(fpath, str) or 'nrows' in kwargs:
+        return pd.read_csv(fetch.local_path(fpath), **kwargs)
+
+    path = op.join(CACHE_DIR, cache_key(fpath, kwargs))
+    if op.exists(path):
+        os.utime(path)
+        if kwargs.get('chunksize'):
+            return _read_chunks(path)
+        return pd.read_parquet(path)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if kwargs.get('chunksize'):
+        return _parse_chunks(fpath, path, kwargs)
+
+    df = pd.read_csv(fetch.local_path(fpath), **kwargs)
+    tmp = f'{path}.tmp{uuid.uuid4().hex}'
+    try:
+        _write(df, tmp)
+        os.replace(tmp, path)
+    except (pa.ArrowException, ValueError) as e:
+        logger.info(f'Not caching {fpath}: {e}')
+        if op.exists(tmp):
+            os.remove(tmp)
+        return df
+    evict()
+    return df
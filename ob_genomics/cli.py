@@ -1,8 +1,13 @@
+import os
+
 import click
 
 from ob_genomics.config import cfg
+from ob_genomics import benchmark as bench
 from ob_genomics import pipeline
 from ob_genomics import database
+from ob_genomics import metrics
+from ob_genomics import profiling
 from ob_genomics import tcga
 
 REFERENCE = cfg['REFERENCE']
@@ -38,8 +43,76 @@ def init():
 
 
 @click.command()
-def build():
-    pipeline.build()
+@click.option('--bulk-load', is_flag=True,
+              help='Drop keys and indexes of the large sample tables during '
+                   'the build and rebuild them once at the end')
+@click.option('--workers', type=int, default=1,
+              help='Load tasks run in parallel, each in its own process')
+@click.option('--incremental', is_flag=True,
+              help='Reload tasks whose input files changed since they were '
+                   'loaded, replacing only their rows')
+@click.option('--profile', type=click.Choice(profiling.MODES),
+              is_flag=False, flag_value='cpu', default=None,
+              help='Profile each task with cProfile (cpu, the default) or '
+                   'tracemalloc (mem), writing reports to SCRATCH')
+def build(bulk_load, workers, incremental, profile):
+    pipeline.build(bulk_load=bulk_load, workers=workers,
+                   incremental=incremental, profile=profile)
+
+
+@click.command('parse-isoforms')
+@click.option('--memory-gb', type=float, default=cfg['PARSE_MEMORY_GB'],
+              help='Memory budget; limits how many cohorts are parsed at once')
+@click.option('--workers', type=int, default=os.cpu_count(),
+              help='Processes parsing cohorts in parallel')
+def parse_isoforms(memory_gb, workers):
+    pipeline.parse_isoforms(memory_gb=memory_gb, workers=workers)
+
+
+@click.command()
+@click.option('--builds', type=int, default=10,
+              help='Number of recent builds to show')
+@click.option('--threshold', type=float, default=1.5,
+              help='Flag tasks of the latest build slower or larger than '
+                   'this many times their median')
+def stats(builds, threshold):
+    history = metrics.task_history(database.engine, builds)
+    if history.empty:
+        print('No task metrics recorded yet')
+        return
+
+    print('Wall time (s) by task and build:')
+    trends = history.pivot_table(index='task_id', columns='build_started',
+                                 values='wall_seconds')
+    trends.columns = trends.columns.strftime('%Y-%m-%d %H:%M')
+    print(trends.round(1).to_string())
+
+    flagged = metrics.regressions(history, threshold)
+    if flagged.empty:
+        print('No regressions in the latest build')
+        return
+    print(f'Regressions in the latest build (> {threshold}x median):')
+    for row in flagged.itertuples(index=False):
+        print(f'  {row.task_id}: {row.metric} {row.latest:.4g} '
+              f'vs median {row.median:.4g} ({row.ratio:.1f}x)')
+
+
+@click.command()
+@click.option('--scale', type=float, default=1.,
+              help='Size of the synthetic reference, relative to '
+                   'benchmark.SIZES')
+@click.option('--out', type=click.Path(dir_okay=False), default=None,
+              help='JSON results file, by default in SCRATCH/benchmark')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False),
+              default=None, help='Earlier results to compare against')
+@click.option('--database-uri', default=cfg['DATABASE_URI'],
+              help='Postgres server to create the throwaway database on')
+def benchmark(scale, out, compare, database_uri):
+    results = bench.run(scale=scale, database_uri=database_uri)
+    print(f'Results written to {bench.save(results, out)}')
+    if compare:
+        ratios = bench.compare(bench.load(compare), results)
+        print(ratios[['speedup', 'memory_ratio']].round(2).to_string())
 
 
 @click.command()
@@ -49,4 +122,7 @@ def test():
 
 cli.add_command(init)
 cli.add_command(build)
+cli.add_command(parse_isoforms)
+cli.add_command(stats)
+cli.add_command(benchmark)
 cli.add_command(test)
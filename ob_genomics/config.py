@@ -19,6 +19,42 @@ cfg['SCRATCH'] = SCRATCH
 # Add back the environment
 cfg['ENV'] = ENV
 
+# Loading options
+cfg.setdefault('COPY_CHUNKSIZE', 100000)  # rows encoded per COPY chunk
+cfg.setdefault('COPY_WORKERS', 4)  # connections used by parallel COPY
+cfg.setdefault('MATRIX_BLOCK_SIZE', 50)  # matrix columns per tall COPY block
+cfg.setdefault('PARSE_MEMORY_GB', 16)  # memory budget of parallel matrix parsing
+cfg.setdefault('CACHE_SIZE_GB', 20)  # parsed reference cache in SCRATCH
+cfg.setdefault('FETCH_SIZE_GB', 100)  # local copies of S3 reference files
+cfg.setdefault('FETCH_WORKERS', 8)  # parallel ranged GETs per download
+cfg.setdefault('FETCH_PART_MB', 64)  # bytes per ranged GET of single-part uploads
+cfg.setdefault('PREFETCH_COHORTS', 1)  # next cohorts fetched while one loads
+cfg.setdefault('S3_ENDPOINT_URL', None)  # S3-compatible server, e.g. moto
+cfg.setdefault('BULK_LOAD_SETTINGS', {  # session settings for `build --bulk-load`
+    'synchronous_commit': 'off',
+    'maintenance_work_mem': '1GB',
+    'max_parallel_maintenance_workers': 4,
+})
+
+# Load tasks writing to a table that may run at once with `build --workers`.
+# Tables not listed take one task at a time.
+cfg['TABLE_CONCURRENCY'] = {
+    'sample_gene_value': 4,  # one partition per task
+    'sample_isoform_value': 2,
+    **cfg.get('TABLE_CONCURRENCY', {}),
+}
+
+# Storage of numeric EAV values by table: 'real' (float4) or 'double' (float8).
+# Changing this for an existing database needs a matching ALTER COLUMN.
+cfg['VALUE_PRECISION'] = {
+    'patient_value': 'double',
+    'sample_gene_value': 'real',
+    'sample_isoform_value': 'real',
+    'tissue_gene_value': 'double',
+    'tissue_isoform_value': 'double',
+    **cfg.get('VALUE_PRECISION', {}),
+}
+
 # Test subsets
 cfg['TEST_GENES'] = [3845, 7157, 4609, 2597]
 cfg['TEST_SYMBOLS'] = ['GAPDH', 'MYC', 'KRAS', 'TP53']
@@ -33,15 +69,14 @@ cfg['TCGA'] = {
 cfg['GTEX_TPM'] = op.join(
     REFERENCE, 'gtex',
     'GTEx_Analysis_2016-01-15_v7_RNASeQCv1.1.8_gene_tpm.gct')
+# Memory-mapped copy of GTEX_TPM written by gtex.build_gtex_tpm_store
+cfg['GTEX_TPM_STORE'] = op.join(SCRATCH, 'gtex', 'gene_tpm')
 cfg['GTEX_MEDIAN_TPM'] = op.join(
     REFERENCE, 'gtex',
     'GTEx_Analysis_2016-01-15_v7_RNASeQCv1.1.8_gene_median_tpm.gct')
 cfg['GTEX_ISOFORM'] = op.join(
     REFERENCE, 'gtex',
     'GTEx_Analysis_2016-01-15_v7_RSEMv1.2.22_transcript_tpm.txt')
-cfg['GTEX_ISOFORM_TALL'] = op.join(
-    REFERENCE, 'gtex',
-    'GTEx_Analysis_2016-01-15_v7_RSEMv1.2.22_transcript_tpm.tall.csv')
 cfg['GTEX_MEDIAN_ISOFORM'] = op.join(
     REFERENCE, 'gtex',
     'GTEx_Analysis_2016-01-15_v7_RSEMv1.2.22_transcript_median_tpm.txt')
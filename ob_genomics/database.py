@@ -1,12 +1,25 @@
-import io
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+import logging
+import os
 import os.path as op
+import uuid
 
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import (BigInteger, Column, Float, MetaData, Table, Text,
+                        create_engine, event)
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.orm import sessionmaker
 
 from ob_genomics.config import cfg
+from ob_genomics import cache
+from ob_genomics import ids
+from ob_genomics import metrics
 from ob_genomics import models
+from ob_genomics import pgbinary
 
 DATABASE_URI = cfg['DATABASE_URI']
 REFERENCE = cfg['REFERENCE']
@@ -17,12 +30,77 @@ GENCODE_TX_TO_GENE_FPATH = cfg['REFERENCE'] + '/gencode/gencode.v19.metadata.HGN
 TISSUE = op.join(REFERENCE, 'tissue', 'tissue.csv')
 CELL_TYPE = op.join(REFERENCE, 'tissue', 'cell_type.csv')
 TEST_GENES = [3845, 7157, 4609, 2597]
+COPY_CHUNKSIZE = cfg['COPY_CHUNKSIZE']
+COPY_WORKERS = cfg['COPY_WORKERS']
+MATRIX_BLOCK_SIZE = cfg['MATRIX_BLOCK_SIZE']
+# sample_gene_value is loaded by partition swap, which builds keys after COPY
+BULK_LOAD_TABLES = ['sample_gene_text_value_fact',
+                    'sample_isoform_value_fact']
+BULK_LOAD_SETTINGS = cfg['BULK_LOAD_SETTINGS']
+
+logger = logging.getLogger(__name__)
 
 engine = create_engine(DATABASE_URI)
+resolver = ids.IdResolver(engine, GENE_HISTORY)
+dictionaries = {name: ids.Dictionary(engine, name)
+                for name in ['data_type', 'unit']}
 Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 current_session = Session()
 
 
+def use_database(uri, gene_history_fpath=GENE_HISTORY):
+    '''Point the engine, resolver and dictionaries at another database'''
+    global engine, resolver, dictionaries, Session, current_session
+    engine.dispose()
+    engine = create_engine(uri)
+    resolver = ids.IdResolver(engine, gene_history_fpath)
+    dictionaries = {name: ids.Dictionary(engine, name)
+                    for name in ['data_type', 'unit']}
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    current_session = Session()
+
+
+# `build --workers` runs tasks in forked processes, which must open their
+# own connections instead of sharing the parent's pooled ones
+os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+
+
+MergeResult = namedtuple('MergeResult', ['staged', 'inserted', 'dropped'])
+
+
+class CopyError(Exception):
+    '''One or more shards of a parallel COPY failed'''
+
+    def __init__(self, table, errors):
+        self.table = table
+        self.errors = errors
+        details = '; '.join(f'shard {shard}: {err!r}'
+                            for shard, err in sorted(errors.items()))
+        super().__init__(f'{len(errors)} shard(s) failed loading {table}, '
+                         f'nothing was committed ({details})')
+
+
+class BulkLoadError(Exception):
+    '''Tables were left without constraints after a bulk load'''
+
+    def __init__(self, missing):
+        self.missing = missing
+        details = '; '.join(f'{table}: {", ".join(names)}'
+                            for table, names in sorted(missing.items()))
+        super().__init__(
+            f'Missing constraints and indexes after a bulk load ({details}). '
+            'Loads no longer deduplicate on these tables. Fix the rows '
+            'that broke them, then run build --bulk-load again to restore '
+            'them.')
+
+
+def add_source(source_id):
+    '''Add a data source if it isn't there yet'''
+    with engine.begin() as conn:
+        conn.execute('INSERT INTO source (source_id) VALUES (%s) '
+                     'ON CONFLICT (source_id) DO NOTHING', (source_id,))
+
+
 def safe_commit(session):
     try:
         session.commit()
@@ -37,28 +115,720 @@ def destroy():
 
 def create():
     models.base.metadata.create_all(bind=engine)
+    # Codes are assigned anew in a new schema
+    for dictionary in dictionaries.values():
+        dictionary.clear()
+
+
+class CopyStream:
+    '''Read-only file-like object over an iterator of encoded chunks.
+
+    cursor.copy_from pulls from this as Postgres consumes the data, so only
+    the chunk currently being sent is held in memory.
+    '''
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = b''
+        self._pos = 0
+        self.bytes_read = 0
+
+    def _next_chunk(self):
+        self._chunk = next(self._chunks, b'')
+        self._pos = 0
+        return len(self._chunk) > 0
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self._pos >= len(self._chunk) and not self._next_chunk():
+                break
+            end = len(self._chunk) if size < 0 else self._pos + size
+            piece = self._chunk[self._pos:end]
+            self._pos += len(piece)
+            pieces.append(piece)
+            if size > 0:
+                size -= len(piece)
+        data = b''.join(pieces)
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self._pos >= len(self._chunk) and not self._next_chunk():
+                break
+            end = self._chunk.find(b'\n', self._pos) + 1 or len(self._chunk)
+            if size > 0:
+                end = min(end, self._pos + size)
+            piece = self._chunk[self._pos:end]
+            self._pos += len(piece)
+            pieces.append(piece)
+            if size > 0:
+                size -= len(piece)
+            if piece.endswith(b'\n'):
+                break
+        data = b''.join(pieces)
+        self.bytes_read += len(data)
+        return data
+
+
+def iter_csv_chunks(df, chunksize=COPY_CHUNKSIZE):
+    '''Encode a DataFrame as tab-separated COPY text, chunksize rows at a time'''
+    for start in range(0, len(df), chunksize):
+        chunk = df.iloc[start:start + chunksize]
+        yield chunk.to_csv(sep='\t', header=False, index=False).encode()
+
+
+def copy(output, table, binary=False, columns=None, conn=None):
+    '''Use Postgres COPY command in production
+
+    With binary=True, output is a PGCOPY stream for a table defined in
+    models (see pgbinary). columns names the columns present in output, by
+    default all columns of the table in order. With conn, an open raw
+    connection, COPY runs in its transaction and is left to the caller to
+    commit.
+    '''
+    own = conn is None
+    if own:
+        conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        if binary:
+            copy_binary(cur, output, models.base.metadata.tables[table],
+                        columns)
+        else:
+            copy_stream(cur, output, table, columns=columns)
+        if own:
+            conn.commit()
+    finally:
+        if own:
+            conn.close()
+
+
+def copy_stream(cur, output, name, binary=False, columns=None):
+    '''COPY a text or PGCOPY stream into a table by name on an open cursor'''
+    if binary:
+        cols = f' ({", ".join(columns)})' if columns else ''
+        cur.copy_expert(f'COPY {name}{cols} FROM STDIN WITH (FORMAT binary)',
+                        output)
+    else:
+        cur.copy_from(output, name, columns=columns)
+
+
+def staging_columns(table, binary=False, columns=None):
+    '''Column definitions for a staging copy of a model table
+
+    For binary loads, arbitrary-precision Numeric columns are declared as
+    double precision so they can receive float8 values directly.
+    '''
+    cols = table.columns
+    if columns:
+        cols = [table.columns[name] for name in columns]
+    return ', '.join(
+        f'{col.name} double precision'
+        if binary and pgbinary.needs_cast(col.type)
+        else f'{col.name} {col.type.compile(dialect=engine.dialect)}'
+        for col in cols)
+
+
+def copy_binary(cur, output, table, columns=None):
+    '''COPY a PGCOPY stream into a table on an open cursor
+
+    Arbitrary-precision Numeric columns are received as float8 in a
+    temporary table and cast by the server on insert.
+    '''
+    columns = columns or [col.name for col in table.columns]
+    if not any(pgbinary.needs_cast(table.columns[name].type)
+               for name in columns):
+        copy_stream(cur, output, table.name, binary=True, columns=columns)
+        return
+
+    cols = staging_columns(table, binary=True, columns=columns)
+    cur.execute(f'CREATE TEMP TABLE binary_stage ({cols}) ON COMMIT DROP')
+    copy_stream(cur, output, 'binary_stage', binary=True)
+    cur.execute(f'INSERT INTO {table.name} ({", ".join(columns)}) '
+                'SELECT * FROM binary_stage')
+
+
+def encode_df(df, table, chunksize=COPY_CHUNKSIZE, binary=False,
+              columns=None):
+    '''Chunked COPY encoding of a DataFrame for a table'''
+    if binary:
+        model = models.base.metadata.tables[table]
+        formats = pgbinary.table_formats(model)
+        if columns:
+            formats = [pgbinary.column_format(model.columns[name].type)
+                       for name in columns]
+        return pgbinary.iter_binary_chunks(df, formats, chunksize)
+    return iter_csv_chunks(df, chunksize)
+
+
+def encode_dictionaries(df, table):
+    '''Replace data_type and unit text columns with their dictionary codes
+
+    Only columns whose code column (e.g. data_type_id) is in the model table
+    are converted. They keep their position, so frames still line up with
+    the table's columns for binary COPY.
+    '''
+    model = models.base.metadata.tables[table]
+    for name, dictionary in dictionaries.items():
+        if name in df.columns and f'{name}_id' in model.columns:
+            df = (df.assign(**{name: dictionary.encode(df[name])})
+                  .rename(columns={name: f'{name}_id'}))
+    return df
+
+
+def copy_from_df(df, table, chunksize=COPY_CHUNKSIZE, binary=False,
+                 columns=None, conn=None):
+    '''Stream a DataFrame into a table in fixed-size chunks
+
+    Peak memory is bounded by one encoded chunk instead of the text of the
+    whole frame. binary=True sends typed values as PGCOPY instead of text;
+    the frame's columns must then match the model table's columns in order,
+    or the table columns given in columns, e.g. to leave out a generated
+    key. conn is as for copy(). Returns the number of rows copied.
+    '''
+    with metrics.step(f'copy_from_df {table}'):
+        df = encode_dictionaries(df, table)
+        stream = CopyStream(encode_df(df, table, chunksize, binary, columns))
+        with metrics.phase('copy'):
+            copy(stream, table, binary=binary, columns=columns, conn=conn)
+        metrics.count(rows_written=len(df), bytes_streamed=stream.bytes_read)
+    return len(df)
+
+
+def copy_from_csv(fpath, table):
+    with open(fpath, 'r') as f:
+        copy(f, table)
 
 
-def copy(output, table):
-    '''Use Postgres COPY command in production'''
+def _copy_shard(name, make_stream, binary):
+    stream = make_stream()
     conn = engine.raw_connection()
-    cur = conn.cursor()
-    cur.copy_from(output, table)
-    conn.commit()
-    conn.close()
+    try:
+        copy_stream(conn.cursor(), stream, name, binary)
+        conn.commit()
+        metrics.count(bytes_streamed=getattr(stream, 'bytes_read', 0))
+    finally:
+        conn.close()
+        if hasattr(stream, 'close'):
+            stream.close()
+
+
+def parallel_copy(shards, table, workers=COPY_WORKERS, binary=False,
+                  into=None):
+    '''COPY shards concurrently over pooled connections, all or nothing
+
+    Each shard is a callable returning a readable COPY stream. Shards are
+    loaded into an unlogged staging table on their own connections, and the
+    rows are moved into the target table in a single INSERT only if every
+    shard succeeded. Otherwise raises CopyError with each shard's exception.
+
+    into names a private table with the model table's columns to load
+    instead of the model table itself. Shards are copied straight into it
+    unless values need a server-side cast, since the caller publishes it.
+    '''
+    model = models.base.metadata.tables[table]
+    target = into or table
+    if into is not None and not (binary and any(
+            pgbinary.needs_cast(col.type) for col in model.columns)):
+        stage = None
+    else:
+        stage = f'stage_{table}_{uuid.uuid4().hex[:8]}'
+        engine.execute(f'CREATE UNLOGGED TABLE {stage} '
+                       f'({staging_columns(model, binary)})')
+    try:
+        with metrics.phase('copy'):
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_copy_shard, stage or target, shard,
+                                       binary)
+                           for shard in shards]
+            errors = {i: f.exception() for i, f in enumerate(futures)
+                      if f.exception() is not None}
+            if errors:
+                raise CopyError(target, errors)
+
+            if stage is not None:
+                with engine.begin() as conn:
+                    conn.execute(f'INSERT INTO {target} '
+                                 f'SELECT * FROM {stage}')
+    finally:
+        if stage is not None:
+            engine.execute(f'DROP TABLE {stage}')
 
 
-def copy_from_df(df, table):
-    output = io.StringIO()
-    df.to_csv(output, sep='\t', header=False, index=False)
-    output.seek(0)
-    output.getvalue()
-    copy(output, table)
+def encode_blocks(blocks, table, chunksize=COPY_CHUNKSIZE, binary=False):
+    '''One chunked COPY encoding of the frames returned by block callables
 
+    Each block is called only once the previous frame has been encoded.
+    '''
+    def encoded():
+        for block in blocks:
+            df = encode_dictionaries(block(), table)
+            metrics.count(rows_written=len(df))
+            yield df
 
-def copy_from_csv(fpath, table):
-    with open(fpath, 'r') as f:
-        copy(f, table)
+    frames = encoded()
+    if binary:
+        formats = pgbinary.table_formats(models.base.metadata.tables[table])
+        return pgbinary.iter_binary_frames(frames, formats, chunksize)
+    return (chunk for df in frames for chunk in iter_csv_chunks(df, chunksize))
+
+
+def _copy_block(block, table, into, chunksize, binary, conn):
+    '''COPY one block on an open raw connection, returning its rows'''
+    df = encode_dictionaries(block(), table)
+    stream = CopyStream(encode_df(df, table, chunksize, binary))
+    cur = conn.cursor()
+    if binary and into is None:
+        copy_binary(cur, stream, models.base.metadata.tables[table])
+    else:
+        copy_stream(cur, stream, into or table, binary)
+    metrics.count(rows_written=len(df), bytes_streamed=stream.bytes_read)
+    return len(df)
+
+
+def parallel_copy_from_blocks(blocks, table, workers=COPY_WORKERS,
+                              chunksize=COPY_CHUNKSIZE, binary=False,
+                              into=None, checkpoint=None):
+    '''COPY DataFrames built block by block, spread over workers
+
+    blocks are callables returning a DataFrame for the table, as from
+    matrix_blocks. Each worker builds and sends its blocks one at a time,
+    so at most one block per worker is held in memory.
+
+    With a Checkpoint, the load is resumable instead of all or nothing:
+    each block is a numbered chunk, committed on its own straight into the
+    target, and blocks committed by an earlier attempt are skipped.
+    '''
+    if checkpoint is not None:
+        def load(chunk):
+            return checkpoint.run(chunk, partial(
+                _copy_block, blocks[chunk], table, into, chunksize, binary))
+
+        with metrics.step(f'parallel_copy_from_blocks {table}'), \
+                metrics.phase('copy'):
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                return sum(pool.map(load, range(len(blocks))))
+
+    shards = [
+        partial(CopyStream, encode_blocks(blocks[i::workers], table,
+                                          chunksize, binary))
+        for i in range(min(workers, len(blocks)))]
+    with metrics.step(f'parallel_copy_from_blocks {table}'):
+        parallel_copy(shards, table, workers, binary, into)
+
+
+def matrix_blocks(mat, column_key, row_key, constants=None,
+                  block_size=MATRIX_BLOCK_SIZE):
+    '''Tall DataFrame blocks of a wide matrix, block_size columns at a time
+
+    Each block is a callable building the rows (column_key, row_key,
+    *constants, value) for its columns from the matrix labels and values,
+    without missing values. Only blocks being sent exist in tall form.
+    '''
+    values = mat.to_numpy()
+    rows = mat.index.to_numpy()
+
+    def block(start):
+        cols = mat.columns[start:start + block_size].to_numpy()
+        df = pd.DataFrame({column_key: np.repeat(cols, len(rows)),
+                           row_key: np.tile(rows, len(cols))})
+        for name, value in (constants or {}).items():
+            df[name] = value
+        df['value'] = values[:, start:start + block_size].ravel(order='F')
+        return df.dropna(subset=['value'])
+
+    return [partial(block, start)
+            for start in range(0, mat.shape[1], block_size)]
+
+
+def _stage_table(df, name):
+    '''SQLAlchemy table with columns typed from a DataFrame's dtypes'''
+    cols = []
+    for col, dtype in df.dtypes.items():
+        if pd.api.types.is_integer_dtype(dtype):
+            sa_type = BigInteger
+        elif pd.api.types.is_float_dtype(dtype):
+            sa_type = Float(precision=53)
+        else:
+            sa_type = Text
+        cols.append(Column(col, sa_type))
+    return Table(name, MetaData(), *cols)
+
+
+def merge(df, table, constants=None, on_conflict=None, temp=True,
+          conn=None):
+    '''Stage a DataFrame and insert it into a table
+
+    Rows are sent with binary COPY to a staging table with a unique name:
+    session-scoped TEMP by default, or UNLOGGED with temp=False. They are
+    then inserted into the target with one INSERT ... SELECT. Target columns
+    are filled from constants, then staged columns of the same name. Rows
+    are deduplicated on the target primary key.
+
+    data_type and unit, as columns or constants, are stored as their
+    dictionary codes.
+
+    on_conflict is None (raise on duplicates), 'nothing' or 'update'.
+    conn is as for copy(). Returns a MergeResult with staged, inserted and
+    dropped row counts.
+    '''
+    model = models.base.metadata.tables[table]
+    df = encode_dictionaries(df, table)
+    constants = dict(constants or {})
+    for name, dictionary in dictionaries.items():
+        if name in constants and f'{name}_id' in model.columns:
+            code = dictionary.encode([constants.pop(name)])[0]
+            constants[f'{name}_id'] = int(code)
+
+    columns, exprs = [], []
+    for col in model.columns:
+        if col.name in constants:
+            expr = f'%({col.name})s'
+        elif col.name in df.columns:
+            expr = f's.{col.name}'
+        else:
+            continue
+        columns.append(col.name)
+        exprs.append(expr)
+
+    # Constants can't appear in DISTINCT ON / ORDER BY and don't vary anyway
+    varying = [expr for col, expr in zip(columns, exprs)
+               if col not in constants]
+    pkey = [exprs[columns.index(col.name)] for col in model.primary_key
+            if exprs[columns.index(col.name)] in varying]
+    order = pkey + [expr for expr in varying if expr not in pkey]
+
+    if on_conflict is None:
+        conflict = ''
+    elif on_conflict == 'nothing':
+        conflict = 'ON CONFLICT DO NOTHING'
+    elif on_conflict == 'update':
+        keys = [col.name for col in model.primary_key]
+        updates = ', '.join(f'{col} = EXCLUDED.{col}'
+                            for col in columns if col not in keys)
+        conflict = f'ON CONFLICT ({", ".join(keys)}) DO UPDATE SET {updates}'
+    else:
+        raise ValueError(f'Unknown on_conflict policy: {on_conflict}')
+
+    stage = _stage_table(df, f'stage_{table}_{uuid.uuid4().hex[:8]}')
+    formats = pgbinary.table_formats(stage)
+    with metrics.step(f'merge {table}'), metrics.phase('copy'):
+        own = conn is None
+        if own:
+            conn = engine.raw_connection()
+        try:
+            cur = conn.cursor()
+            if temp:
+                cur.execute(f'CREATE TEMP TABLE {stage.name} '
+                            f'({staging_columns(stage)}) ON COMMIT DROP')
+            else:
+                cur.execute(f'CREATE UNLOGGED TABLE {stage.name} '
+                            f'({staging_columns(stage)})')
+            stream = CopyStream(
+                pgbinary.iter_binary_chunks(df, formats, COPY_CHUNKSIZE))
+            copy_stream(cur, stream, stage.name, binary=True)
+
+            cur.execute(f'''
+                INSERT INTO {table} ({", ".join(columns)})
+                SELECT DISTINCT ON ({", ".join(pkey)}) {", ".join(exprs)}
+                FROM {stage.name} s
+                ORDER BY {", ".join(order)}
+                {conflict}
+            ''', constants)
+            result = MergeResult(staged=len(df), inserted=cur.rowcount,
+                                 dropped=len(df) - cur.rowcount)
+            metrics.count(rows_written=result.inserted,
+                          rows_dropped=result.dropped,
+                          bytes_streamed=stream.bytes_read)
+            if not temp:
+                cur.execute(f'DROP TABLE {stage.name}')
+            if own:
+                conn.commit()
+        except Exception:
+            if own:
+                conn.rollback()
+                if not temp:
+                    conn.cursor().execute(
+                        f'DROP TABLE IF EXISTS {stage.name}')
+                    conn.commit()
+            raise
+        finally:
+            if own:
+                conn.close()
+
+    logger.info(f'{table}: staged {result.staged}, '
+                f'inserted {result.inserted}, dropped {result.dropped}')
+    return result
+
+
+def delete_values(table, data_types=None, **columns):
+    '''Delete the rows of a table matching every given column
+
+    Column values are a scalar or a list of values. data_types are names,
+    matched through their dictionary codes. Used to clear the rows of an
+    input before reloading it. Returns the number of rows deleted.
+    '''
+    if data_types is not None:
+        codes = dictionaries['data_type'].encode(pd.Series(data_types).unique())
+        columns['data_type_id'] = codes
+    where, params = [], {}
+    for col, value in columns.items():
+        if np.ndim(value):
+            where.append(f'{col} = ANY(%({col})s)')
+            params[col] = pd.Series(value).tolist()
+        else:
+            where.append(f'{col} = %({col})s')
+            params[col] = value
+
+    with engine.begin() as conn:
+        deleted = conn.execute(
+            f'DELETE FROM {table} WHERE {" AND ".join(where)}',
+            params).rowcount
+    logger.info(f'{table}: deleted {deleted}')
+    return deleted
+
+
+class Checkpoint:
+    '''Numbered chunks of one load, each committed with its rows
+
+    run() commits a chunk's rows and its load_checkpoint row in a single
+    transaction, so the chunks recorded are exactly those whose rows are
+    in, and a load retried after a failure skips them. Checkpoints recorded
+    for other inputs are discarded when the load starts. Without an
+    update_id, chunks are committed but not recorded.
+    '''
+
+    def __init__(self, update_id=None, input_hash=None):
+        self.update_id = update_id
+        self.input_hash = input_hash
+        self.done = {}
+        # Whether an earlier attempt of the load committed chunks
+        self.resuming = False
+        self.discarded = False
+        if update_id is None:
+            return
+        with engine.begin() as conn:
+            self.discarded = bool(conn.execute(
+                'DELETE FROM load_checkpoint WHERE update_id = %s '
+                'AND input_hash IS DISTINCT FROM %s',
+                (update_id, input_hash)).rowcount)
+            self.done = dict(conn.execute(
+                'SELECT chunk, n_rows FROM load_checkpoint '
+                'WHERE update_id = %s', (update_id,)).fetchall())
+        self.resuming = bool(self.done)
+        if self.resuming:
+            logger.info(f'{update_id}: resuming after {len(self.done)} '
+                        'committed chunks')
+
+    def pending(self, chunk):
+        return chunk not in self.done
+
+    def restart(self):
+        '''Forget committed chunks, once their rows are gone'''
+        if self.update_id is not None:
+            engine.execute('DELETE FROM load_checkpoint WHERE update_id = %s',
+                           (self.update_id,))
+        self.done.clear()
+        self.resuming = False
+
+    def run(self, chunk, load):
+        '''Load a chunk unless committed before, returning its row count
+
+        load(conn) loads the chunk's rows on an open raw connection without
+        committing, e.g. with copy_from_df(..., conn=conn), and returns
+        their number.
+        '''
+        if chunk in self.done:
+            return self.done[chunk]
+        conn = engine.raw_connection()
+        try:
+            n_rows = int(load(conn))
+            if self.update_id is not None:
+                conn.cursor().execute(
+                    'INSERT INTO load_checkpoint '
+                    '(update_id, chunk, input_hash, n_rows) '
+                    'VALUES (%s, %s, %s, %s)',
+                    (self.update_id, chunk, self.input_hash, n_rows))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        self.done[chunk] = n_rows
+        return n_rows
+
+
+def load_sample_gene_partition(blocks, data_type, cohort_id,
+                               workers=COPY_WORKERS, checkpoint=None):
+    '''Replace one cohort of a sample_gene_value data type by partition swap
+
+    Rows are copied from DataFrame blocks (see parallel_copy_from_blocks)
+    into a standalone table, which gets its primary key once the data is
+    in. It then replaces the cohort's current partition, if any, and is
+    attached in a single transaction, so readers see either the old or the
+    new cohort data and re-loading never deletes rows.
+
+    With a Checkpoint, blocks are committed one by one and the standalone
+    table is kept after a failure, so a retry only copies the blocks
+    missing from it.
+    '''
+    table = models.SampleGeneValue.__table__
+    parent = models.sample_gene_partition(data_type)
+    partition = models.sample_gene_partition(data_type, cohort_id)
+    load = f'{partition}_load'
+    pkey = ', '.join(col.name for col in table.primary_key)
+    data_type_id = int(dictionaries['data_type'].encode([data_type])[0])
+
+    resume = (checkpoint is not None and checkpoint.resuming and
+              engine.execute('SELECT to_regclass(%s)', (load,)).scalar())
+    if not resume:
+        if checkpoint is not None:
+            checkpoint.restart()
+        engine.execute(f'DROP TABLE IF EXISTS {load}')
+        engine.execute(f'CREATE TABLE {load} '
+                       f'(LIKE {table.name} INCLUDING DEFAULTS)')
+    parallel_copy_from_blocks(blocks, table.name, workers, binary=True,
+                              into=load, checkpoint=checkpoint)
+    # A failed attempt may have added them already
+    engine.execute(f'ALTER TABLE {load} '
+                   f'DROP CONSTRAINT IF EXISTS {load}_pkey, '
+                   f'DROP CONSTRAINT IF EXISTS {load}_bounds')
+    engine.execute(f'ALTER TABLE {load} '
+                   f'ADD CONSTRAINT {load}_pkey PRIMARY KEY ({pkey})')
+    # Matches the partition bounds, so ATTACH doesn't need to scan the table
+    engine.execute(f'ALTER TABLE {load} ADD CONSTRAINT {load}_bounds '
+                   'CHECK (data_type_id = %s AND cohort_id = %s)',
+                   (data_type_id, cohort_id))
+
+    with engine.begin() as conn:
+        conn.execute(f'DROP TABLE IF EXISTS {partition}')
+        conn.execute(f'ALTER TABLE {load} RENAME TO {partition}')
+        conn.execute(f'ALTER INDEX {load}_pkey RENAME TO {partition}_pkey')
+        conn.execute(f'ALTER TABLE {partition} RENAME CONSTRAINT '
+                     f'{load}_bounds TO {partition}_bounds')
+        conn.execute(f'ALTER TABLE {parent} ATTACH PARTITION {partition} '
+                     'FOR VALUES IN (%s)', (cohort_id,))
+
+
+def _fkey_name(fk):
+    '''Constraint name, defaulting to the name Postgres generates'''
+    cols = '_'.join(col.name for col in fk.columns)
+    return fk.name or f'{fk.table.name}_{cols}_fkey'
+
+
+def _apply_settings(dbapi_conn, connection_record):
+    cur = dbapi_conn.cursor()
+    for name, value in BULK_LOAD_SETTINGS.items():
+        cur.execute(f'SET {name} = %s', (str(value),))
+    cur.close()
+    dbapi_conn.commit()
+
+
+def _restore_table(table):
+    '''Rebuild a table's indexes and constraints after a bulk load'''
+    pkey = f'{table.name}_pkey'
+    pkey_cols = ', '.join(col.name for col in table.primary_key)
+    with engine.begin() as conn:
+        conn.execute(f'CREATE UNIQUE INDEX {pkey} ON {table.name} '
+                     f'({pkey_cols})')
+        conn.execute(f'ALTER TABLE {table.name} ADD CONSTRAINT {pkey} '
+                     f'PRIMARY KEY USING INDEX {pkey}')
+        for idx in table.indexes:
+            conn.execute(CreateIndex(idx))
+        # Tables restored in parallel lock the referred tables in one order
+        fkeys = sorted(table.foreign_key_constraints,
+                       key=lambda fk: (fk.referred_table.name, _fkey_name(fk)))
+        for fk in fkeys:
+            cols = ', '.join(col.name for col in fk.columns)
+            ref_cols = ', '.join(el.column.name for el in fk.elements)
+            conn.execute(f'ALTER TABLE {table.name} '
+                         f'ADD CONSTRAINT {_fkey_name(fk)} FOREIGN KEY ({cols}) '
+                         f'REFERENCES {fk.referred_table.name} ({ref_cols}) '
+                         'NOT VALID')
+    with engine.begin() as conn:
+        for fk in fkeys:
+            conn.execute(f'ALTER TABLE {table.name} '
+                         f'VALIDATE CONSTRAINT {_fkey_name(fk)}')
+
+
+def missing_constraints(tables=BULK_LOAD_TABLES):
+    '''Primary keys, indexes and foreign keys of models missing by table
+
+    Only tables with something missing are returned, e.g. those left over
+    by a bulk load whose restore failed. Empty on databases other than
+    Postgres.
+    '''
+    if engine.dialect.name != 'postgresql':
+        return {}
+    existing = {name for name, in engine.execute(
+        'SELECT conname FROM pg_constraint UNION SELECT indexname '
+        'FROM pg_indexes WHERE schemaname = current_schema()')}
+    missing = {}
+    for name in tables:
+        table = models.base.metadata.tables[name]
+        names = ([f'{table.name}_pkey']
+                 + [idx.name for idx in table.indexes]
+                 + [_fkey_name(fk) for fk in table.foreign_key_constraints])
+        names = [name for name in names if name not in existing]
+        if names:
+            missing[table.name] = names
+    return missing
+
+
+@contextmanager
+def bulk_load(tables=BULK_LOAD_TABLES, workers=COPY_WORKERS):
+    '''Load large tables without maintaining their indexes and constraints
+
+    Primary keys, indexes and foreign keys of the given tables, as defined in
+    models, are dropped for the duration of the context, and connections
+    opened inside it use BULK_LOAD_SETTINGS. On exit the indexes are rebuilt
+    in parallel, and foreign keys are re-added NOT VALID and validated once.
+    If that fails, e.g. on duplicate keys, BulkLoadError lists what is still
+    missing. Does nothing on databases other than Postgres.
+    '''
+    if engine.dialect.name != 'postgresql':
+        yield
+        return
+
+    names = tables
+    tables = [models.base.metadata.tables[name] for name in tables]
+    with engine.begin() as conn:
+        for table in tables:
+            for fk in table.foreign_key_constraints:
+                conn.execute(f'ALTER TABLE {table.name} '
+                             f'DROP CONSTRAINT IF EXISTS {_fkey_name(fk)}')
+            conn.execute(f'ALTER TABLE {table.name} '
+                         f'DROP CONSTRAINT IF EXISTS {table.name}_pkey')
+            for idx in table.indexes:
+                conn.execute(f'DROP INDEX IF EXISTS {idx.name}')
+
+    # Only connections opened from here on pick up the session settings
+    engine.dispose()
+    event.listen(engine, 'connect', _apply_settings)
+    try:
+        yield
+    finally:
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {table.name: pool.submit(_restore_table, table)
+                           for table in tables}
+            errors = {name: f.exception() for name, f in futures.items()
+                      if f.exception() is not None}
+        finally:
+            event.remove(engine, 'connect', _apply_settings)
+            engine.dispose()
+        if errors:
+            for name, error in sorted(errors.items()):
+                logger.error(f'Restoring {name} after bulk load failed: '
+                             f'{error}')
+            missing = missing_constraints(names)
+            for name, constraints in sorted(missing.items()):
+                logger.error(f'{name} is missing {", ".join(constraints)}')
+            raise BulkLoadError(missing) from next(iter(errors.values()))
 
 
 def get_ensembl_gene(ref_str):
@@ -72,17 +842,10 @@ def get_ensembl_gene(ref_str):
 
 
 def load_genes(gene_info_fpath=GENE, gene_history_fpath=GENE_HISTORY):
-    gene_info = pd.read_csv(gene_info_fpath)
+    gene_info = cache.read_csv(gene_info_fpath)
     gene_info.columns = ['gene_id', 'ensembl_id', 'symbol']
 
-    gene_history = pd.read_csv(gene_history_fpath, sep="\t")
-    gene_history.columns = [
-        "taxid",
-        "new_gene_id",
-        "gene_id",
-        "symbol",
-        "discontinued_date",
-    ]
+    gene_history = ids.read_gene_history(gene_history_fpath)
     gene_history["ensembl_id"] = None
 
     df = pd.concat([
@@ -98,7 +861,7 @@ def load_isoforms(
         gencode_fpath=GENCODE_TX_TO_GENE_FPATH):
 
     # UNC
-    df = pd.read_csv(unc_fpath, sep='\t', header=None)
+    df = cache.read_csv(unc_fpath, sep='\t', header=None)
     df.columns = ['mapping', 'isoform_id']
 
     df['symbol'] = df['mapping'].map(
@@ -110,59 +873,49 @@ def load_isoforms(
     copy_from_df(df[['isoform_id', 'gene_id', 'source']], 'isoform')
 
     # GENCODE
-    gencode = pd.read_csv(gencode_fpath, sep='\t', header=None)
+    gencode = cache.read_csv(gencode_fpath, sep='\t', header=None)
     gencode.columns = ['isoform_id', 'symbol']
     gencode = gencode.drop_duplicates(subset='isoform_id')
 
-    conn = engine.connect()
-    conn.execute('''
-        CREATE TABLE tmp_gencode_isoform
-        (isoform_id varchar, symbol varchar)
-    ''')
-
-    try:
-        copy_from_df(gencode, 'tmp_gencode_isoform')
-
-        conn.execute('''
-            INSERT INTO isoform
-            (isoform_id, gene_id, source)
-            SELECT tmp.isoform_id, MIN(g.gene_id), 'GENCODE v19'
-            FROM tmp_gencode_isoform tmp
-            INNER JOIN gene g ON g.symbol = tmp.symbol
-            GROUP BY tmp.isoform_id
-        ''')
-    finally:
-        conn.execute('DROP TABLE tmp_gencode_isoform')
-        conn.close()
+    # Isoforms matching several genes by symbol get the lowest gene ID
+    gencode = resolver.resolve(gencode, {'symbol': 'symbol'},
+                               loader='GENCODE isoforms')
+    return merge(gencode, 'isoform', constants={'source': 'GENCODE v19'})
 
 
 def load_tissues(fpath=TISSUE):
-    tissue = pd.read_csv(fpath)
+    tissue = cache.read_csv(fpath)
     copy_from_df(tissue, 'tissue')
 
 
 def load_cell_types(fpath=CELL_TYPE):
     cell_type = (
-        pd.read_csv(fpath)
+        cache.read_csv(fpath)
         [['cell_type_id', 'tissue_id', 'cell_type']]
         .drop_duplicates(subset='cell_type_id')
     )
     copy_from_df(cell_type, 'cell_type')
 
 
-def load_sample_gene_values(fpath, data_type, cols, unit, env=cfg['ENV']):
-    df = pd.read_csv(fpath)
-    if 'data_type' not in df.columns:
-        df['data_type'] = data_type
-    if 'unit' not in df.columns:
-        df['unit'] = unit
-    df = df[cols]
-    df.columns = ['sample_id', 'gene_id', 'data_type', 'unit', 'value']
-    df = df.drop_duplicates(subset=['sample_id', 'gene_id', 'data_type'])
-
-    df = df[df['gene_id'] > 0]
-
-    if env == 'dev':
-        df = df[df['gene_id'].isin(TEST_GENES)]
-
-    copy_from_df(df, 'sample_gene_value')
+def load_sample_gene_matrix(mat, data_type, unit, cohort_id,
+                            workers=COPY_WORKERS, checkpoint=None):
+    '''Load a gene by sample matrix as one cohort of a data type
+
+    mat has Entrez gene IDs as index and sample IDs as columns. It is
+    resolved once by label and sent in blocks of sample columns, so the
+    tall table of the whole matrix is never built. With a Checkpoint, each
+    block of samples is a chunk (see load_sample_gene_partition). Returns
+    the number of values loaded.
+    '''
+    # Retired gene IDs map to their replacement, which may already be present
+    mat = resolver.resolve_matrix(mat, 'gene_id', 'sample_id',
+                                  loader=f'TCGA {data_type}')
+    constants = {
+        'data_type_id': int(dictionaries['data_type'].encode([data_type])[0]),
+        'cohort_id': cohort_id,
+        'unit_id': int(dictionaries['unit'].encode([unit])[0]),
+    }
+    blocks = matrix_blocks(mat, 'sample_key', 'gene_id', constants)
+    load_sample_gene_partition(blocks, data_type, cohort_id, workers,
+                               checkpoint)
+    return int(mat.count().sum())
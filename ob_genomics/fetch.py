@@ -0,0 +1,229 @@
+'''Local copies of S3 reference files, kept in SCRATCH
+
+With REFERENCE on S3, loaders read local_path(fpath) instead of the object.
+It is downloaded once into FETCH_DIR with parallel ranged GETs, checked
+against its ETag, and reused by later tasks and builds for as long as the
+ETag is unchanged. The least recently used copies are removed beyond
+FETCH_SIZE_GB. prefetch() downloads files in the background, such as the
+inputs of the next cohorts while one is loading.
+
+S3_ENDPOINT_URL points the client at an S3-compatible server instead of
+AWS, e.g. a local moto server.
+'''
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import os
+import os.path as op
+import re
+import threading
+import time
+import uuid
+
+from ob_genomics.config import cfg
+
+logger = logging.getLogger(__name__)
+
+FETCH_DIR = op.join(cfg['SCRATCH'], 'reference')
+FETCH_SIZE_GB = cfg['FETCH_SIZE_GB']
+FETCH_WORKERS = cfg['FETCH_WORKERS']
+FETCH_PART_MB = cfg['FETCH_PART_MB']
+READ_SIZE = 2**20  # bytes written at a time from a ranged GET
+
+_client = None
+_prefetcher = None
+_pid = None  # process owning the client and prefetcher, unset by fork
+_pending = {}  # prefetch future by S3 path
+_lock = threading.Lock()
+
+
+class FetchError(Exception):
+    pass
+
+
+def _reset_after_fork():
+    '''Clients and threads of the parent can't be used in a forked child'''
+    global _client, _prefetcher, _pid
+    if _pid != os.getpid():
+        _client, _prefetcher, _pid = None, None, os.getpid()
+        _pending.clear()
+
+
+def client():
+    global _client
+    _reset_after_fork()
+    if _client is None:
+        import boto3
+        _client = boto3.client('s3', endpoint_url=cfg['S3_ENDPOINT_URL'])
+    return _client
+
+
+def is_s3(fpath):
+    return isinstance(fpath, str) and fpath.startswith('s3://')
+
+
+def _split(fpath):
+    bucket, key = fpath[len('s3://'):].split('/', 1)
+    return bucket, key
+
+
+def head(fpath, **kwargs):
+    '''HEAD of an S3 object, e.g. its ContentLength and ETag'''
+    bucket, key = _split(fpath)
+    return client().head_object(Bucket=bucket, Key=key, **kwargs)
+
+
+def local_path(fpath):
+    '''Path of an up-to-date local copy of an S3 file, fetched if needed
+
+    Local paths are returned as they are. A file being prefetched is waited
+    for rather than downloaded twice.
+    '''
+    if not is_s3(fpath):
+        return fpath
+    with _lock:
+        _reset_after_fork()
+        pending = _pending.pop(fpath, None)
+    if pending is not None:
+        try:
+            pending.result()
+        except Exception as e:
+            logger.info(f'Prefetching {fpath} failed: {e}')
+    return _fetch(fpath)
+
+
+def _fetch(fpath):
+    response = head(fpath)
+    etag = response['ETag'].strip('"')
+    # Copies are stored by ETag, so a changed object is fetched again
+    path = op.join(FETCH_DIR, etag, _split(fpath)[1])
+    if op.exists(path):
+        os.utime(path)
+        return path
+
+    start = time.perf_counter()
+    _download(fpath, response, path)
+    logger.info(f'Fetched {fpath} ({response["ContentLength"] / 2**20:.1f} '
+                f'MiB) in {time.perf_counter() - start:.1f}s')
+    evict(keep=path)
+    return path
+
+
+def _download(fpath, response, path):
+    '''Stream an object into path with parallel ranged GETs
+
+    ETags of single-part uploads are the MD5 of the content. Those of
+    multipart uploads, "<md5>-<parts>", are the MD5 of the parts' MD5s, so
+    ranges then follow the upload's parts. The copy is only moved into
+    place if it matches.
+    '''
+    bucket, key = _split(fpath)
+    size = response['ContentLength']
+    etag = response['ETag'].strip('"')
+    multipart = re.fullmatch(r'[0-9a-f]{32}-\d+', etag)
+    if multipart:
+        part_size = head(fpath, PartNumber=1)['ContentLength']
+    else:
+        part_size = FETCH_PART_MB * 2**20
+    ranges = [(start, min(start + part_size, size))
+              for start in range(0, size, part_size)]
+
+    os.makedirs(op.dirname(path), exist_ok=True)
+    tmp = f'{path}.tmp{uuid.uuid4().hex}'
+    try:
+        with open(tmp, 'wb') as f:
+            f.truncate(size)
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+            digests = list(pool.map(
+                lambda r: _get_range(bucket, key, response['ETag'], tmp, *r),
+                ranges))
+
+        if multipart:
+            digest = hashlib.md5(b''.join(digests)).hexdigest()
+            digest = f'{digest}-{len(digests)}'
+        else:
+            digest = _md5(tmp)
+        if digest != etag:
+            raise FetchError(f'{fpath}: downloaded content hashes to '
+                             f'{digest}, not its ETag {etag}')
+        os.replace(tmp, path)
+    finally:
+        if op.exists(tmp):
+            os.remove(tmp)
+
+
+def _get_range(bucket, key, etag, tmp, start, end):
+    '''Write bytes [start, end) of an object into tmp, returning their MD5'''
+    body = client().get_object(Bucket=bucket, Key=key, IfMatch=etag,
+                               Range=f'bytes={start}-{end - 1}')['Body']
+    digest = hashlib.md5()
+    with open(tmp, 'r+b') as f:
+        f.seek(start)
+        for block in body.iter_chunks(READ_SIZE):
+            f.write(block)
+            digest.update(block)
+        if f.tell() != end:
+            raise FetchError(f's3://{bucket}/{key}: got {f.tell() - start} '
+                             f'bytes of range [{start}, {end})')
+    return digest.digest()
+
+
+def _md5(fpath):
+    digest = hashlib.md5()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _entries():
+    '''Local copies with their last use and size'''
+    for folder, _, names in os.walk(FETCH_DIR):
+        for name in names:
+            if '.tmp' in name:
+                continue
+            path = op.join(folder, name)
+            stat = os.stat(path)
+            yield stat.st_mtime, stat.st_size, path
+
+
+def evict(size_gb=FETCH_SIZE_GB, keep=None):
+    '''Remove least recently used copies until the rest fit in size_gb'''
+    entries = sorted(_entries())
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= size_gb * 2**30:
+            break
+        if path == keep:
+            continue
+        os.remove(path)
+        total -= size
+        # Remove folders left empty, up to FETCH_DIR
+        folder = op.dirname(path)
+        while folder != FETCH_DIR and folder.startswith(FETCH_DIR):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            folder = op.dirname(folder)
+
+
+def prefetch(fpaths):
+    '''Fetch S3 files in a background thread, one after the other
+
+    Files are downloaded in order, each with parallel ranged GETs. Local
+    paths are skipped. Returns the futures of the downloads started.
+    '''
+    global _prefetcher
+    futures = []
+    with _lock:
+        _reset_after_fork()
+        for fpath in fpaths:
+            if not is_s3(fpath) or (fpath in _pending and
+                                    not _pending[fpath].done()):
+                continue
+            if _prefetcher is None:
+                _prefetcher = ThreadPoolExecutor(max_workers=1)
+            _pending[fpath] = _prefetcher.submit(_fetch, fpath)
+            futures.append(_pending[fpath])
+    return futures
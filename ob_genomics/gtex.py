@@ -1,14 +1,30 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import os
+import os.path as op
+import shutil
+
+import numpy as np
 import pandas as pd
 
 from ob_genomics.config import cfg
+from ob_genomics import cache
+from ob_genomics import fetch
+from ob_genomics import metrics
 import ob_genomics.database as db
+from ob_genomics.utils import FileRange, file_shards
 
 REFERENCE = cfg['REFERENCE']
+# Memory per matrix value while summarizing: the float32 block, its
+# per-tissue copies and the parser's buffers
+MEDIAN_BYTES_PER_VALUE = 16
+GTEX_TPM_CHUNKSIZE = 2000  # GCT rows converted at a time
 
 
-def load_gtex_median_tpm(fpath=cfg['GTEX_MEDIAN_TPM'], env=cfg['ENV']):
+def load_gtex_median_tpm(fpath=cfg['GTEX_MEDIAN_TPM'], env=cfg['ENV'],
+                         replace=False):
     df = (
-        pd.read_csv(fpath, sep='\t', skiprows=2)
+        cache.read_csv(fpath, sep='\t', skiprows=2)
         .melt(id_vars=['gene_id', 'Description'],
               var_name='tissue', value_name='median_tpm')
         )
@@ -17,35 +33,199 @@ def load_gtex_median_tpm(fpath=cfg['GTEX_MEDIAN_TPM'], env=cfg['ENV']):
     if env == 'dev':
         df = df[df['Description'].isin(cfg['TEST_SYMBOLS'])]
 
-    conn = db.engine.connect()
-    conn.execute("INSERT INTO source (source_id) VALUES ('GTEx')")
+    db.add_source('GTEx')
+
+    selected = db.resolver.resolve(
+        df[['ensembl_id', 'tissue', 'median_tpm']]
+        .rename(columns={'median_tpm': 'value'}),
+        {'tissue': 'gtex_id', 'ensembl_id': 'ensembl_id'},
+        loader='GTEx median')
+
+    if replace:
+        db.delete_values('tissue_gene_value_fact', source_id='GTEx',
+                         data_types=['expression'])
+    return db.merge(
+        selected, 'tissue_gene_value_fact',
+        constants={'source_id': 'GTEx', 'data_type': 'expression',
+                   'unit': 'median_tpm'})
+
 
-    conn.execute('''
-        CREATE TABLE tmp_gtex
-        (ensembl_id varchar, tissue varchar, median_tpm numeric)
-    ''')
+def read_gtex_tissues(fpath=cfg['GTEX_SAMPLE']):
+    '''GTEx tissue (SMTSD, e.g. "Adipose - Subcutaneous") by sample ID'''
+    meta = cache.read_csv(fpath, sep='\t', usecols=['SAMPID', 'SMTSD'])
+    return meta.set_index('SAMPID')['SMTSD']
 
-    selected = df[['ensembl_id', 'tissue', 'median_tpm']]
+
+def _summarize_rows(fpath, start, end, columns, groups, block_rows):
+    '''Median of each tissue's columns for the rows in bytes [start, end)'''
+    dtype = defaultdict(lambda: 'float32',
+                        {'transcript_id': str, 'gene_id': str})
+    f = FileRange(fpath, start, end)
+    medians = []
     try:
-        db.copy_from_df(selected, 'tmp_gtex')
-
-        conn.execute('''
-            INSERT INTO tissue_gene_value
-            (source_id, tissue_id, gene_id, data_type, unit, value)
-            SELECT 'GTEx', t.tissue_id, g.gene_id, 'expression',
-                   'median_tpm', tmp.median_tpm
-            FROM tmp_gtex tmp
-            INNER JOIN tissue t ON t.gtex_id = tmp.tissue
-            INNER JOIN gene g ON g.ensembl_id = tmp.ensembl_id
-        ''')
+        for block in cache.read_csv(f, sep='\t', header=None, names=columns,
+                                 dtype=dtype, chunksize=block_rows):
+            values = block.iloc[:, 2:].to_numpy()
+            medians.append(pd.DataFrame(
+                {tissue: np.median(values[:, idx], axis=1)
+                 for tissue, idx in groups.items()},
+                index=block['transcript_id']))
     finally:
-        conn.execute('DROP TABLE tmp_gtex')
-        conn.close()
+        f.close()
+    return pd.concat(medians) if medians else None
+
+
+def summarize_gtex_isoform(
+        data_fpath=cfg['GTEX_ISOFORM'],
+        sample_fpath=cfg['GTEX_SAMPLE'],
+        out_fpath=cfg['GTEX_MEDIAN_ISOFORM'],
+        workers=None,
+        memory_gb=cfg['PARSE_MEMORY_GB']):
+    '''Median transcript TPM per tissue, streamed from the sample matrix
+
+    The transcript by sample matrix is split into byte ranges of rows, one
+    per worker process. Each worker reads its rows in blocks sized so all
+    workers stay within memory_gb, and takes the median of every tissue's
+    sample columns, found once as column index arrays. Writes isoform_id,
+    tissue, median_tpm rows, the input of load_gtex_isoform.
+    '''
+    workers = workers or os.cpu_count()
+    # Workers read byte ranges of a local file
+    data_fpath = fetch.local_path(data_fpath)
+    columns = list(cache.read_csv(data_fpath, sep='\t', nrows=0).columns)
+    tissues = read_gtex_tissues(sample_fpath).reindex(columns[2:])
+    groups = {tissue: np.flatnonzero(tissues.to_numpy() == tissue)
+              for tissue in tissues.dropna().unique()}
+    block_rows = max(1, int(memory_gb * 2**30 / (
+        workers * len(columns) * MEDIAN_BYTES_PER_VALUE)))
+
+    shards = file_shards(data_fpath, workers, skip_lines=1)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_summarize_rows, data_fpath, start, end,
+                               columns, groups, block_rows)
+                   for start, end in shards]
+        medians = pd.concat([f.result() for f in futures])
+    # Workers count their reads in their own processes
+    metrics.count(rows_read=len(medians))
+
+    df = (medians.rename_axis(index='isoform_id', columns='tissue')
+          .stack().rename('median_tpm').reset_index())
+    df.to_csv(out_fpath, index=False)
+    return df
 
 
 def load_gtex_isoform(fpath=cfg['GTEX_MEDIAN_ISOFORM']):
-    df = (pd.read_csv(fpath)
+    df = (cache.read_csv(fpath)
           .rename(columns={'median_tpm': 'value'}))
-    df.loc[:, 'unit']: 'TPM'
-    df = df[['source_id', 'tissue_id', 'isoform_id', 'unit', 'value']]
-    db.copy_from_df(df, 'tissue_isoform_value')
+    df = df[['tissue', 'isoform_id', 'value']]
+
+    db.add_source('GTEx')
+
+    df = db.resolver.resolve(
+        df, {'tissue': 'gtex_id', 'isoform_id': 'isoform_id'},
+        loader='GTEx isoform median')
+    return db.merge(df, 'tissue_isoform_value_fact',
+                    constants={'source_id': 'GTEx', 'unit': 'TPM'})
+
+
+def build_gtex_tpm_store(fpath=cfg['GTEX_TPM'],
+                         sample_fpath=cfg['GTEX_SAMPLE'],
+                         out_dir=cfg['GTEX_TPM_STORE'],
+                         chunksize=GTEX_TPM_CHUNKSIZE):
+    '''Convert the GTEx sample TPM GCT into a memory-mapped matrix store
+
+    The store is a folder with:
+        values.f32   float32 genes x samples, row-major
+        genes.csv    gene_id (versioned Ensembl ID), ensembl_id and symbol
+                     of each row
+        samples.csv  sample_id and tissue of each column
+        tissues.csv  tissue with the [start, end) range of its columns
+    Columns are ordered by tissue, so a gene's samples for one tissue are
+    a contiguous slice of its row. The GCT is read chunksize rows at a time
+    and the store replaces out_dir only once complete.
+    '''
+    fpath = fetch.local_path(fpath)
+    with open(fpath) as f:
+        f.readline()  # GCT version
+        n_genes, n_samples = map(int, f.readline().split()[:2])
+    header = cache.read_csv(fpath, sep='\t', skiprows=2, nrows=0).columns
+    name, description = header[:2]
+
+    tissues = read_gtex_tissues(sample_fpath).reindex(header[2:])
+    samples = (pd.DataFrame({'sample_id': header[2:],
+                             'tissue': tissues.to_numpy()})
+               .dropna(subset=['tissue'])
+               .sort_values('tissue', kind='stable'))
+    order = header[2:].get_indexer(samples['sample_id'])
+
+    tmp_dir = f'{out_dir}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    values = np.memmap(op.join(tmp_dir, 'values.f32'), dtype='float32',
+                       mode='w+', shape=(n_genes, len(samples)))
+    dtype = defaultdict(lambda: 'float32', {name: str, description: str})
+    genes, start = [], 0
+    for chunk in cache.read_csv(fpath, sep='\t', skiprows=2, dtype=dtype,
+                                chunksize=chunksize):
+        end = start + len(chunk)
+        values[start:end] = chunk.iloc[:, 2:].to_numpy()[:, order]
+        genes.append(chunk[[name, description]])
+        start = end
+    values.flush()
+    del values
+
+    genes = pd.concat(genes)
+    genes.columns = ['gene_id', 'symbol']
+    genes.insert(1, 'ensembl_id', genes['gene_id'].str.split('.').str[0])
+    genes.to_csv(op.join(tmp_dir, 'genes.csv'), index=False)
+    samples.to_csv(op.join(tmp_dir, 'samples.csv'), index=False)
+    bounds = samples.reset_index(drop=True).reset_index().groupby('tissue')
+    (bounds['index'].agg(start='min', end='max')
+     .assign(end=lambda df: df['end'] + 1)
+     .reset_index()
+     .to_csv(op.join(tmp_dir, 'tissues.csv'), index=False))
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+
+
+class TPMStore:
+    '''Read access to a store written by build_gtex_tpm_store
+
+    Values are memory-mapped, so looking up a gene reads one row of the
+    matrix from disk (or the page cache) instead of scanning a table.
+    '''
+
+    def __init__(self, path=cfg['GTEX_TPM_STORE']):
+        # Small files written by build_gtex_tpm_store and read by the app,
+        # not reference inputs: caching them as Parquet would only copy them
+        self.genes = pd.read_csv(op.join(path, 'genes.csv'))
+        self.samples = pd.read_csv(op.join(path, 'samples.csv'))
+        self.tissues = pd.read_csv(op.join(path, 'tissues.csv'))
+        self.values = np.memmap(
+            op.join(path, 'values.f32'), dtype='float32', mode='r',
+            shape=(len(self.genes), len(self.samples)))
+        # Row of each gene ID, Ensembl ID and symbol; the first row wins
+        self._rows = {}
+        for col in ['symbol', 'ensembl_id', 'gene_id']:
+            rows = pd.Series(self.genes.index, index=self.genes[col])
+            self._rows.update(rows[~rows.index.duplicated()].to_dict())
+
+    def row(self, gene):
+        '''Matrix row of a gene by GTEx gene ID, Ensembl ID or symbol'''
+        try:
+            return self._rows[gene]
+        except KeyError:
+            raise KeyError(f'Gene not in GTEx TPM store: {gene}') from None
+
+    def tissue_distribution(self, gene):
+        '''TPM of a gene in each sample, as a float32 array by tissue'''
+        values = self.values[self.row(gene)]
+        return {tissue: np.asarray(values[start:end])
+                for tissue, start, end in self.tissues.itertuples(
+                    index=False)}
+
+    def gene_tpm(self, gene):
+        '''Long table of sample_id, tissue and tpm of one gene'''
+        return self.samples.assign(
+            tpm=np.asarray(self.values[self.row(gene)]))
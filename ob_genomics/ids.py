@@ -0,0 +1,214 @@
+'''In-memory resolution of external identifiers to database keys'''
+from collections import Counter
+import logging
+
+import numpy as np
+import pandas as pd
+
+from ob_genomics import cache
+from ob_genomics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Mapping name: (output key column, query returning identifier and key)
+MAPPINGS = {
+    'gene_id': ('gene_id', 'SELECT gene_id, gene_id FROM gene'),
+    'ensembl_id': ('gene_id', '''
+        SELECT ensembl_id, MIN(gene_id) FROM gene
+        WHERE ensembl_id IS NOT NULL GROUP BY ensembl_id'''),
+    'symbol': ('gene_id', '''
+        SELECT symbol, MIN(gene_id) FROM gene
+        WHERE symbol IS NOT NULL GROUP BY symbol'''),
+    'isoform_id': ('isoform_id', 'SELECT isoform_id, isoform_id FROM isoform'),
+    'gtex_id': ('tissue_id', '''
+        SELECT gtex_id, MIN(tissue_id) FROM tissue
+        WHERE gtex_id IS NOT NULL GROUP BY gtex_id'''),
+    'hpa_id': ('tissue_id', '''
+        SELECT hpa_id, MIN(tissue_id) FROM tissue
+        WHERE hpa_id IS NOT NULL GROUP BY hpa_id'''),
+    'cell_type_id': ('cell_type_id',
+                     'SELECT cell_type_id, cell_type_id FROM cell_type'),
+    'sample_id': ('sample_key', 'SELECT sample_id, sample_key FROM sample'),
+    'patient_id': ('patient_key',
+                   'SELECT patient_id, patient_key FROM patient'),
+}
+
+
+def read_gene_history(fpath):
+    '''NCBI gene_history as (new_gene_id, gene_id, symbol) of retired genes
+
+    new_gene_id is NaN for genes that were discontinued without a
+    replacement.
+    '''
+    gene_history = cache.read_csv(fpath, sep='\t', na_values='-')
+    gene_history.columns = [
+        'taxid',
+        'new_gene_id',
+        'gene_id',
+        'symbol',
+        'discontinued_date',
+    ]
+    return gene_history
+
+
+class IdResolver:
+    '''Maps identifier columns to database keys through cached hash maps
+
+    Each mapping is read from the database the first time it is used and
+    kept until clear(), so a build queries each dimension table once.
+    Retired NCBI gene IDs resolve to their replacement through gene_history.
+    '''
+
+    def __init__(self, engine, gene_history_fpath=None):
+        self.engine = engine
+        self.gene_history_fpath = gene_history_fpath
+        self.unmatched = Counter()
+        self._maps = {}
+
+    def clear(self, *names):
+        '''Forget the given mappings, or all mappings and unmatched counts
+
+        Mappings to keys assigned by the database, like sample_key, must be
+        cleared after loading new rows into their table.
+        '''
+        if names:
+            for name in names:
+                self._maps.pop(name, None)
+            return
+        self._maps.clear()
+        self.unmatched.clear()
+
+    def _load(self, name):
+        _, query = MAPPINGS[name]
+        rows = self.engine.execute(query).fetchall()
+        keys = [row[0] for row in rows]
+        values = np.array([row[1] for row in rows], dtype=object)
+
+        if name == 'gene_id' and self.gene_history_fpath is not None:
+            retired = read_gene_history(self.gene_history_fpath)
+            retired = retired[retired['new_gene_id'].isin(keys)]
+            current = pd.Index(keys).get_indexer(retired['new_gene_id'])
+            keys += list(retired['gene_id'])
+            values = np.concatenate([values, values[current]])
+
+        index = pd.Index(keys)
+        keep = ~index.duplicated(keep='last')
+        return index[keep], values[keep]
+
+    def mapping(self, name):
+        if name not in self._maps:
+            self._maps[name] = self._load(name)
+        return self._maps[name]
+
+    def map(self, name, values):
+        '''Map identifiers to keys, with None where they don't resolve'''
+        values = pd.Series(values)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Look up each category once and expand by code
+            keys = np.append(self.map(name, values.cat.categories), None)
+            return keys[values.cat.codes.to_numpy()]
+
+        index, keys = self.mapping(name)
+        pos = index.get_indexer(values)
+        out = keys[pos]
+        out[pos < 0] = None
+        return out
+
+    def resolve(self, df, columns, loader):
+        '''Replace identifier columns with keys and drop unresolved rows
+
+        columns maps DataFrame columns to mapping names, e.g.
+        {'Gene': 'ensembl_id'} replaces Gene with gene_id, in the same
+        position. The number of rows dropped is added to unmatched[loader].
+        '''
+        resolved = {}
+        matched = np.ones(len(df), dtype=bool)
+        for col, name in columns.items():
+            keys = self.map(name, df[col])
+            matched &= pd.notna(keys)
+            resolved[col] = keys
+
+        df = df.loc[matched].copy()
+        for col, keys in resolved.items():
+            key = MAPPINGS[columns[col]][0]
+            keys = pd.Series(keys[matched], index=df.index).infer_objects()
+            if key == col:
+                df[key] = keys
+            else:
+                pos = df.columns.get_loc(col)
+                df = df.drop(columns=col)
+                df.insert(pos, key, keys)
+
+        n_unmatched = int((~matched).sum())
+        self.unmatched[loader] += n_unmatched
+        metrics.count(rows_dropped=n_unmatched)
+        if n_unmatched:
+            logger.info(f'{loader}: dropped {n_unmatched} of {len(matched)} '
+                        'rows with unresolved identifiers')
+        return df
+
+    def resolve_matrix(self, mat, rows, columns, loader):
+        '''Replace the row and column labels of a wide matrix with keys
+
+        rows and columns are the mapping names of the index and column
+        labels, e.g. 'gene_id' and 'sample_id'. Rows and columns that don't
+        resolve are dropped, as are later duplicates of a key, such as a
+        retired gene ID next to its replacement. The number of cells dropped
+        as unresolved is added to unmatched[loader].
+        '''
+        row_keys = pd.Series(self.map(rows, mat.index))
+        col_keys = pd.Series(self.map(columns, mat.columns))
+        keep_rows = (row_keys.notna() & ~row_keys.duplicated()).to_numpy()
+        keep_cols = (col_keys.notna() & ~col_keys.duplicated()).to_numpy()
+
+        n_cells = mat.shape[0] * mat.shape[1]
+        n_unmatched = n_cells - row_keys.notna().sum() * col_keys.notna().sum()
+        self.unmatched[loader] += int(n_unmatched)
+        metrics.count(rows_dropped=int(n_unmatched))
+        if n_unmatched:
+            logger.info(f'{loader}: dropped {n_unmatched} of {n_cells} '
+                        'values with unresolved identifiers')
+
+        mat = mat.iloc[keep_rows, keep_cols]
+        mat.index = pd.Index(row_keys[keep_rows].infer_objects(),
+                             name=MAPPINGS[rows][0])
+        mat.columns = pd.Index(col_keys[keep_cols].infer_objects(),
+                               name=MAPPINGS[columns][0])
+        return mat
+
+
+class Dictionary:
+    '''Small-integer codes for the values of a dictionary table
+
+    The table has a {name}_id key and a unique {name} text column, as
+    models.DataType and models.Unit. Codes are read once and cached; values
+    not seen before are added to the table on first use.
+    '''
+
+    def __init__(self, engine, name):
+        self.engine = engine
+        self.name = name
+        self._codes = None
+
+    def clear(self):
+        self._codes = None
+
+    def _load(self):
+        rows = self.engine.execute(
+            f'SELECT {self.name}, {self.name}_id FROM {self.name}').fetchall()
+        self._codes = dict(rows)
+
+    def encode(self, values):
+        '''Codes for values as a nullable Int16 array, adding new values'''
+        values = pd.Series(values)
+        if self._codes is None:
+            self._load()
+        new = [value for value in values.dropna().unique()
+               if value not in self._codes]
+        if new:
+            self.engine.execute(
+                f'INSERT INTO {self.name} ({self.name}) VALUES (%s) '
+                f'ON CONFLICT ({self.name}) DO NOTHING',
+                [(str(value),) for value in new])
+            self._load()
+        return values.map(self._codes).astype('Int16').array
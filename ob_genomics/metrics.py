@@ -0,0 +1,214 @@
+'''Timings and row counts of pipeline tasks, recorded in task_metric
+
+Metrics are collected for one task at a time in the process running it,
+from start_task() to finish_task(). Loading code adds to them with phase()
+and count(). Load calls like copy_from_df also record a row of their own
+inside step(), whose totals add up into the task's.
+'''
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import re
+import resource
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+from ob_genomics import models
+from ob_genomics import profiling
+
+# Counters added with count(). Phases are timed with phase(): parse and
+# copy, and transform is the wall time spent outside them.
+COUNTERS = ['rows_read', 'rows_written', 'rows_dropped', 'bytes_streamed']
+# Tasks faster than this are too noisy to flag as regressions
+MIN_SECONDS = 1.0
+
+build_id = None
+_stack = []
+_children_baseline = 0  # children's peak RSS when the current task started
+# COPY shards count rows and bytes from their own threads
+_lock = threading.Lock()
+
+
+class Metrics:
+    def __init__(self, task_id, step):
+        self.task_id = task_id
+        self.step = step
+        self.started = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.seconds = Counter()
+        self.counts = Counter()
+
+    def row(self, status):
+        wall = time.perf_counter() - self.start
+        return {
+            'build_id': build_id,
+            'task_id': self.task_id,
+            'step': self.step,
+            'status': status,
+            'started': self.started,
+            'wall_seconds': wall,
+            'parse_seconds': self.seconds['parse'],
+            'transform_seconds': max(0., wall - sum(self.seconds.values())),
+            'copy_seconds': self.seconds['copy'],
+            **{name: self.counts[name] for name in COUNTERS},
+            'peak_rss': peak_rss(),
+        }
+
+
+def _own_peak_rss():
+    '''High-water mark of this process in bytes, resettable on Linux'''
+    try:
+        with open('/proc/self/status') as f:
+            return 1024 * int(re.search(r'VmHWM:\s+(\d+) kB', f.read())[1])
+    except (OSError, TypeError):
+        return 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _children_peak_rss():
+    return 1024 * resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+def reset_peak_rss():
+    '''Measure peak_rss() from now on, where the kernel allows it'''
+    global _children_baseline
+    _children_baseline = _children_peak_rss()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    '''Peak resident memory in bytes of the current task
+
+    On Linux, start_task resets the high-water mark of the process, so each
+    task reports its own peak, in single process builds too. Elsewhere this
+    is the peak of the process so far, only meaningful per task with forked
+    workers or in benchmark.measure. Child processes, such as parsing pools,
+    count when one of them peaked higher than any before the task started.
+    '''
+    rss = _own_peak_rss()
+    children = _children_peak_rss()
+    if children > _children_baseline:
+        rss = max(rss, children)
+    return rss
+
+
+def start_build():
+    global build_id
+    build_id = uuid.uuid4().hex
+    return build_id
+
+
+def _record(row):
+    from ob_genomics.database import engine
+    with engine.begin() as conn:
+        conn.execute(models.TaskMetric.__table__.insert(), row)
+
+
+def start_task(task_id):
+    if build_id is None:
+        start_build()
+    reset_peak_rss()
+    _stack[:] = [Metrics(task_id, 'task')]
+
+
+def finish_task(status='done'):
+    '''Record the current task's metrics and return them'''
+    if _stack:
+        row = _stack.pop().row(status)
+        _stack.clear()
+        _record(row)
+        return row
+
+
+@contextmanager
+def step(name):
+    '''Record the metrics of a load call inside the current task'''
+    if not _stack:
+        yield
+        return
+    metrics = Metrics(_stack[0].task_id, name)
+    _stack.append(metrics)
+    status = 'failed'
+    try:
+        yield
+        status = 'done'
+    finally:
+        _stack.remove(metrics)
+        _record(metrics.row(status))
+        if _stack:
+            _stack[-1].seconds.update(metrics.seconds)
+            _stack[-1].counts.update(metrics.counts)
+
+
+@contextmanager
+def phase(name):
+    '''Add the time spent in the block to a phase of the current task'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _stack:
+            _stack[-1].seconds[name] += time.perf_counter() - start
+        profiling.checkpoint()
+
+
+def count(**counts):
+    '''Add to counters of the current task, e.g. count(rows_read=10)'''
+    if _stack:
+        with _lock:
+            _stack[-1].counts.update(counts)
+
+
+def task_history(engine, builds=10):
+    '''Task metrics of the last builds, oldest build first'''
+    result = engine.execute('''
+        WITH recent AS (
+            SELECT build_id, MIN(started) AS build_started
+            FROM task_metric
+            GROUP BY build_id
+            ORDER BY build_started DESC
+            LIMIT %s
+        )
+        SELECT r.build_started, m.*
+        FROM task_metric m
+        INNER JOIN recent r ON r.build_id = m.build_id
+        WHERE m.step = 'task' AND m.status = 'done'
+        ORDER BY r.build_started, m.task_id
+    ''', (builds,))
+    return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+
+def regressions(history, threshold=1.5):
+    '''Tasks of the latest build slower or larger than usual
+
+    Each task's wall time and peak RSS in the latest build are compared
+    with its median over the earlier builds, and flagged above threshold
+    times the median.
+    '''
+    if history.empty:
+        return history
+    latest = history['build_started'] == history['build_started'].max()
+    current = history[latest].set_index('task_id')
+    usual = (history[~latest].groupby('task_id')
+             [['wall_seconds', 'peak_rss']].median())
+    usual = usual.reindex(current.index)
+
+    flagged = []
+    for metric in 'wall_seconds', 'peak_rss':
+        ratio = current[metric] / usual[metric]
+        slow = ratio > threshold
+        if metric == 'wall_seconds':
+            slow &= current[metric] >= MIN_SECONDS
+        flagged.append(pd.DataFrame({
+            'metric': metric,
+            'latest': current.loc[slow, metric],
+            'median': usual.loc[slow, metric],
+            'ratio': ratio[slow],
+        }))
+    return pd.concat(flagged).reset_index()
@@ -1,17 +1,60 @@
-from sqlalchemy import (Column, ForeignKey, Integer, Numeric, String,
-                        Text, DateTime)
+from sqlalchemy import (BigInteger, Column, Float, ForeignKey, Integer,
+                        SmallInteger, String, Text, DateTime, event)
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
 
+from ob_genomics.config import cfg
+
 
 base = declarative_base()
 
 
+# A completed load, with the input files it was loaded from, so rebuilds
+# can tell which inputs changed. Several inputs are comma-separated paths,
+# summed sizes, the latest mtime and a hash of their hashes.
 class TableUpdate(base):
     __tablename__ = 'table_update'
     update_id = Column(String, primary_key=True)
     target_table = Column(String)
     inserted = Column(DateTime(timezone=True), server_default=func.now())
+    input_path = Column(String)
+    input_size = Column(BigInteger)
+    input_mtime = Column(DateTime(timezone=True))
+    input_hash = Column(String)
+    n_rows = Column(BigInteger)
+
+
+# Chunks committed by a load that has not completed yet (see
+# database.Checkpoint), removed when its table_update is recorded
+class LoadCheckpoint(base):
+    __tablename__ = 'load_checkpoint'
+    update_id = Column(String, primary_key=True)
+    chunk = Column(Integer, primary_key=True)
+    input_hash = Column(String)
+    n_rows = Column(BigInteger)
+    committed = Column(DateTime(timezone=True), server_default=func.now())
+
+
+# Timings, row counts and memory of a build task (step 'task'), and of each
+# load call inside it (e.g. step 'copy_from_df patient_value_fact'), as
+# recorded by the metrics module
+class TaskMetric(base):
+    __tablename__ = 'task_metric'
+    metric_id = Column(Integer, primary_key=True)
+    build_id = Column(String, nullable=False, index=True)
+    task_id = Column(String, nullable=False)
+    step = Column(String, nullable=False)
+    status = Column(String)
+    started = Column(DateTime(timezone=True))
+    wall_seconds = Column(Float)
+    parse_seconds = Column(Float)
+    transform_seconds = Column(Float)
+    copy_seconds = Column(Float)
+    rows_read = Column(BigInteger)
+    rows_written = Column(BigInteger)
+    rows_dropped = Column(BigInteger)
+    bytes_streamed = Column(BigInteger)
+    peak_rss = Column(BigInteger)
 
 
 class Gene(base):
@@ -41,16 +84,21 @@ class Cohort(base):
     name = Column(String)
 
 
+# Patients and samples are keyed by integers, which are much smaller than
+# barcodes in the data tables and their indexes. Barcodes are kept unique
+# here for lookups.
 class Patient(base):
     __tablename__ = 'patient'
-    patient_id = Column(String, primary_key=True)
+    patient_key = Column(Integer, primary_key=True)
+    patient_id = Column(String, nullable=False, unique=True)
     cohort_id = Column(String, ForeignKey('cohort.cohort_id'))
 
 
 class Sample(base):
     __tablename__ = 'sample'
-    sample_id = Column(String, primary_key=True)
-    patient_id = Column(String, ForeignKey('patient.patient_id'))
+    sample_key = Column(Integer, primary_key=True)
+    sample_id = Column(String, nullable=False, unique=True)
+    patient_key = Column(Integer, ForeignKey('patient.patient_key'))
     sample_code = Column(String)
     sample_type = Column(String)
 
@@ -79,86 +127,222 @@ class Pathway(base):
 ##############################
 # Generalizable data entities
 # (similar to Entity-Attribute-Value with foreign keys)
+#
+# data_type and unit repeat on every row, so they are stored as small-integer
+# codes into dictionary tables. Each *_fact table is read through a view with
+# the original table name, text data_type / unit columns and the sample or
+# patient barcode next to its key (see EAV_VIEWS).
+
+# Numeric values are floats, single or double precision by table as set in
+# cfg['VALUE_PRECISION']
+VALUE_TYPES = {
+    'real': Float(precision=24),
+    'double': Float(precision=53),
+}
+
+
+def value_column(table):
+    '''Numeric value column stored as configured for a table'''
+    return Column(VALUE_TYPES[cfg['VALUE_PRECISION'][table]], nullable=False)
+
+
+class DataType(base):
+    __tablename__ = 'data_type'
+    data_type_id = Column(SmallInteger, primary_key=True)
+    data_type = Column(String, nullable=False, unique=True)
+
+
+class Unit(base):
+    __tablename__ = 'unit'
+    unit_id = Column(SmallInteger, primary_key=True)
+    unit = Column(String, nullable=False, unique=True)
+
 
 class PatientValue(base):
-    __tablename__ = 'patient_value'
-    patient_id = Column(String, ForeignKey('patient.patient_id'),
-                        primary_key=True)
-    data_type = Column(String, primary_key=True)
-    unit = Column(String)
-    value = Column(Numeric, nullable=False)
+    __tablename__ = 'patient_value_fact'
+    patient_key = Column(Integer, ForeignKey('patient.patient_key'),
+                         primary_key=True)
+    data_type_id = Column(SmallInteger, ForeignKey('data_type.data_type_id'),
+                          primary_key=True)
+    unit_id = Column(SmallInteger, ForeignKey('unit.unit_id'))
+    value = value_column('patient_value')
+    # Input that loaded the value, so a reload only replaces its own rows
+    source_id = Column(String, ForeignKey('source.source_id'))
 
 
 class PatientTextValue(base):
-    __tablename__ = 'patient_text_value'
-    patient_id = Column(String, ForeignKey('patient.patient_id'),
-                        primary_key=True)
-    data_type = Column(String, primary_key=True)
-    unit = Column(String)
+    __tablename__ = 'patient_text_value_fact'
+    patient_key = Column(Integer, ForeignKey('patient.patient_key'),
+                         primary_key=True)
+    data_type_id = Column(SmallInteger, ForeignKey('data_type.data_type_id'),
+                          primary_key=True)
+    unit_id = Column(SmallInteger, ForeignKey('unit.unit_id'))
     value = Column(String, nullable=False)
+    # Input that loaded the value, so a reload only replaces its own rows
+    source_id = Column(String, ForeignKey('source.source_id'))
 
 
+# List-partitioned by data_type_id, then by cohort_id (Postgres only). Each
+# data type in SAMPLE_GENE_DATA_TYPES has its own cohort-partitioned table,
+# other data types go to a default partition. Cohort partitions are created by
+# database.load_sample_gene_partition.
 class SampleGeneValue(base):
-    __tablename__ = 'sample_gene_value'
-    sample_id = Column(String, ForeignKey('sample.sample_id'),
-                       primary_key=True)
+    __tablename__ = 'sample_gene_value_fact'
+    __table_args__ = {'postgresql_partition_by': 'LIST (data_type_id)'}
+    sample_key = Column(Integer, ForeignKey('sample.sample_key'),
+                        primary_key=True)
     gene_id = Column(Integer, ForeignKey('gene.gene_id'), primary_key=True)
-    data_type = Column(String, primary_key=True)
-    unit = Column(String)
-    value = Column(Numeric, nullable=False)
+    data_type_id = Column(SmallInteger, ForeignKey('data_type.data_type_id'),
+                          primary_key=True)
+    cohort_id = Column(String, ForeignKey('cohort.cohort_id'),
+                       primary_key=True)
+    unit_id = Column(SmallInteger, ForeignKey('unit.unit_id'))
+    value = value_column('sample_gene_value')
+
+
+# Data types with their own cohort-partitioned table, by partition suffix
+SAMPLE_GENE_DATA_TYPES = {
+    'expression': 'expression',
+    'copy number': 'copy_number',
+}
+
+
+def sample_gene_partition(data_type, cohort_id=None):
+    '''Name of the sample_gene_value partition for a data type or cohort'''
+    name = f'sample_gene_value_{SAMPLE_GENE_DATA_TYPES[data_type]}'
+    if cohort_id is not None:
+        name += f'_{cohort_id.lower()}'
+    return name
+
+
+@event.listens_for(SampleGeneValue.__table__, 'after_create')
+def create_sample_gene_partitions(target, connection, **kw):
+    if connection.dialect.name != 'postgresql':
+        return
+    # Partition bounds are dictionary codes, so the data types are added first
+    for data_type in SAMPLE_GENE_DATA_TYPES:
+        connection.execute('INSERT INTO data_type (data_type) VALUES (%s) '
+                           'ON CONFLICT (data_type) DO NOTHING', (data_type,))
+        data_type_id = connection.execute(
+            'SELECT data_type_id FROM data_type WHERE data_type = %s',
+            (data_type,)).scalar()
+        connection.execute(f'''
+            CREATE TABLE {sample_gene_partition(data_type)}
+            PARTITION OF {target.name}
+            FOR VALUES IN ({data_type_id})
+            PARTITION BY LIST (cohort_id)
+        ''')
+    connection.execute(f'''
+        CREATE TABLE sample_gene_value_other
+        PARTITION OF {target.name} DEFAULT
+    ''')
 
 
 class SampleGeneTextValue(base):
-    __tablename__ = 'sample_gene_text_value'
-    sample_id = Column(String, ForeignKey('sample.sample_id'),
-                       primary_key=True)
+    __tablename__ = 'sample_gene_text_value_fact'
+    sample_key = Column(Integer, ForeignKey('sample.sample_key'),
+                        primary_key=True)
     gene_id = Column(Integer, ForeignKey('gene.gene_id'), primary_key=True)
-    data_type = Column(String, primary_key=True)
-    unit = Column(String)
+    data_type_id = Column(SmallInteger, ForeignKey('data_type.data_type_id'),
+                          primary_key=True)
+    unit_id = Column(SmallInteger, ForeignKey('unit.unit_id'))
     value = Column(String, nullable=False)
 
 
 class SampleIsoformValue(base):
-    __tablename__ = 'sample_isoform_value'
-    sample_id = Column(String, ForeignKey('sample.sample_id'),
-                       primary_key=True)
+    __tablename__ = 'sample_isoform_value_fact'
+    sample_key = Column(Integer, ForeignKey('sample.sample_key'),
+                        primary_key=True)
     isoform_id = Column(String, ForeignKey('isoform.isoform_id'),
                         primary_key=True)
-    unit = Column(String)
-    value = Column(String, nullable=False)
+    unit_id = Column(SmallInteger, ForeignKey('unit.unit_id'))
+    value = value_column('sample_isoform_value')
 
 
 class TissueGeneValue(base):
-    __tablename__ = 'tissue_gene_value'
+    __tablename__ = 'tissue_gene_value_fact'
     source_id = Column(String, ForeignKey('source.source_id'),
                        primary_key=True)
     tissue_id = Column(String, ForeignKey('tissue.tissue_id'),
                        primary_key=True)
     gene_id = Column(Integer, ForeignKey('gene.gene_id'), primary_key=True)
-    data_type = Column(String, primary_key=True)
-    unit = Column(String)
-    value = Column(Numeric, nullable=False)
+    data_type_id = Column(SmallInteger, ForeignKey('data_type.data_type_id'),
+                          primary_key=True)
+    unit_id = Column(SmallInteger, ForeignKey('unit.unit_id'))
+    value = value_column('tissue_gene_value')
 
 
 class TissueIsoformValue(base):
-    __tablename__ = 'tissue_isoform_value'
+    __tablename__ = 'tissue_isoform_value_fact'
     source_id = Column(String, ForeignKey('source.source_id'),
                        primary_key=True)
     tissue_id = Column(String, ForeignKey('tissue.tissue_id'),
                        primary_key=True)
     isoform_id = Column(String, ForeignKey('isoform.isoform_id'),
                         primary_key=True)
-    unit = Column(String)
-    value = Column(Numeric, nullable=False)
+    unit_id = Column(SmallInteger, ForeignKey('unit.unit_id'))
+    value = value_column('tissue_isoform_value')
 
 
 class CellTypeGeneTextValue(base):
-    __tablename__ = 'cell_type_gene_text_value'
+    __tablename__ = 'cell_type_gene_text_value_fact'
     source_id = Column(String, ForeignKey('source.source_id'),
                        primary_key=True)
     cell_type_id = Column(String, ForeignKey('cell_type.cell_type_id'),
                           primary_key=True)
     gene_id = Column(Integer, ForeignKey('gene.gene_id'), primary_key=True)
-    data_type = Column(String, primary_key=True)
-    unit = Column(String)
+    data_type_id = Column(SmallInteger, ForeignKey('data_type.data_type_id'),
+                          primary_key=True)
+    unit_id = Column(SmallInteger, ForeignKey('unit.unit_id'))
     value = Column(String, nullable=False)
+
+
+# Surrogate keys shown with their barcode in the views: (table, barcode)
+BARCODES = {
+    'sample_key': ('sample', 'sample_id'),
+    'patient_key': ('patient', 'patient_id'),
+}
+
+
+def eav_view(table):
+    '''SELECT for a fact table with dictionary codes and keys decoded'''
+    cols, joins = [], []
+    for col in table.columns:
+        if col.name in BARCODES:
+            # Left joins on a unique key are removed when the barcode isn't
+            # used, so joining on the key from the view costs nothing extra
+            dim, barcode = BARCODES[col.name]
+            cols += [f'{dim}.{barcode}', f't.{col.name}']
+            joins.append(f'LEFT JOIN {dim} '
+                         f'ON {dim}.{col.name} = t.{col.name}')
+        elif col.name == 'data_type_id':
+            cols.append('d.data_type')
+            joins.append('INNER JOIN data_type d '
+                         'ON d.data_type_id = t.data_type_id')
+        elif col.name == 'unit_id':
+            cols.append('u.unit')
+            joins.append('LEFT JOIN unit u ON u.unit_id = t.unit_id')
+        else:
+            cols.append(f't.{col.name}')
+    return (f'SELECT {", ".join(cols)} FROM {table.name} t '
+            + ' '.join(joins))
+
+
+# Compatibility views with the original EAV table names, as used by the app
+EAV_VIEWS = {
+    table.name[:-len('_fact')]: table
+    for table in base.metadata.sorted_tables
+    if table.name.endswith('_fact')
+}
+
+
+@event.listens_for(base.metadata, 'after_create')
+def create_eav_views(target, connection, **kw):
+    for name, table in EAV_VIEWS.items():
+        connection.execute(f'CREATE VIEW {name} AS {eav_view(table)}')
+
+
+@event.listens_for(base.metadata, 'before_drop')
+def drop_eav_views(target, connection, **kw):
+    for name in EAV_VIEWS:
+        connection.execute(f'DROP VIEW IF EXISTS {name}')
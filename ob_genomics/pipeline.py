@@ -1,9 +1,19 @@
+from concurrent.futures import wait
+from contextlib import nullcontext
+import hashlib
+import os
+import os.path as op
+
 import luigi
-from luigi import Task, WrapperTask, Parameter, Target, LocalTarget
+from luigi import (Task, WrapperTask, Parameter, FloatParameter,
+                   IntParameter, Target, LocalTarget)
 from luigi.contrib.s3 import S3Target
-import pandas as pd
 
 from ob_genomics.config import cfg
+from ob_genomics import cache
+from ob_genomics import fetch
+from ob_genomics import metrics
+from ob_genomics import profiling
 import ob_genomics.database as db
 import ob_genomics.gtex as gtex
 import ob_genomics.hpa as hpa
@@ -11,39 +21,189 @@ import ob_genomics.tcga as tcga
 
 REFERENCE = cfg['REFERENCE']
 SCRATCH = cfg['SCRATCH']
+PREFETCH_COHORTS = cfg['PREFETCH_COHORTS']
 
 ReferenceTarget = S3Target if REFERENCE.startswith('s3://') else LocalTarget
 
 
+# Metrics and profiles of every task are recorded by the process that
+# runs it
+@Task.event_handler(luigi.Event.START)
+def start_task_metrics(task):
+    metrics.start_task(task.task_id)
+    profiling.start_task(task.task_id)
+
+
+@Task.event_handler(luigi.Event.SUCCESS)
+def finish_task_metrics(task):
+    profiling.finish_task(task.task_id)
+    metrics.finish_task('done')
+
+
+@Task.event_handler(luigi.Event.FAILURE)
+def fail_task_metrics(task, exception):
+    profiling.finish_task(task.task_id)
+    metrics.finish_task('failed')
+
+
 class DatabaseTarget(Target):
-    def __init__(self, table, update_id):
+    # Input hash by update_id of table_update, read in one query by
+    # load_completed(). Misses are only trusted in the process that read
+    # them: tasks run by forked workers mark updates in their own copy.
+    _completed = None
+    _completed_pid = None
+    # When set, an update is only complete while its inputs still hash to
+    # what was recorded
+    incremental = False
+
+    def __init__(self, table, update_id, inputs=()):
         """
         Args:
+            table (str): Table, or comma-separated tables, loaded by the task
             update_id (str): An identifier for this data set
+            inputs (str or list): Paths of the files it is loaded from
         """
         self.table = table
         self.update_id = update_id
-
-    def touch(self, connection=None):
-        """Mark this update as complete."""
-        conn = db.engine.connect()
-        conn.execute(f'''
-            INSERT INTO table_update (update_id, target_table)
-            VALUES ('{self.update_id}', '{self.table}')
-        ''')
-        conn.close()
+        self.inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+
+    @classmethod
+    def load_completed(cls):
+        """Cache all completed updates, before scheduling a build."""
+        with db.engine.connect() as conn:
+            rows = conn.execute('SELECT update_id, input_hash '
+                                'FROM table_update')
+            cls._completed = dict(rows.fetchall())
+        cls._completed_pid = os.getpid()
+
+    def recorded(self):
+        """Whether this update was loaded before, and its input hash."""
+        completed = DatabaseTarget._completed
+        if completed is not None:
+            if self.update_id in completed:
+                return True, completed[self.update_id]
+            if DatabaseTarget._completed_pid == os.getpid():
+                return False, None
+
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                'SELECT input_hash FROM table_update WHERE update_id = %s',
+                (self.update_id,)).fetchone()
+        if row is None:
+            return False, None
+        if completed is not None:
+            completed[self.update_id] = row[0]
+        return True, row[0]
+
+    def input_hash(self):
+        hashes = [cache.content_hash(fpath) for fpath in self.inputs]
+        return _combine_hashes(hashes)
+
+    def touch(self, n_rows=None):
+        """Mark this update as complete, replacing any earlier record.
+
+        Checkpoints of the load are removed in the same transaction.
+        """
+        path = size = mtime = digest = None
+        if self.inputs:
+            sizes, mtimes, hashes = zip(*map(cache.file_info, self.inputs))
+            path, size, mtime = ','.join(self.inputs), sum(sizes), max(mtimes)
+            digest = _combine_hashes(hashes)
+        with db.engine.begin() as conn:
+            conn.execute(
+                """
+                INSERT INTO table_update (
+                    update_id, target_table, input_path, input_size,
+                    input_mtime, input_hash, n_rows)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (update_id) DO UPDATE SET
+                    target_table = EXCLUDED.target_table,
+                    inserted = now(),
+                    input_path = EXCLUDED.input_path,
+                    input_size = EXCLUDED.input_size,
+                    input_mtime = EXCLUDED.input_mtime,
+                    input_hash = EXCLUDED.input_hash,
+                    n_rows = EXCLUDED.n_rows
+                """,
+                (self.update_id, self.table, path, size, mtime, digest,
+                 n_rows))
+            conn.execute('DELETE FROM load_checkpoint WHERE update_id = %s',
+                         (self.update_id,))
+        if DatabaseTarget._completed is not None:
+            DatabaseTarget._completed[self.update_id] = digest
 
     def exists(self):
-        conn = db.engine.connect()
-        res = conn.execute(f'''
-            SELECT 1 FROM table_update
-            WHERE update_id = '{self.update_id}'
-            LIMIT 1
-        ''')
-        row = res.fetchone()
-        conn.close()
+        found, recorded_hash = self.recorded()
+        if not found:
+            return False
+        # Updates recorded without inputs can't be checked for changes
+        if not (self.incremental and self.inputs and recorded_hash):
+            return True
+        return self.input_hash() == recorded_hash
+
+
+def _combine_hashes(hashes):
+    if len(hashes) == 1:
+        return hashes[0]
+    return hashlib.sha256(','.join(hashes).encode()).hexdigest()
+
+
+class LoadTask(Task):
+    '''Task loading its inputs into the tables of its DatabaseTarget
+
+    Subclasses implement load(replace, checkpoint), returning the number of
+    rows loaded or a MergeResult. replace is set when the update was loaded
+    before, as when `build --incremental` found its input changed, so the
+    loader first deletes the rows it is about to load again. Loaders that
+    commit in chunks do so through the db.Checkpoint, so a task retried
+    after a failure resumes after the chunks already committed. The update
+    is only recorded once every chunk is in.
+
+    With REFERENCE on S3, the inputs of prefetch_tasks() are downloaded in
+    the background while the task loads (see fetch).
+
+    Each table is a Luigi resource, so with several workers no more than
+    TABLE_CONCURRENCY[table] tasks load into a table at once.
+    '''
+
+    @property
+    def resources(self):
+        return {table: 1 for table in self.output().table.split(',')}
 
-        return row is not None
+    def load(self, replace, checkpoint):
+        raise NotImplementedError
+
+    def prefetch_tasks(self):
+        return []
+
+    def run(self):
+        target = self.output()
+        prefetched = fetch.prefetch([
+            fpath for task in self.prefetch_tasks()
+            for fpath in task.output().inputs])
+        replace, _ = target.recorded()
+        checkpoint = db.Checkpoint(target.update_id, target.input_hash())
+        # Rows of chunks committed from other inputs must go too
+        result = self.load(replace or checkpoint.discarded, checkpoint)
+        if isinstance(result, db.MergeResult):
+            result = result.inserted
+        target.touch(n_rows=result)
+        # Forked workers exit after their task, stopping its downloads
+        wait(prefetched)
+
+
+class CohortLoadTask(LoadTask):
+    '''LoadTask of one TCGA cohort, prefetching the next cohorts' inputs'''
+
+    cohort = Parameter()
+
+    def prefetch_tasks(self):
+        cohorts = tcga_cohorts()
+        if self.cohort not in cohorts:
+            return []
+        start = cohorts.index(self.cohort) + 1
+        return [self.clone(cohort=cohort)
+                for cohort in cohorts[start:start + PREFETCH_COHORTS]]
 
 
 class DownloadGDAC(Task):
@@ -83,106 +243,159 @@ class BuildGDACTable(Task):
         return ReferenceTarget(path)
 
 
-class LoadTCGAClinical(Task):
+class ExtractGDACMatrix(Task):
 
+    data_type = Parameter()
     cohort = Parameter()
 
     def requires(self):
-        return BuildGDACTable(data_type='clinical', cohort=self.cohort)
+        return DownloadGDAC()
 
     def run(self):
-        tcga.load_tcga_clinical(self.input().path)
-        self.output().touch()
+        raise NotImplementedError('Downloading and extracting GDAC is not yet '
+                                  'tested. Point output to a pre-populated '
+                                  'folder of extracted GDAC matrices.')
+
+    def output(self):
+        matrix = tcga.gdac_params[self.data_type]['matrix']
+        path = f'{REFERENCE}/tcga/gdac/matrices/{self.cohort}.{matrix}'
+        return ReferenceTarget(path)
+
+
+class LoadTCGAClinical(CohortLoadTask):
+
+    def requires(self):
+        return BuildGDACTable(data_type='clinical', cohort=self.cohort)
+
+    def load(self, replace, checkpoint):
+        return tcga.load_tcga_clinical(self.input().path, replace=replace,
+                                       checkpoint=checkpoint)
 
     def output(self):
         update_id = f'TCGA {self.cohort} clinical'
-        return DatabaseTarget('patient_value,patient_text_value', update_id)
+        return DatabaseTarget('patient_value,patient_text_value', update_id,
+                              self.input().path)
 
 
-class LoadImmuneLandscape(Task):
+class LoadImmuneLandscape(LoadTask):
 
-    def run(self):
-        tcga.load_immune_landscape()
-        self.output().touch()
+    def load(self, replace, checkpoint):
+        return tcga.load_immune_landscape(replace=replace,
+                                          checkpoint=checkpoint)
 
     def output(self):
-        return DatabaseTarget('patient_value', 'immune landscape')
+        return DatabaseTarget('patient_value', 'immune landscape',
+                              tcga.IMMUNE_LANDSCAPE)
 
 
-class LoadTCIAPatient(Task):
+class LoadTCIAPatient(LoadTask):
 
-    def run(self):
-        tcga.load_tcia_patient()
-        self.output().touch()
+    def load(self, replace, checkpoint):
+        return tcga.load_tcia_patient(replace=replace, checkpoint=checkpoint)
 
     def output(self):
-        return DatabaseTarget('patient_value', 'TCIA patient')
+        return DatabaseTarget('patient_value', 'TCIA patient',
+                              tcga.TCIA_PATIENT)
 
 
-class LoadTCIAPathways(Task):
+class LoadTCIAPathways(LoadTask):
 
-    def run(self):
-        tcga.load_tcia_pathways()
-        self.output().touch()
+    def load(self, replace, checkpoint):
+        return tcga.load_tcia_pathways(replace=replace, checkpoint=checkpoint)
 
     def output(self):
-        return DatabaseTarget('patient_value', 'TCIA pathways')
+        return DatabaseTarget(
+            'patient_value', 'TCIA pathways',
+            [tcga.TCIA_GSEA_ENRICHMENT, tcga.TCIA_GSEA_DEPLETION])
 
 
-class LoadTCGAMutation(Task):
+class LoadTCGAMutation(LoadTask):
 
-    def run(self):
-        tcga.load_tcga_mutation()
-        self.output().touch()
+    def load(self, replace, checkpoint):
+        return tcga.load_tcga_mutation(replace=replace, checkpoint=checkpoint)
 
     def output(self):
         update_id = f'TCGA mutation'
-        return DatabaseTarget('sample_gene_value', update_id)
+        return DatabaseTarget('sample_gene_text_value', update_id,
+                              tcga.TCGA_MUTATIONS)
 
 
-class LoadTCGAProfile(Task):
+class LoadTCGAProfile(CohortLoadTask):
 
     data_type = Parameter()
-    cohort = Parameter()
 
     def requires(self):
-        return BuildGDACTable(data_type=self.data_type, cohort=self.cohort)
+        return ExtractGDACMatrix(data_type=self.data_type,
+                                 cohort=self.cohort)
 
-    def run(self):
-        tcga.load_tcga_profile(self.data_type, self.input().path)
-        self.output().touch()
+    def load(self, replace, checkpoint):
+        return tcga.load_tcga_profile(self.data_type, self.input().path,
+                                      self.cohort, checkpoint=checkpoint)
 
     def output(self):
         update_id = f'TCGA {self.cohort} {self.data_type}'
-        return DatabaseTarget('sample_gene_value', update_id)
-
+        return DatabaseTarget('sample_gene_value', update_id,
+                              self.input().path)
 
-class LoadTCGAIsoforms(Task):
 
-    cohort = Parameter()
+class LoadTCGAIsoforms(CohortLoadTask):
 
     def requires(self):
-        return BuildGDACTable(data_type='isoforms', cohort=self.cohort)
+        return {'matrix': ExtractGDACMatrix(data_type='isoforms',
+                                            cohort=self.cohort),
+                'parquet': ParseTCGAIsoforms()}
 
-    def run(self):
-        tcga.load_tcga_isoforms(self.input().path)
-        self.output().touch()
+    def load(self, replace, checkpoint):
+        return tcga.load_tcga_isoforms(self.cohort, replace=replace,
+                                       checkpoint=checkpoint)
 
     def output(self):
         update_id = f'TCGA {self.cohort} isoforms'
-        return DatabaseTarget('sample_isoform_value', update_id)
+        return DatabaseTarget('sample_isoform_value', update_id,
+                              self.input()['matrix'].path)
+
+
+def tcga_cohorts():
+    if cfg['ENV'] == 'dev':
+        return ['ACC', 'CHOL', 'DLBC']
+    cohorts = cache.read_csv(tcga.TCGA_COHORT_META)['cohort_id']
+    return [cohort for cohort in cohorts
+            if cohort not in ['LCML', 'FPPP', 'CNTL', 'MISC']]
+
+
+class ParseTCGAIsoforms(Task):
+    '''Tall isoform values of all cohorts as Parquet, partitioned by cohort
+
+    Cohorts are parsed in parallel, ahead of LoadTCGAIsoforms, which loads
+    each cohort's partition. Complete while every partition was parsed
+    from its matrix as it is now; only the others are parsed again.
+    '''
+
+    memory_gb = FloatParameter(default=cfg['PARSE_MEMORY_GB'])
+    workers = IntParameter(default=os.cpu_count())
+
+    def requires(self):
+        return {cohort: ExtractGDACMatrix(data_type='isoforms', cohort=cohort)
+                for cohort in tcga_cohorts()}
+
+    def stale(self):
+        return {cohort: target.path
+                for cohort, target in self.input().items()
+                if not tcga.isoform_parquet_current(target.path, cohort)}
+
+    def complete(self):
+        return (all(task.complete() for task in self.requires().values())
+                and not self.stale())
+
+    def run(self):
+        tcga.parse_tcga_isoform_cohorts(self.stale(),
+                                        memory_gb=self.memory_gb,
+                                        workers=self.workers)
 
 
 class LoadTCGA(WrapperTask):
     def requires(self):
-        if cfg['ENV'] == 'dev':
-            cohorts = ['ACC', 'CHOL', 'DLBC']
-        else:
-            cohorts = pd.read_csv(tcga.TCGA_COHORT_META)['cohort_id']
-
-        for cohort in cohorts:
-            if cohort in ['LCML', 'FPPP', 'CNTL', 'MISC']:
-                continue
+        for cohort in tcga_cohorts():
             yield LoadTCGAClinical(cohort=cohort)
             yield LoadTCGAMutation()
             yield LoadTCGAProfile(data_type='copy number', cohort=cohort)
@@ -190,40 +403,91 @@ class LoadTCGA(WrapperTask):
             yield LoadTCGAIsoforms(cohort=cohort)
 
 
-class LoadGTEx(Task):
-    def run(self):
-        gtex.load_gtex_median_tpm()
-        self.output().touch()
+class LoadGTEx(LoadTask):
+    def load(self, replace, checkpoint):
+        return gtex.load_gtex_median_tpm(replace=replace)
 
     def output(self):
-        return DatabaseTarget('tissue_gene_value', 'GTEx median')
+        return DatabaseTarget('tissue_gene_value', 'GTEx median',
+                              cfg['GTEX_MEDIAN_TPM'])
 
 
-class LoadHPAProtein(Task):
+class BuildGTExTPMStore(Task):
     def run(self):
-        hpa.load_hpa_protein()
-        self.output().touch()
+        gtex.build_gtex_tpm_store()
 
     def output(self):
-        return DatabaseTarget('cell_type_gene_text_value', 'HPA proteomics')
+        # The store folder is moved into place only once complete
+        return LocalTarget(op.join(cfg['GTEX_TPM_STORE'], 'tissues.csv'))
 
 
-class LoadHPAExpression(Task):
-    def run(self):
-        hpa.load_hpa_expression()
-        self.output().touch()
+class LoadHPAProtein(LoadTask):
+    def load(self, replace, checkpoint):
+        return hpa.load_hpa_protein(replace=replace)
+
+    def output(self):
+        return DatabaseTarget('cell_type_gene_text_value', 'HPA proteomics',
+                              hpa.HPA_NORMAL_TISSUE)
+
+
+class LoadHPAExpression(LoadTask):
+    def load(self, replace, checkpoint):
+        return hpa.load_hpa_expression(replace=replace)
 
     def output(self):
-        return DatabaseTarget('tissue_gene_value', 'HPA expression')
-
-
-def build():
-    luigi.build([
-        LoadTCGA(),
-        LoadImmuneLandscape(),
-        LoadTCIAPatient(),
-        LoadTCIAPathways(),
-        LoadGTEx(),
-        LoadHPAProtein(),
-        LoadHPAExpression()
-    ], local_scheduler=True)
+        return DatabaseTarget('tissue_gene_value', 'HPA expression',
+                              hpa.HPA_RNA_TISSUE)
+
+
+def set_table_resources(concurrency=cfg['TABLE_CONCURRENCY']):
+    config = luigi.configuration.get_config()
+    if not config.has_section('resources'):
+        config.add_section('resources')
+    for table, n_tasks in concurrency.items():
+        config.set('resources', table, str(n_tasks))
+
+
+def build(bulk_load=False, workers=1, incremental=False, profile=None):
+    '''Run all load tasks not yet completed
+
+    With incremental, tasks whose input files changed since they were
+    loaded run again, replacing the rows loaded from the old inputs.
+    profile is None, 'cpu' or 'mem' (see profiling). Without bulk_load,
+    tables left without their keys by a failed bulk load raise
+    BulkLoadError, as loads into them would no longer deduplicate.
+    '''
+    if not bulk_load:
+        missing = db.missing_constraints()
+        if missing:
+            raise db.BulkLoadError(missing)
+    db.resolver.clear()
+    profile_dir = profiling.start_build(metrics.start_build(), profile)
+    set_table_resources()
+    DatabaseTarget.incremental = incremental
+    DatabaseTarget.load_completed()
+    with db.bulk_load() if bulk_load else nullcontext():
+        luigi.build([
+            LoadTCGA(),
+            LoadImmuneLandscape(),
+            LoadTCIAPatient(),
+            LoadTCIAPathways(),
+            LoadGTEx(),
+            BuildGTExTPMStore(),
+            LoadHPAProtein(),
+            LoadHPAExpression()
+        ], workers=workers, local_scheduler=True)
+
+    # Tasks run by other worker processes log their own counts
+    for loader, n_rows in sorted(db.resolver.unmatched.items()):
+        print(f'{loader}: {n_rows} rows with unresolved identifiers')
+
+    if profile_dir:
+        print(f'Task profiles written to {profile_dir}')
+        print(profiling.summary(profile_dir))
+        profiling.start_build(None, None)
+
+
+def parse_isoforms(memory_gb=cfg['PARSE_MEMORY_GB'], workers=os.cpu_count()):
+    metrics.start_build()
+    luigi.build([ParseTCGAIsoforms(memory_gb=memory_gb, workers=workers)],
+                local_scheduler=True)
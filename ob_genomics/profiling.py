@@ -0,0 +1,118 @@
+'''Opt-in CPU and memory profiles of build tasks, written to SCRATCH
+
+With `build --profile=cpu`, each task runs under cProfile and its stats
+are written to {PROFILE_DIR}/{build}/{task_id}.pstats. With
+`--profile=mem`, tracemalloc traces the task. Its allocations at the
+highest traced memory seen at a metrics phase boundary, e.g. right after a
+file is parsed or copied, are written to {task_id}.allocations.txt, next
+to the snapshot. summary() combines the files of a build, including those
+written by forked workers.
+
+cProfile only sees the thread that runs the task: time spent in parallel
+COPY shards shows up as waiting on their futures.
+'''
+from collections import Counter
+import cProfile
+import glob
+import io
+import os
+import os.path as op
+import pstats
+import tracemalloc
+
+from ob_genomics.config import cfg
+
+PROFILE_DIR = op.join(cfg['SCRATCH'], 'profile')
+MODES = ['cpu', 'mem']
+TRACE_FRAMES = 10  # frames kept per traced allocation
+TOP = 30  # entries shown in reports and summaries
+
+mode = None
+build_dir = None
+_profiler = None
+_peak = (0, None)  # traced size and snapshot at the task's highest point
+
+
+def start_build(build_id, profile_mode):
+    '''Profile the tasks of a build, or stop profiling with None'''
+    global mode, build_dir
+    if profile_mode not in MODES + [None]:
+        raise ValueError(f'Unknown profile mode: {profile_mode}')
+    mode = profile_mode
+    build_dir = op.join(PROFILE_DIR, build_id) if mode else None
+    if build_dir:
+        os.makedirs(build_dir, exist_ok=True)
+    return build_dir
+
+
+def start_task(task_id):
+    global _profiler, _peak
+    if mode == 'cpu':
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    elif mode == 'mem':
+        _peak = (0, None)
+        tracemalloc.start(TRACE_FRAMES)
+
+
+def checkpoint():
+    '''Snapshot traced memory if it is the highest seen in the task'''
+    global _peak
+    if mode != 'mem' or not tracemalloc.is_tracing():
+        return
+    size, _ = tracemalloc.get_traced_memory()
+    if size > _peak[0]:
+        _peak = (size, tracemalloc.take_snapshot())
+
+
+def finish_task(task_id):
+    global _profiler
+    if mode == 'cpu' and _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(op.join(build_dir, f'{task_id}.pstats'))
+        _profiler = None
+    elif mode == 'mem' and tracemalloc.is_tracing():
+        checkpoint()
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = _peak[1]
+        tracemalloc.stop()
+        snapshot.dump(op.join(build_dir, f'{task_id}.snapshot'))
+        with open(op.join(build_dir, f'{task_id}.allocations.txt'), 'w') as f:
+            f.write(_allocation_report(snapshot.statistics('traceback'),
+                                       peak))
+
+
+def _allocation_report(stats, peak):
+    lines = [f'Peak traced memory: {peak / 2**20:.1f} MiB',
+             'Largest allocations at the highest snapshot:']
+    for stat in stats[:TOP]:
+        lines.append(f'{stat.size / 2**20:.1f} MiB in {stat.count} blocks')
+        lines.extend(f'    {line}' for line in stat.traceback.format())
+    return '\n'.join(lines) + '\n'
+
+
+def summary(path=None):
+    '''Hotspots over all tasks of a profiled build, as text
+
+    CPU profiles are merged and listed by cumulative, then own time. Memory
+    snapshots, one per task at its highest point, are summed by the line
+    that allocated the memory.
+    '''
+    path = path or build_dir
+    pstats_files = sorted(glob.glob(op.join(path, '*.pstats')))
+    if pstats_files:
+        out = io.StringIO()
+        stats = pstats.Stats(*pstats_files, stream=out)
+        stats.sort_stats('cumulative').print_stats(TOP)
+        stats.sort_stats('tottime').print_stats(TOP)
+        return out.getvalue()
+
+    sizes, counts = Counter(), Counter()
+    for fpath in sorted(glob.glob(op.join(path, '*.snapshot'))):
+        snapshot = tracemalloc.Snapshot.load(fpath)
+        for stat in snapshot.statistics('lineno'):
+            line = str(stat.traceback[0])
+            sizes[line] += stat.size
+            counts[line] += stat.count
+    return ''.join(f'{size / 2**20:10.1f} MiB {counts[line]:10d} blocks  '
+                   f'{line}\n' for line, size in sizes.most_common(TOP))
@@ -1,11 +1,21 @@
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+import json
+import os
 import os.path as op
 from subprocess import check_output
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from ob_genomics.config import cfg
+from ob_genomics import cache
+from ob_genomics import metrics
 import ob_genomics.database as db
-from ob_genomics.utils import is_numeric
+from ob_genomics.utils import split_typed_values
 
 REFERENCE = cfg['REFERENCE']
 
@@ -24,6 +34,26 @@ TCGA_SAMPLE_CODE = op.join(REFERENCE, 'tcga', 'sample_code.csv')
 # Curated mutations downloaded from GDC pan-cancer atlas
 # https://gdc.cancer.gov/about-data/publications/pancanatlas
 TCGA_MUTATIONS = op.join(REFERENCE, 'tcga', 'pancan', 'mc3.v0.2.8.PUBLIC.maf')
+# MAF columns kept for mutations, with their name in sample_gene_text_value
+MAF_COLUMNS = {
+    'Gene': 'ensembl_id',
+    'Tumor_Sample_Barcode': 'sample_id',
+    'Variant_Classification': 'variant classification',
+    'Variant_Type': 'variant type',
+    'HGVSp_Short': 'HGVSp_Short',
+}
+MUTATION_TYPES = [col for col in MAF_COLUMNS.values()
+                  if col not in ('sample_id', 'ensembl_id')]
+MAF_CHUNKSIZE = 500000  # MAF rows read per chunk
+
+# Tall isoform values of all cohorts, as Parquet partitioned by cohort
+TCGA_ISOFORM_PARQUET = op.join(cfg['SCRATCH'], 'tcga', 'isoforms.parquet')
+ISOFORM_SCHEMA = pa.schema([
+    ('transcript_id', pa.string()),
+    ('barcode', pa.string()),
+    ('rsem_normalized', pa.float32()),
+])
+PARSE_MEMORY_FACTOR = 2  # peak memory of parsing a matrix, by file size
 
 GDAC_LATEST = '2016_07_15'
 TEST_GENES = [3845, 7157, 4609, 2597]
@@ -101,17 +131,20 @@ gdac_params = {
     'expression': {
         'data_type': 'Merge_rnaseqv2__illuminahiseq_rnaseqv2__unc_edu__Level_3__RSEM_genes_normalized__data.Level_3',
         'run_type': 'stddata',
-        'suffix': 'rsem_normalized.csv'
+        'suffix': 'rsem_normalized.csv',
+        'matrix': 'rsem_genes_normalized.txt'
     },
     'isoforms': {
         'data_type': 'Merge_rnaseqv2__illuminahiseq_rnaseqv2__unc_edu__Level_3__RSEM_isoforms_normalized__data.Level_3',
         'run_type': 'stddata',
-        'suffix': 'isoform.csv'
+        'suffix': 'isoform.csv',
+        'matrix': 'rsem_isoforms_normalized.txt'
     },
     'copy number': {
         'data_type': 'CopyNumber_Gistic2.Level_4',
         'run_type': 'analyses',
-        'suffix': 'copy_number.csv'
+        'suffix': 'copy_number.csv',
+        'matrix': 'all_data_by_genes.txt'
     },
     'clinical': {
         'data_type': 'Clinical_Pick_Tier1.Level_4',
@@ -156,28 +189,41 @@ def load_tcga_sample_meta(cohort_fpath=TCGA_COHORT_META,
     conn = db.engine.connect()
     conn.execute("INSERT INTO source (source_id) VALUES ('TCGA')")
 
-    cohort = (pd.read_csv(cohort_fpath)
+    cohort = (cache.read_csv(cohort_fpath)
               .assign(source_id='TCGA')
               [['cohort_id', 'source_id', 'cohort_name']]
               .drop_duplicates())
     db.copy_from_df(cohort, 'cohort')
 
-    patient = (pd.read_csv(patient_fpath)
+    patient = (cache.read_csv(patient_fpath)
                [['patient_id', 'cohort_id']]
                .drop_duplicates(subset=['patient_id']))
-    db.copy_from_df(patient, 'patient')
+    db.copy_from_df(patient, 'patient', columns=list(patient.columns))
+    db.resolver.clear('patient_id')
 
-    sample = (pd.read_csv(sample_fpath)
+    sample = (cache.read_csv(sample_fpath)
               [['sample_id', 'patient_id', 'sample_code', 'sample_type']]
               .drop_duplicates())
-    db.copy_from_df(sample, 'sample')
+    sample = db.resolver.resolve(sample, {'patient_id': 'patient_id'},
+                                 loader='TCGA samples')
+    db.copy_from_df(sample, 'sample', columns=list(sample.columns))
+    db.resolver.clear('sample_id')
 
     conn.close()
 
 
-def load_immune_landscape(fpath=IMMUNE_LANDSCAPE):
+def _copy_values(df, table, conn, binary=False):
+    return db.copy_from_df(df, table, binary=binary, conn=conn)
+
+
+def _merge_values(df, table, conn, **kwargs):
+    return db.merge(df, table, conn=conn, **kwargs).inserted
+
+
+def load_immune_landscape(fpath=IMMUNE_LANDSCAPE, replace=False,
+                          checkpoint=None):
     df = (
-        pd.read_csv(fpath)
+        cache.read_csv(fpath)
         .drop('TCGA Study', axis=1)
         .rename(columns={
             'TCGA Participant Barcode': 'patient_id',
@@ -188,32 +234,38 @@ def load_immune_landscape(fpath=IMMUNE_LANDSCAPE):
         .dropna(subset=['Wound Healing'])
         .melt(id_vars='patient_id', var_name='data_type', value_name='value')
     )
+    df = db.resolver.resolve(df, {'patient_id': 'patient_id'},
+                             loader='Immune landscape')
 
     df.loc[:, "unit"] = df["data_type"].map(lambda dt: IMMUNE_LANDSCAPE_UNITS[dt])
 
     # Split into numeric values and text values
-    df['is_numeric'] = df['value'].map(is_numeric)
-    df_numeric = df[df['is_numeric']]
-    df_numeric['value'] = df_numeric['value'].map(float)
-    df_text = df[~df['is_numeric']]
-
-    # Load to database in respective tables
-    conn = db.engine.connect()
-    df_numeric = (df_numeric[['patient_id', 'data_type', 'unit', 'value']]
-                  .drop_duplicates(subset=['patient_id', 'data_type'])
-                  .dropna(subset=['value']))
-    db.copy_from_df(df_numeric,  'patient_value')
-
-    df_text = (df_text[['patient_id', 'data_type', 'unit', 'value']]
-               .drop_duplicates(subset=['patient_id', 'data_type'])
-               .dropna(subset=['value']))
-    db.copy_from_df(df_text, 'patient_text_value')
-    conn.close()
+    df_numeric, df_text, _ = split_typed_values(df, loader='Immune landscape')
 
+    db.add_source('Immune landscape')
+    checkpoint = checkpoint or db.Checkpoint()
+    if replace and not checkpoint.resuming:
+        for table in 'patient_value_fact', 'patient_text_value_fact':
+            db.delete_values(table, data_types=df['data_type'],
+                             source_id='Immune landscape')
 
-def load_tcia_patient(fpath=TCIA_PATIENT):
+    # Load to database in respective tables
+    df_numeric = (df_numeric[['patient_key', 'data_type', 'unit', 'value']]
+                  .drop_duplicates(subset=['patient_key', 'data_type'])
+                  .assign(source_id='Immune landscape'))
+    df_text = (df_text[['patient_key', 'data_type', 'unit', 'value']]
+               .drop_duplicates(subset=['patient_key', 'data_type'])
+               .assign(source_id='Immune landscape'))
+    return (
+        checkpoint.run(0, partial(_copy_values, df_numeric,
+                                  'patient_value_fact', binary=True)) +
+        checkpoint.run(1, partial(_copy_values, df_text,
+                                  'patient_text_value_fact')))
+
+
+def load_tcia_patient(fpath=TCIA_PATIENT, replace=False, checkpoint=None):
     df = (
-        pd.read_csv(fpath, sep='\t', low_memory=False)
+        cache.read_csv(fpath, sep='\t', low_memory=False)
         .drop(['datasource', 'disease'], axis=1)
         .melt(id_vars='barcode', var_name='data_type', value_name='value')
         .rename(columns={'barcode': 'patient_id'}))
@@ -221,61 +273,51 @@ def load_tcia_patient(fpath=TCIA_PATIENT):
     df.loc[:, 'unit'] = 'clinical'
 
     # Split into numeric values and text values
-    df.loc[:, 'is_numeric'] = df['value'].map(is_numeric)
-    df_numeric = df[df['is_numeric']]
-    df_numeric.loc[:, 'value'] = df_numeric['value'].map(float)
-    df_text = df[~df['is_numeric']]
+    df_numeric, df_text, _ = split_typed_values(df, loader='TCIA patient')
 
     # Load to database in respective tables
     df_numeric = (
         df_numeric[['patient_id', 'data_type', 'unit', 'value']]
-        .drop_duplicates(subset=['patient_id', 'data_type'])
-        .dropna(subset=['value']))
+        .drop_duplicates(subset=['patient_id', 'data_type']))
     df_text = (
         df_text[['patient_id', 'data_type', 'unit', 'value']]
-        .drop_duplicates(subset=['patient_id', 'data_type'])
-        .dropna(subset=['value']))
-
-    conn = db.engine.connect()
-    try:
-        conn.execute('''
-            CREATE TABLE tmp_tcia_patient_text
-            (patient_id varchar, data_type varchar,
-             unit varchar, value varchar)
-        ''')
-        db.copy_from_df(df_text, 'tmp_tcia_patient_text')
-        conn.execute('''
-            INSERT INTO patient_text_value
-            (patient_id, data_type, unit, value)
-            SELECT tmp.patient_id, tmp.data_type, tmp.unit, tmp.value
-            FROM tmp_tcia_patient_text tmp
-            ON CONFLICT DO NOTHING
-        ''')
-
-        conn.execute('''
-            CREATE TABLE tmp_tcia_patient_num
-            (patient_id varchar, data_type varchar,
-             unit varchar, value numeric)
-        ''')
-        db.copy_from_df(df_numeric, 'tmp_tcia_patient_num')
-        conn.execute('''
-            INSERT INTO patient_value
-            (patient_id, data_type, unit, value)
-            SELECT tmp.patient_id, tmp.data_type, tmp.unit, tmp.value
-            FROM tmp_tcia_patient_num tmp
-            ON CONFLICT DO NOTHING
-        ''')
-    finally:
-        conn.execute('DROP TABLE tmp_tcia_patient_text')
-        conn.execute('DROP TABLE tmp_tcia_patient_num')
-        conn.close()
+        .drop_duplicates(subset=['patient_id', 'data_type']))
+
+    df_numeric = db.resolver.resolve(
+        df_numeric, {'patient_id': 'patient_id'}, loader='TCIA patient')
+    df_text = db.resolver.resolve(
+        df_text, {'patient_id': 'patient_id'}, loader='TCIA patient')
+    # TCGA clinical values of the same data types win: only rows loaded from
+    # TCIA are replaced, and values already loaded are kept on conflict
+    db.add_source('TCIA')
+    checkpoint = checkpoint or db.Checkpoint()
+    if replace and not checkpoint.resuming:
+        for table in 'patient_value_fact', 'patient_text_value_fact':
+            db.delete_values(table, data_types=df['data_type'],
+                             source_id='TCIA')
+    return (
+        checkpoint.run(0, partial(_merge_values, df_text,
+                                  'patient_text_value_fact',
+                                  constants={'source_id': 'TCIA'},
+                                  on_conflict='nothing')) +
+        checkpoint.run(1, partial(_merge_values, df_numeric,
+                                  'patient_value_fact',
+                                  constants={'source_id': 'TCIA'},
+                                  on_conflict='nothing')))
 
 
 def load_tcia_pathways(up_fpath=TCIA_GSEA_ENRICHMENT,
-                       down_fpath=TCIA_GSEA_DEPLETION):
-    for fpath in up_fpath, down_fpath:
+                       down_fpath=TCIA_GSEA_DEPLETION, replace=False,
+                       checkpoint=None):
+    db.add_source('TCIA pathways')
+    checkpoint = checkpoint or db.Checkpoint()
+    n_rows = 0
+    for chunk, fpath in enumerate([up_fpath, down_fpath]):
+        if not checkpoint.pending(chunk):
+            n_rows += checkpoint.done[chunk]
+            continue
         df = (
-            pd.read_csv(fpath, sep='\t')
+            cache.read_csv(fpath, sep='\t')
             .drop(['disease'], axis=1)
             .rename(columns={
                 'patients': 'patient_id',
@@ -290,64 +332,192 @@ def load_tcia_pathways(up_fpath=TCIA_GSEA_ENRICHMENT,
         df = (df[['patient_id', 'data_type', 'unit', 'value']]
               .drop_duplicates(subset=['patient_id', 'data_type'])
               .dropna(subset=['value']))
-        db.copy_from_df(df, 'patient_value')
+        df = db.resolver.resolve(df, {'patient_id': 'patient_id'},
+                                 loader='TCIA pathways')
+        df['source_id'] = 'TCIA pathways'
+        if replace and chunk == 0:
+            # Both files hold the same cell types
+            db.delete_values('patient_value_fact', data_types=df['data_type'],
+                             source_id='TCIA pathways')
+        n_rows += checkpoint.run(chunk, partial(
+            _copy_values, df, 'patient_value_fact', binary=True))
+    return n_rows
+
+
+def read_gdac_matrix(fpath, data_type, sample_ids=True):
+    '''Read a GDAC gene or isoform by sample matrix as float32, in one pass
+
+    Rows are labeled with Entrez gene IDs, or isoform IDs for isoforms, and
+    columns with sample IDs cut from the aliquot barcodes, or the barcodes
+    themselves with sample_ids=False.
+    '''
+    if data_type == 'copy number':
+        # GISTIC2 all_data_by_genes: symbol, Entrez ID and cytoband columns
+        labels = {'Gene Symbol': str, 'Locus ID': 'int64', 'Cytoband': str}
+        skiprows = None
+    else:
+        # RSEM: second header line names the value of each column
+        labels, skiprows = {'Hybridization REF': str}, [1]
+    mat = cache.read_csv(fpath, sep='\t', skiprows=skiprows,
+                      dtype=defaultdict(lambda: 'float32', labels))
+
+    if data_type == 'copy number':
+        mat = mat.set_index('Locus ID').drop(columns=['Gene Symbol',
+                                                      'Cytoband'])
+    else:
+        mat = mat.set_index('Hybridization REF')
+    if data_type == 'expression':
+        # Genes are labeled symbol|entrez_id
+        mat.index = mat.index.str.split('|').str[1].astype(int)
+    if sample_ids:
+        mat.columns = mat.columns.str.slice(0, 15)
+    return mat
 
 
-def load_tcga_profile(data_type, fpath):
+def load_tcga_profile(data_type, fpath, cohort, env=cfg['ENV'],
+                      checkpoint=None):
     if data_type == "copy number":
-        cols = ["sample", "entrez_id", "data_type", "unit", "copy_number"]
         unit = "log2 ratio"
     elif data_type == "expression":
-        cols = [
-            "sample",
-            "entrez_id",
-            "data_type",
-            "unit",
-            "normalized_counts",
-        ]
         unit = "normalized_counts"
     else:
         raise ValueError("Data type not recognized")
 
-    db.load_sample_gene_values(fpath, data_type, cols, unit)
-
-
-def parse_tcga_isoforms(fpath):
-    mat = pd.read_csv(fpath, sep='\t', skiprows=2, header=None)
-    header = pd.read_csv(fpath, sep='\t', nrows=0)
-    mat.columns = header.columns
-
-    df = (
-        mat
-        .rename(columns={'Hybridization REF': 'transcript_id'})
-        .melt(
-            id_vars=['transcript_id'],
-            var_name='barcode',
-            value_name='value')
-    )
-    return df
-
-
-def load_tcga_isoforms(fpath, env=cfg['ENV']):
-    df = (
-        pd.read_csv(fpath)
-        .rename(columns={
-            'transcript_id': 'isoform_id',
-            'rsem_normalized': 'value'})
-    )
-    df['sample_id'] = df['barcode'].map(lambda s: s[:15])
-    df['unit'] = 'normalized_counts'
-    df = df[['sample_id', 'isoform_id', 'unit', 'value']]
-    df = df.drop_duplicates(subset=['sample_id', 'isoform_id'])
-
+    mat = read_gdac_matrix(fpath, data_type)
+    mat = mat[mat.index > 0]
     if env == 'dev':
-        df = df[df['isoform_id'].isin(cfg['TEST_ISOFORMS'])]
-
-    db.copy_from_df(df, 'sample_isoform_value')
-
-
-def load_tcga_clinical(fpath):
-    mat = pd.read_csv(fpath, sep='\t')
+        mat = mat[mat.index.isin(TEST_GENES)]
+
+    # Replaces the cohort's partition, so reloading needs no delete
+    return db.load_sample_gene_matrix(mat, data_type, unit, cohort,
+                                      checkpoint=checkpoint)
+
+
+def isoform_parquet(cohort, out_dir=TCGA_ISOFORM_PARQUET):
+    return op.join(out_dir, f'cohort={cohort}', 'part-0.parquet')
+
+
+def isoform_parquet_current(fpath, cohort, out_dir=TCGA_ISOFORM_PARQUET):
+    '''Whether a cohort's Parquet was parsed from fpath as it is now'''
+    path = isoform_parquet(cohort, out_dir)
+    if not op.exists(path):
+        return False
+    metadata = pq.read_schema(path).metadata or {}
+    return metadata.get(b'source_hash') == cache.content_hash(fpath).encode()
+
+
+def parse_tcga_isoforms(fpath, cohort, out_dir=TCGA_ISOFORM_PARQUET):
+    '''Write one cohort's RSEM isoform matrix as tall Parquet
+
+    The matrix is read once as float32 and written to
+    {out_dir}/cohort={cohort}/ with ISOFORM_SCHEMA, one row group per block
+    of samples. The schema metadata records the matrix's content hash and
+    its barcodes in order. Returns the number of values written.
+    '''
+    mat = read_gdac_matrix(fpath, 'isoforms', sample_ids=False)
+    path = isoform_parquet(cohort, out_dir)
+    os.makedirs(op.dirname(path), exist_ok=True)
+    schema = ISOFORM_SCHEMA.with_metadata({
+        'source_hash': cache.content_hash(fpath),
+        'barcodes': json.dumps(list(mat.columns)),
+    })
+
+    n_values = 0
+    with pq.ParquetWriter(f'{path}.tmp', schema) as writer:
+        for block in db.matrix_blocks(mat, 'barcode', 'transcript_id'):
+            df = block().rename(columns={'value': 'rsem_normalized'})
+            writer.write_table(
+                pa.Table.from_pandas(df, schema=schema, preserve_index=False),
+                row_group_size=max(len(df), 1))
+            n_values += len(df)
+    os.replace(f'{path}.tmp', path)
+    return n_values
+
+
+def parse_tcga_isoform_cohorts(fpaths, out_dir=TCGA_ISOFORM_PARQUET,
+                               memory_gb=cfg['PARSE_MEMORY_GB'],
+                               workers=None):
+    '''Parse cohorts' isoform matrices in a process pool, within memory_gb
+
+    fpaths maps cohorts to RSEM isoform matrices. Each cohort is expected
+    to need PARSE_MEMORY_FACTOR times its file size. Cohorts start, largest
+    first, whenever they fit next to the running ones; a cohort larger than
+    memory_gb runs alone. Returns the number of values written by cohort.
+    '''
+    workers = workers or os.cpu_count()
+    limit = memory_gb * 2**30
+    sizes = {cohort: PARSE_MEMORY_FACTOR * cache.file_info(fpath)[0]
+             for cohort, fpath in fpaths.items()}
+    pending = sorted(sizes, key=sizes.get, reverse=True)
+    running, written = {}, {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for cohort in list(pending):
+                in_use = sum(sizes[c] for c in running.values())
+                if len(running) < workers and (
+                        not running or in_use + sizes[cohort] <= limit):
+                    pending.remove(cohort)
+                    future = pool.submit(parse_tcga_isoforms, fpaths[cohort],
+                                         cohort, out_dir)
+                    running[future] = cohort
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                cohort = running.pop(future)
+                written[cohort] = future.result()
+                # Parsed in other processes, so counted here
+                metrics.count(rows_read=written[cohort])
+    return written
+
+
+def _isoform_block(path, row_group, sample_keys, unit_id, env):
+    '''Rows of sample_isoform_value_fact from one row group of the Parquet'''
+    df = (pq.ParquetFile(path).read_row_group(row_group).to_pandas()
+          .rename(columns={'rsem_normalized': 'value'}))
+    if env == 'dev':
+        df = df[df['transcript_id'].isin(cfg['TEST_ISOFORMS'])]
+    # Aliquots of unknown samples, or of samples with an earlier aliquot
+    kept = df['barcode'].isin(sample_keys).to_numpy()
+    metrics.count(rows_dropped=int((~kept).sum()))
+    df = df[kept]
+    df = db.resolver.resolve(
+        df.assign(sample_key=df['barcode'].map(sample_keys)),
+        {'transcript_id': 'isoform_id'}, loader='TCGA isoforms')
+    # Row groups hold every isoform of their samples: the first row wins
+    df = df.drop_duplicates(subset=['sample_key', 'isoform_id'])
+    return df.assign(unit_id=unit_id)[
+        ['sample_key', 'isoform_id', 'unit_id', 'value']]
+
+
+def load_tcga_isoforms(cohort, out_dir=TCGA_ISOFORM_PARQUET, env=cfg['ENV'],
+                       replace=False, checkpoint=None):
+    '''Load a cohort's isoform values from parse_tcga_isoforms' Parquet
+
+    Each row group is a block of samples, read and sent on its own, so the
+    wide matrix is never parsed again. As when loading the matrix, the
+    first aliquot of a sample wins. Returns the number of values loaded.
+    '''
+    path = isoform_parquet(cohort, out_dir)
+    metadata = pq.read_schema(path).metadata
+    barcodes = pd.Series(json.loads(metadata[b'barcodes']))
+    keys = pd.Series(db.resolver.map('sample_id', barcodes.str.slice(0, 15)),
+                     index=barcodes)
+    keys = keys[keys.notna() & ~keys.duplicated()].astype('int64')
+    sample_keys = keys.to_dict()
+
+    if replace and not (checkpoint and checkpoint.resuming):
+        db.delete_values('sample_isoform_value_fact',
+                         sample_key=keys.unique())
+    unit_id = int(db.dictionaries['unit'].encode(['normalized_counts'])[0])
+    blocks = [partial(_isoform_block, path, row_group, sample_keys, unit_id,
+                      env)
+              for row_group in range(pq.ParquetFile(path).num_row_groups)]
+    return db.parallel_copy_from_blocks(
+        blocks, 'sample_isoform_value_fact', binary=True,
+        checkpoint=checkpoint or db.Checkpoint())
+
+
+def load_tcga_clinical(fpath, replace=False, checkpoint=None):
+    mat = cache.read_csv(fpath, sep='\t')
     df = mat.melt(id_vars='Hybridization REF', var_name='patient_id',
                   value_name='value')
     df = df[df['Hybridization REF'] != 'Composite Element REF']
@@ -356,94 +526,105 @@ def load_tcga_clinical(fpath):
     df = df.rename(columns={'Hybridization REF': 'data_type'})
     df = df.drop_duplicates(subset=['patient_id', 'data_type'])
     df = df.dropna(subset=['value'])
-
-    df['is_numeric'] = df['value'].map(is_numeric)
-    df_numeric = df[df['is_numeric']]
-    df_text = df[~df['is_numeric']]
-
-    df_numeric = df_numeric[['patient_id', 'data_type', 'unit', 'value']]
-    db.copy_from_df(df_numeric, 'patient_value')
-    df_text = df_text[['patient_id', 'data_type', 'unit', 'value']]
-    db.copy_from_df(df_text, 'patient_text_value')
-
-
-def load_tcga_mutation(fpath=TCGA_MUTATIONS, env=cfg['ENV']):
-    maf = pd.read_csv(fpath, sep='\t')
-    #if 'Protein_Change' in maf.columns:
-    df = maf[
-        [
-            'Gene',
-            'Tumor_Sample_Barcode',
-            'Variant_Classification',
-            'Variant_Type',
-            'HGVSp_Short',
-        ]
-    ]
-    # elif 'AAChange' in maf.columns:
-    #     df = maf[
-    #         [
-    #             'Entrez_Gene_Id',
-    #             'Tumor_Sample_Barcode',
-    #             'Variant_Classification',
-    #             'Variant_Type',
-    #             'AAChange',
-    #         ]
-    #     ]
-    # elif 'amino_acid_change' in maf.columns:
-    #     df = maf[
-    #         [
-    #             'Entrez_Gene_Id',
-    #             'Tumor_Sample_Barcode',
-    #             'Variant_Classification',
-    #             'Variant_Type',
-    #             'amino_acid_change',
-    #         ]
-    #     ]
-    # else:
-    #     raise Exception(
-    #         'MAF file should have either "Protein_Change", "AAChange", '
-    #         'or "amino_acid_change" column'
-    #     )
-    df.loc[:, 'sample_id'] = df['Tumor_Sample_Barcode'].map(lambda s: s[:15])
-    df = df.drop('Tumor_Sample_Barcode', axis=1)
-    df = df.rename(columns={
-        'Gene': 'ensembl_id',
-        'Variant_Type': 'variant type',
-        'Variant_Classification': 'variant classification',
-        'AAChange': 'AA change'})
-    # df = df[df['gene_id'] > 0]
-
-    # if env == 'dev':
-    #     df = df[df['ensembl_id'].isin(cfg['TEST_ENSEMBL_GENES'])]
-
-    df = df.melt(id_vars=['sample_id', 'ensembl_id'],
-                 var_name='data_type', value_name='value')
-    df.loc[:, 'unit'] = 'mutation'
+    df = db.resolver.resolve(df, {'patient_id': 'patient_id'},
+                             loader='TCGA clinical')
+
+    df_numeric, df_text, _ = split_typed_values(df, loader='TCGA clinical')
+
+    # Clinical values win over TCIA values of the same data types, whichever
+    # is loaded first
+    checkpoint = checkpoint or db.Checkpoint()
+    if replace and not checkpoint.resuming:
+        for table in 'patient_value_fact', 'patient_text_value_fact':
+            db.delete_values(table, data_types=df['data_type'],
+                             patient_key=df['patient_key'].unique(),
+                             source_id='TCGA')
+
+    df_numeric = df_numeric[['patient_key', 'data_type', 'unit', 'value']]
+    df_text = df_text[['patient_key', 'data_type', 'unit', 'value']]
+    return (
+        checkpoint.run(0, partial(_merge_values, df_numeric,
+                                  'patient_value_fact',
+                                  constants={'source_id': 'TCGA'},
+                                  on_conflict='update')) +
+        checkpoint.run(1, partial(_merge_values, df_text,
+                                  'patient_text_value_fact',
+                                  constants={'source_id': 'TCGA'},
+                                  on_conflict='update')))
+
+
+def read_maf(fpath, chunksize=MAF_CHUNKSIZE):
+    '''Read the mutation columns of a MAF file, chunksize rows at a time
+
+    Only MAF_COLUMNS are parsed, as categoricals, and renamed. Tumor sample
+    barcodes are cut to the 15-character sample_id.
+    '''
+    reader = cache.read_csv(fpath, sep='\t', usecols=list(MAF_COLUMNS),
+                         dtype='category', chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk[list(MAF_COLUMNS)].rename(columns=MAF_COLUMNS)
+        chunk['sample_id'] = (chunk['sample_id'].str.slice(0, 15)
+                              .astype('category'))
+        yield chunk
+
+
+def _mutation_values(maf, seen):
+    '''Tall, resolved values of one chunk of read_maf not in earlier chunks
+
+    seen holds the sorted keys of sample, gene and data type of earlier
+    chunks, and is returned updated along with the values. Duplicates are
+    dropped here rather than left to conflicts on the primary key, which
+    bulk_load drops for the duration of a build.
+    '''
+    df = maf.melt(id_vars=['sample_id', 'ensembl_id'],
+                  var_name='data_type', value_name='value')
     df = df.drop_duplicates(subset=['ensembl_id', 'sample_id', 'data_type'])
     df = df.dropna(subset=['value'])
-
-    df = df[['sample_id', 'ensembl_id', 'data_type', 'unit', 'value']]
-
-    conn = db.engine.connect()
-
-    try:
-        conn.execute('''
-            CREATE TABLE tmp_tcga_maf
-            (sample_id varchar, ensembl_id varchar, data_type varchar,
-             unit varchar, value varchar)
-        ''')
-
-        db.copy_from_df(df, 'tmp_tcga_maf')
-
-        conn.execute('''
-            INSERT INTO sample_gene_text_value
-            (sample_id, gene_id, data_type, unit, value)
-            SELECT tmp.sample_id, g.gene_id, tmp.data_type,
-                   tmp.unit, tmp.value
-            FROM tmp_tcga_maf tmp
-            INNER JOIN gene g ON g.ensembl_id = tmp.ensembl_id
-            INNER JOIN sample s ON s.sample_id = tmp.sample_id
-        ''')
-    finally:
-        conn.execute('DROP TABLE tmp_tcga_maf')
-        conn.close()
+    df = df.astype({'value': str})
+
+    df = df[['sample_id', 'ensembl_id', 'data_type', 'value']]
+    df = db.resolver.resolve(
+        df, {'sample_id': 'sample_id', 'ensembl_id': 'ensembl_id'},
+        loader='TCGA mutation')
+    # Retired Ensembl IDs can resolve to the gene of another row
+    df = df.drop_duplicates(subset=['sample_key', 'gene_id', 'data_type'])
+
+    data_types = pd.Categorical(df['data_type'], categories=MUTATION_TYPES)
+    keys = ((df['sample_key'].to_numpy(dtype=np.int64) << 32
+             | df['gene_id'].to_numpy(dtype=np.int64)) * len(MUTATION_TYPES)
+            + data_types.codes)
+    new = ~np.isin(keys, seen, assume_unique=True)
+    return df.loc[new], np.union1d(seen, keys[new])
+
+
+def _load_mutations(df, conn):
+    '''Merge values of _mutation_values on an open connection'''
+    if df.empty:
+        return 0
+    return db.merge(df, 'sample_gene_text_value_fact',
+                    constants={'unit': 'mutation'}, on_conflict='nothing',
+                    conn=conn).inserted
+
+
+def load_tcga_mutation(fpath=TCGA_MUTATIONS, replace=False, checkpoint=None):
+    '''Stream MC3 mutations into sample_gene_text_value chunk by chunk
+
+    Memory use is bounded by one chunk and the keys loaded so far, whatever
+    the size of the MAF. The first row for a sample, gene and data type
+    wins: later duplicates are dropped, across chunks too, and rows loaded
+    before are kept on conflict. With replace, mutations loaded before are
+    deleted first. Each chunk is committed with its Checkpoint: on a retry,
+    chunks committed before are still read, for their keys, but not loaded.
+    Returns the number of rows inserted.
+    '''
+    checkpoint = checkpoint or db.Checkpoint()
+    if replace and not checkpoint.resuming:
+        db.delete_values('sample_gene_text_value_fact',
+                         data_types=MUTATION_TYPES)
+
+    seen = np.array([], dtype=np.int64)
+    n_rows = 0
+    for chunk, maf in enumerate(read_maf(fpath)):
+        df, seen = _mutation_values(maf, seen)
+        n_rows += checkpoint.run(chunk, partial(_load_mutations, df))
+    return n_rows
@@ -1,6 +1,85 @@
-def is_numeric(val):
-    try:
-        float(val)
-        return True
-    except ValueError:
-        return False
+from collections import namedtuple
+import logging
+import os
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+TypedValues = namedtuple('TypedValues', ['numeric', 'text', 'stats'])
+
+
+def split_typed_values(df, loader=None, column='value', by='data_type'):
+    '''Split EAV rows into numeric and text values
+
+    Values are coerced to numbers once for the whole column instead of
+    trying float() cell by cell. Rows whose value parses go to the numeric
+    frame, with the value as float; the other non-missing rows go to the
+    text frame, with the value as str. stats counts numeric and text values
+    for each data type. Data types with both kinds are logged under loader.
+    '''
+    values = pd.to_numeric(df[column], errors='coerce')
+    numeric = values.notna()
+    text = df[column].notna() & ~numeric
+
+    stats = (pd.DataFrame({by: df[by], 'numeric': numeric, 'text': text})
+             .groupby(by).sum())
+    mixed = stats[(stats['numeric'] > 0) & (stats['text'] > 0)]
+    if loader is not None and len(mixed):
+        logger.info(f'{loader}: {len(mixed)} data types with both numeric '
+                    f'and text values: {", ".join(map(str, mixed.index))}')
+
+    return TypedValues(
+        numeric=df[numeric].assign(**{column: values[numeric]}),
+        text=df[text].assign(**{column: df.loc[text, column].astype(str)}),
+        stats=stats)
+
+
+def file_shards(fpath, n, skip_lines=0):
+    '''Split a text file into at most n (start, end) byte ranges
+
+    Boundaries fall on line starts, after the first skip_lines lines.
+    '''
+    size = os.path.getsize(fpath)
+    with open(fpath, 'rb') as f:
+        for _ in range(skip_lines):
+            f.readline()
+        start = f.tell()
+        bounds = [start]
+        for i in range(1, n):
+            pos = start + (size - start) * i // n
+            if pos <= bounds[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline()
+            if bounds[-1] < f.tell() < size:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+class FileRange:
+    '''Read-only file-like view of the bytes [start, end) of a file'''
+
+    def __init__(self, fpath, start, end):
+        self._f = open(fpath, 'rb')
+        self._f.seek(start)
+        self._remaining = end - start
+
+    def _limit(self, size):
+        if size < 0 or size > self._remaining:
+            return self._remaining
+        return size
+
+    def read(self, size=-1):
+        data = self._f.read(self._limit(size))
+        self._remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self._f.readline(self._limit(size))
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._f.close()
@@ -0,0 +1,93 @@
+"""Compare text and binary COPY encoding of a sample_gene_value-shaped frame.
+
+Encoding is timed on its own by default. Pass --load to also COPY into the
+configured database, using a temporary copy of sample_gene_value without
+constraints that is rolled back afterwards.
+
+    $ python scripts/benchmark_copy.py --rows 2000000
+    $ python scripts/benchmark_copy.py --rows 2000000 --load
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import MetaData
+
+from ob_genomics import database as db
+from ob_genomics import models
+from ob_genomics import pgbinary
+
+
+def make_frame(n_rows, n_samples=1000):
+    n_genes = max(n_rows // n_samples, 1)
+    return pd.DataFrame({
+        'sample_key': np.repeat(np.arange(1, n_samples + 1), n_genes)[:n_rows],
+        'gene_id': np.tile(np.arange(1, n_genes + 1), n_samples)[:n_rows],
+        'data_type_id': 1,
+        'cohort_id': 'BRCA',
+        'unit_id': 1,
+        'value': np.random.lognormal(5, 2, n_rows),
+    })
+
+
+def encoders(chunksize):
+    table = models.base.metadata.tables['sample_gene_value_fact']
+    formats = pgbinary.table_formats(table)
+    return {
+        'text': lambda df: db.iter_csv_chunks(df, chunksize),
+        'binary': lambda df: pgbinary.iter_binary_chunks(
+            df, formats, chunksize),
+    }
+
+
+def time_encode(df, encode):
+    start = time.perf_counter()
+    nbytes = sum(len(chunk) for chunk in encode(df))
+    return time.perf_counter() - start, nbytes
+
+
+def time_load(df, encode, binary):
+    table = (models.base.metadata.tables['sample_gene_value_fact']
+             .tometadata(MetaData(), name='bench_sample_gene_value'))
+    conn = db.engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute('CREATE TEMP TABLE bench_sample_gene_value '
+                    '(LIKE sample_gene_value_fact)')
+        stream = db.CopyStream(encode(df))
+        start = time.perf_counter()
+        if binary:
+            db.copy_binary(cur, stream, table)
+        else:
+            cur.copy_from(stream, table.name)
+        elapsed = time.perf_counter() - start
+    finally:
+        conn.rollback()
+        conn.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--chunksize', type=int, default=db.COPY_CHUNKSIZE)
+    parser.add_argument('--load', action='store_true',
+                        help='also COPY into the database and roll back')
+    args = parser.parse_args()
+
+    df = make_frame(args.rows)
+    print(f'{len(df):,} rows, {df.memory_usage(deep=True).sum() / 1e6:.0f} MB '
+          'in memory')
+    for name, encode in encoders(args.chunksize).items():
+        elapsed, nbytes = time_encode(df, encode)
+        line = (f'{name:>6}: encode {elapsed:6.2f}s '
+                f'({len(df) / elapsed:,.0f} rows/s, {nbytes / 1e6:.0f} MB)')
+        if args.load:
+            elapsed = time_load(df, encode, binary=name == 'binary')
+            line += f', encode+COPY {elapsed:6.2f}s'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Compare storing EAV values as numeric, double precision and real.
+
+Builds temporary sample_gene_value-shaped tables holding the same synthetic
+values as numeric (the previous schema), double precision and real, then
+reports each table's size and the time of a gene-level aggregation over it.
+The tables are temporary and go away with the connection.
+
+    $ python scripts/benchmark_value_storage.py --rows 5000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from ob_genomics import database as db
+from ob_genomics import pgbinary
+
+VALUE_TYPES = ['numeric', 'double precision', 'real']
+AGGREGATE = '''
+    SELECT gene_id, count(*), avg(value), max(value)
+    FROM {table} GROUP BY gene_id
+'''
+
+
+def make_frame(n_rows, n_samples=1000):
+    n_genes = max(n_rows // n_samples, 1)
+    return pd.DataFrame({
+        'sample_key': np.repeat(np.arange(1, n_samples + 1), n_genes)[:n_rows],
+        'gene_id': np.tile(np.arange(1, n_genes + 1), n_samples)[:n_rows],
+        'value': np.random.lognormal(5, 2, n_rows),
+    })
+
+
+def create_tables(cur, df, chunksize):
+    '''One temporary table per value type, all with the same rows'''
+    tables = {}
+    for value_type in VALUE_TYPES:
+        name = f'bench_{value_type.split()[0]}'
+        cur.execute(f'CREATE TEMP TABLE {name} (sample_key integer, '
+                    f'gene_id integer, value {value_type}, '
+                    'PRIMARY KEY (sample_key, gene_id))')
+        tables[value_type] = name
+
+    source = tables['double precision']
+    stream = db.CopyStream(pgbinary.iter_binary_chunks(
+        df, ['>i4', '>i4', '>f8'], chunksize))
+    db.copy_stream(cur, stream, source, binary=True)
+    for value_type, name in tables.items():
+        if name != source:
+            cur.execute(f'INSERT INTO {name} SELECT sample_key, gene_id, '
+                        f'value::{value_type} FROM {source}')
+        cur.execute(f'ANALYZE {name}')
+    return tables
+
+
+def time_query(cur, sql, repeat):
+    '''Best wall time of several runs'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cur.execute(sql)
+        cur.fetchall()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--chunksize', type=int, default=db.COPY_CHUNKSIZE)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of the aggregation, the best is reported')
+    args = parser.parse_args()
+
+    df = make_frame(args.rows)
+    conn = db.engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        tables = create_tables(cur, df, args.chunksize)
+        print(f'{len(df):,} rows')
+        for value_type, name in tables.items():
+            cur.execute('SELECT pg_relation_size(%s), '
+                        'pg_indexes_size(%s)', (name, name))
+            heap, index = cur.fetchone()
+            elapsed = time_query(cur, AGGREGATE.format(table=name),
+                                 args.repeat)
+            print(f'{value_type:>16}: table {heap / 1e6:7.1f} MB, '
+                  f'index {index / 1e6:7.1f} MB, '
+                  f'aggregate by gene {elapsed:6.3f}s')
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,7 @@ setuptools.setup(
         'luigi',
         'pandas',
         'psycopg2',
+        'pyarrow',
         'PyYAML',
         'sqlalchemy'
     ],